@@ -1,7 +1,24 @@
 """Configuración central. Lee variables de entorno (Coolify) con valores por defecto
 seguros para desarrollo local. Nunca hardcodear secretos aquí."""
 from functools import lru_cache
+from typing import Literal
+
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy.engine import make_url
+
+
+def _con_driver(url: str, driver: str) -> str:
+    """La URL con el driver indicado, venga como `postgres://`, `postgresql://` o con otro
+    driver (las bases gestionadas de Coolify entregan `postgresql://` a secas)."""
+    u = make_url(url)
+    if u.get_backend_name() not in ("postgres", "postgresql"):
+        return url
+    u = u.set(drivername=f"postgresql+{driver}")
+    if driver == "asyncpg" and "sslmode" in u.query:
+        # asyncpg no entiende sslmode (de libpq); su equivalente es ssl
+        u = u.update_query_dict({"ssl": u.query["sslmode"]}).difference_update_query(["sslmode"])
+    return u.render_as_string(hide_password=False)
 
 
 class Settings(BaseSettings):
@@ -9,10 +26,14 @@ class Settings(BaseSettings):
 
     # --- Base de datos ---
     database_url: str = "postgresql+psycopg2://cerritos:cerritos@db:5432/cerritos"
+    # Engine async (asyncpg) de los endpoints públicos. Vacío => se deriva de database_url.
+    async_database_url: str = ""
 
     # --- Marca / evento ---
     app_name: str = "Tienda Pintuco Cerritos"
     public_base_url: str = "https://cerritos.ferreinox.co"
+    # URL pública del backend (imágenes de QR alojadas). Vacío => public_base_url + "/api"
+    public_api_url: str = ""
     frontend_url: str = "https://cerritos.ferreinox.co"
     store_whatsapp: str = "573102806605"  # 310 280 66 05
     store_address: str = "Av. 30 de Agosto 105-42, Pereira"
@@ -24,6 +45,10 @@ class Settings(BaseSettings):
     prize_ttl_days: int = 30
     magic_link_ttl_hours: int = 72
     session_ttl_hours: int = 12
+    # Vigencia de las respuestas guardadas por Idempotency-Key (reintentos móviles)
+    idempotencia_ttl_horas: int = 24
+    # Token de un solo uso práctico para abrir el stream SSE (va en la URL, queda en logs)
+    sse_token_ttl_seconds: int = 60
 
     # --- Admin (bootstrap del primer usuario) ---
     admin_email: str = "admin@ferreinox.co"
@@ -41,10 +66,66 @@ class Settings(BaseSettings):
     smtp_port: int = 465
     smtp_user: str = ""
     smtp_password: str = ""
+    # Sesiones SMTP autenticadas que se mantienen abiertas y se reutilizan
+    smtp_sesiones: int = 2
+
+    # --- Email: circuit breaker por transporte ---
+    email_breaker_fallos: int = 5  # fallos seguidos para abrir el circuito
+    email_breaker_espera_seconds: int = 60  # abierto => se salta; luego una prueba
+    # Últimos intentos de envío que guarda la telemetría (GET /admin/email/telemetria)
+    email_telemetria_items: int = 500
+
+    # --- Email: outbox ---
+    email_concurrencia: int = 4  # envíos simultáneos del worker
+    email_max_intentos: int = 6  # después => "muerto" (dead-letter)
+    email_reintento_base_seconds: int = 30  # backoff: base * 2^(intento-1), tope 1 h
+    # Avisos a la tienda en resumen: uno cada N minutos o al juntar M (0 => uno por evento)
+    email_resumen_minutos: int = 0
+    email_resumen_max_eventos: int = 50
+    email_resumen_premio_inmediato: bool = True  # los premios ganados no esperan
+
+    # --- Ruleta ---
+    # Vigencia máxima de los segmentos en caché (el admin además la invalida al editar)
+    ruleta_cache_ttl_seconds: int = 30
+
+    # --- Dashboard admin ---
+    # Segundos que se reutilizan las métricas de GET /admin/metrics (por proceso)
+    tablero_cache_ttl_seconds: int = 5
+    # Filas por (canal, evento) en event_counters: reparte los UPDATE concurrentes
+    contadores_fragmentos: int = 8
+    # Sondeo del dashboard en vivo (SSE) mientras haya al menos uno conectado
+    tablero_sse_intervalo_seconds: float = 1.0
+
+    # --- QR ---
+    # Procesos para renderizar QR fuera del request y PNGs guardados en caché (LRU)
+    qr_workers: int = 2
+    qr_cache_items: int = 4096
+    # PNG de correos y /qr/*.png: "png1" (paleta 1 bit, compacto) | "png" (RGB)
+    qr_png_motor: Literal["png", "png1"] = "png1"
+    # Correos con el QR como imagen alojada (/qr/t/...) en vez de adjunto inline (cid:).
+    # Mensajes más livianos, pero algunos clientes bloquean imágenes remotas por defecto.
+    email_qr_alojado: bool = False
+
+    # --- Observabilidad ---
+    # GET /metrics exige "Authorization: Bearer <token>"; vacío => /metrics deshabilitado
+    metrics_token: str = ""
 
     # --- CORS ---
     cors_origins: str = "https://cerritos.ferreinox.co,http://localhost:3000"
 
+    @field_validator("database_url")
+    @classmethod
+    def _url_psycopg2(cls, v: str) -> str:
+        return _con_driver(v, "psycopg2")
+
+    @property
+    def database_url_async(self) -> str:
+        return _con_driver(self.async_database_url or self.database_url, "asyncpg")
+
+    @property
+    def api_base_url(self) -> str:
+        return (self.public_api_url or f"{self.public_base_url}/api").rstrip("/")
+
     @property
     def cors_list(self) -> list[str]:
         return [o.strip() for o in self.cors_origins.split(",") if o.strip()]
@@ -1,5 +1,18 @@
-"""Configuración de SQLAlchemy: engine, sesión y Base declarativa."""
-from sqlalchemy import create_engine
+"""Configuración de SQLAlchemy: engines (sync y async), sesiones y Base declarativa.
+
+Los endpoints públicos de alto tráfico (registro, giros, validación) usan el engine
+async (asyncpg) vía `get_async_db`; el panel admin sigue con el engine sync mientras
+dura la transición.
+
+`contar_consultas()` abre un contador de sentencias SQL y tiempo en la BD para la
+petición en curso (lo usa el middleware de `main.py` para `X-DB-Queries` y `/metrics`).
+"""
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from .config import settings
@@ -10,7 +23,53 @@ engine = create_engine(
     pool_recycle=1800,
 )
 
+async_engine = create_async_engine(
+    settings.database_url_async,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+
+class ConsultasPeticion:
+    """Sentencias SQL y segundos en la BD acumulados por una petición."""
+
+    __slots__ = ("n", "segundos")
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.segundos = 0.0
+
+
+# Objeto mutable por petición: los hilos del threadpool y los greenlets de run_sync
+# reciben una copia del contexto, pero apuntan al mismo objeto.
+_consultas: ContextVar[Optional[ConsultasPeticion]] = ContextVar("consultas", default=None)
+
+
+def contar_consultas() -> ConsultasPeticion:
+    """Empieza a contar las sentencias (y su tiempo) del contexto actual."""
+    contador = ConsultasPeticion()
+    _consultas.set(contador)
+    return contador
+
+
+def _antes(conn, cursor, statement, parameters, context, executemany):
+    conn.info["t0_consulta"] = time.perf_counter()
+
+
+def _despues(conn, cursor, statement, parameters, context, executemany):
+    t0 = conn.info.pop("t0_consulta", None)
+    contador = _consultas.get()
+    if contador is not None and t0 is not None:
+        contador.n += 1
+        contador.segundos += time.perf_counter() - t0
+
+
+for _engine in (engine, async_engine.sync_engine):
+    event.listen(_engine, "before_cursor_execute", _antes)
+    event.listen(_engine, "after_cursor_execute", _despues)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: tras el commit se siguen leyendo atributos sin I/O implícito.
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -21,3 +80,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """Igual que `get_db`, con una AsyncSession para handlers `async def`."""
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,17 +1,31 @@
 """Punto de entrada FastAPI. Crea tablas, siembra datos y monta routers."""
+import asyncio
+import hmac
 import logging
+import time
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Match
 
 from .config import settings
-from .database import Base, SessionLocal, engine
-from sqlalchemy import text
+from .database import Base, SessionLocal, async_engine, contar_consultas, engine, get_db
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
 
+from .models import Channel
 from .routers import admin, channels, leads, magic, ruleta, validar
 from .seed import run_seed
+from .services import contadores as contadores_svc
+from .services import email as email_svc
+from .services import en_vivo as en_vivo_svc
+from .services import idempotencia as idem_svc
+from .services import metricas
+from .services import outbox as outbox_svc
 from .services import qr as qr_svc
 
 # Migración ligera idempotente para bases ya existentes (columnas nuevas de canje)
@@ -28,6 +42,17 @@ _MIGRACIONES = [
     "ALTER TABLE spins ADD COLUMN IF NOT EXISTS telefono VARCHAR(40)",
     "ALTER TABLE spins ADD COLUMN IF NOT EXISTS factura VARCHAR(60)",
     "ALTER TABLE spins ALTER COLUMN lead_id DROP NOT NULL",
+    # Sorteo por mazo pre-barajado
+    "ALTER TABLE channels ADD COLUMN IF NOT EXISTS sorteo VARCHAR(20) DEFAULT 'ruleta'",
+    # Anti-duplicado de giros por canal forzado en BD
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_spins_canal_factura ON spins (channel_id, factura) "
+    "WHERE factura IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_spins_canal_telefono ON spins (channel_id, telefono) "
+    "WHERE channel_id IS NOT NULL AND telefono IS NOT NULL",
+    # Idempotencia: huella de la petición y vencimiento
+    "ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS huella VARCHAR(64)",
+    "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at)",
+    "ALTER TABLE idempotency_keys ALTER COLUMN ruta TYPE VARCHAR(80)",
 ]
 
 logging.basicConfig(level=logging.INFO)
@@ -39,20 +64,35 @@ async def lifespan(app: FastAPI):
     # Crea tablas (idempotente) y siembra admin + premios por defecto.
     Base.metadata.create_all(bind=engine)
     # Migración ligera para bases ya existentes
-    try:
-        with engine.begin() as conn:
-            for stmt in _MIGRACIONES:
+    # (cada sentencia en su transacción: un índice que no aplica no frena a las demás)
+    for stmt in _MIGRACIONES:
+        try:
+            with engine.begin() as conn:
                 conn.execute(text(stmt))
-    except Exception as e:  # noqa: BLE001
-        logger.error("Migración falló: %s", e)
+        except Exception as e:  # noqa: BLE001
+            logger.error("Migración falló: %s", e)
     db = SessionLocal()
     try:
         run_seed(db)
+        contadores_svc.inicializar(db)
     except Exception as e:  # noqa: BLE001
         logger.error("Seed falló: %s", e)
     finally:
         db.close()
+    # Worker del outbox de correos (uno por proceso; se reparten la cola con SKIP LOCKED)
+    worker_correos = asyncio.create_task(outbox_svc.trabajar())
+    purga_llaves = asyncio.create_task(idem_svc.trabajar())
     yield
+    await en_vivo_svc.cerrar()
+    for tarea in (worker_correos, purga_llaves):
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+    await run_in_threadpool(email_svc.cerrar)
+    qr_svc.cerrar_pool()
+    await async_engine.dispose()
 
 
 app = FastAPI(title=settings.app_name, lifespan=lifespan)
@@ -65,6 +105,46 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def _ruta(request: Request) -> str:
+    """Plantilla de la ruta (`/channels/{slug}/spin`), no la URL concreta."""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "sin_ruta"
+
+
+@app.middleware("http")
+async def observar_peticion(request: Request, call_next):
+    """Latencia, estado, peticiones en curso y consultas SQL por ruta (`/metrics`).
+
+    La cabecera `X-DB-Queries` devuelve las sentencias SQL que costó la petición.
+    """
+    ruta, metodo = _ruta(request), request.method
+    contador = contar_consultas()
+    metricas.http_en_curso.inc(metodo, ruta)
+    t0 = time.perf_counter()
+    estado = 500
+    try:
+        response = await call_next(request)
+        estado = response.status_code
+    finally:
+        metricas.http_en_curso.dec(metodo, ruta)
+        metricas.http_duracion.observar(time.perf_counter() - t0, metodo, ruta)
+        metricas.http_peticiones.inc(metodo, ruta, str(estado))
+        metricas.db_consultas.observar(contador.n, ruta)
+        metricas.db_duracion.observar(contador.segundos, ruta)
+    response.headers["X-DB-Queries"] = str(contador.n)
+    return response
+
+
+@app.exception_handler(idem_svc.LlaveReutilizada)
+async def llave_reutilizada(request: Request, exc: idem_svc.LlaveReutilizada):
+    return JSONResponse(status_code=422, content={
+        "detail": "Esta Idempotency-Key ya se usó con otra petición."})
+
+
 app.include_router(leads.router)
 app.include_router(magic.router)
 app.include_router(ruleta.router)
@@ -78,19 +158,79 @@ def health():
     return {"status": "ok", "app": settings.app_name}
 
 
+def _locks_en_espera() -> int:
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM pg_locks WHERE NOT granted")).scalar()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(authorization: Optional[str] = Header(default=None)):
+    """Métricas en formato Prometheus, solo con `Bearer <METRICS_TOKEN>`.
+
+    Sin METRICS_TOKEN el endpoint no existe (404): es caro (consulta pg_locks) y no debe
+    quedar abierto a cualquiera. La validación va antes de tocar la BD.
+    """
+    if not settings.metrics_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(authorization or "", f"Bearer {settings.metrics_token}"):
+        raise HTTPException(status_code=401, detail="No autorizado.")
+    metricas.db_pool_en_uso.fijar("sync", valor=engine.pool.checkedout())
+    metricas.db_pool_en_uso.fijar("async", valor=async_engine.pool.checkedout())
+    try:
+        metricas.db_locks_en_espera.fijar(valor=await run_in_threadpool(_locks_en_espera))
+    except Exception as e:  # noqa: BLE001
+        logger.warning("No se pudo leer pg_locks: %s", e)
+    return PlainTextResponse(metricas.exponer(), media_type="text/plain; version=0.0.4")
+
+
+def _qr_cacheable(request: Request, contenido: str, motor: Optional[str] = None,
+                  max_age: int = 3600) -> Response:
+    """QR con ETag fuerte; `If-None-Match` coincidente => 304 sin cuerpo."""
+    datos, etag = qr_svc.qr_etag(contenido, motor)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if_none_match = request.headers.get("if-none-match", "")
+    candidatos = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    if etag in candidatos or "*" in candidatos:
+        return Response(status_code=304, headers=headers)
+    media_type = qr_svc.MEDIA_TYPES[motor or settings.qr_png_motor]
+    return Response(content=datos, media_type=media_type, headers=headers)
+
+
 @app.get("/qr/registro.png")
-def qr_registro():
+def qr_registro(request: Request):
     """QR fijo hacia el formulario de registro (para compartir por colaboradores)."""
-    url = f"{settings.public_base_url}/registro"
-    png = qr_svc.qr_png_bytes(url)
-    return Response(content=png, media_type="image/png",
-                    headers={"Cache-Control": "public, max-age=3600"})
+    return _qr_cacheable(request, qr_svc.url_registro())
+
+
+@app.get("/qr/registro.svg")
+def qr_registro_svg(request: Request):
+    return _qr_cacheable(request, qr_svc.url_registro(), "svg")
+
+
+def _url_canal_existente(db: Session, slug: str) -> str:
+    """URL del canal solo si existe: un slug inventado no se renderiza ni entra a la caché
+    LRU, donde desplazaría los QR de cupones y premios."""
+    if db.scalar(select(Channel.id).where(Channel.slug == slug)) is None:
+        raise HTTPException(status_code=404, detail="Canal no encontrado.")
+    return qr_svc.url_canal(slug)
 
 
 @app.get("/qr/c/{slug}.png")
-def qr_canal(slug: str):
+def qr_canal(slug: str, request: Request, db: Session = Depends(get_db)):
     """QR de un canal (sede/vendedor) hacia su ruleta."""
-    url = f"{settings.public_base_url}/girar/{slug}"
-    png = qr_svc.qr_png_bytes(url)
-    return Response(content=png, media_type="image/png",
-                    headers={"Cache-Control": "public, max-age=3600"})
+    return _qr_cacheable(request, _url_canal_existente(db, slug))
+
+
+@app.get("/qr/c/{slug}.svg")
+def qr_canal_svg(slug: str, request: Request, db: Session = Depends(get_db)):
+    return _qr_cacheable(request, _url_canal_existente(db, slug), "svg")
+
+
+@app.get("/qr/t/{firmado}.png")
+def qr_alojado(firmado: str, request: Request):
+    """QR de un cupón/premio para los correos con imagen alojada (EMAIL_QR_ALOJADO)."""
+    token = qr_svc.token_alojado(firmado)
+    if not token:
+        raise HTTPException(status_code=404, detail="QR no encontrado.")
+    # El contenido de un token no cambia: caché larga en clientes y proxies de correo
+    return _qr_cacheable(request, qr_svc.url_validar(token), max_age=30 * 86400)
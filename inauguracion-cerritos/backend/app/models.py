@@ -3,14 +3,18 @@ import uuid
 from datetime import datetime
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
+    Sequence,
     String,
     Text,
+    text,
 )
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
@@ -22,6 +26,10 @@ def _uuid() -> str:
     return str(uuid.uuid4())
 
 
+# Consecutivo de participantes: alimenta los códigos de cupón/referido (utils.codigo_*)
+lead_codigo_seq = Sequence("leads_codigo_seq", metadata=Base.metadata)
+
+
 class Lead(Base):
     __tablename__ = "leads"
 
@@ -81,6 +89,8 @@ class Channel(Base):
     nombre = Column(String(120), nullable=False)
     slug = Column(String(60), unique=True, nullable=False, index=True)
     modo = Column(String(20), nullable=False)  # 'factura' | 'vendedor'
+    # 'ruleta' = sorteo ponderado en cada giro | 'mazo' = resultados pre-barajados
+    sorteo = Column(String(20), default="ruleta", nullable=False)
     activo = Column(Boolean, default=True, nullable=False)
     orden = Column(Integer, default=0, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -88,6 +98,13 @@ class Channel(Base):
 
 class Spin(Base):
     __tablename__ = "spins"
+    __table_args__ = (
+        # Anti-duplicado en BD de los giros por canal (el giro inserta con ON CONFLICT)
+        Index("uq_spins_canal_factura", "channel_id", "factura", unique=True,
+              postgresql_where=text("factura IS NOT NULL")),
+        Index("uq_spins_canal_telefono", "channel_id", "telefono", unique=True,
+              postgresql_where=text("channel_id IS NOT NULL AND telefono IS NOT NULL")),
+    )
 
     id = Column(UUID(as_uuid=False), primary_key=True, default=_uuid)
     lead_id = Column(UUID(as_uuid=False), ForeignKey("leads.id"), nullable=True)
@@ -117,6 +134,40 @@ class Spin(Base):
     channel = relationship("Channel")
 
 
+class Deck(Base):
+    """Mazo pre-barajado de resultados de un canal (sorteo 'mazo').
+
+    `seed_hash` se publica al crearlo (compromiso); `seed` se revela al cerrarlo para
+    que cualquiera pueda rehacer el barajado y auditar los resultados.
+    """
+    __tablename__ = "decks"
+
+    id = Column(UUID(as_uuid=False), primary_key=True, default=_uuid)
+    channel_id = Column(UUID(as_uuid=False), ForeignKey("channels.id"), nullable=False, index=True)
+    seed = Column(String(64), nullable=False)
+    seed_hash = Column(String(64), nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    activo = Column(Boolean, default=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    cerrado_at = Column(DateTime, nullable=True)
+
+
+class DeckTicket(Base):
+    """Un resultado del mazo. Se reclama al girar (spin_id deja de ser NULL)."""
+    __tablename__ = "deck_tickets"
+    __table_args__ = (
+        Index("ix_deck_tickets_pendientes", "deck_id", "posicion",
+              postgresql_where=text("spin_id IS NULL")),
+    )
+
+    id = Column(UUID(as_uuid=False), primary_key=True, default=_uuid)
+    deck_id = Column(UUID(as_uuid=False), ForeignKey("decks.id"), nullable=False, index=True)
+    posicion = Column(Integer, nullable=False)
+    prize_id = Column(UUID(as_uuid=False), ForeignKey("prizes.id"), nullable=False)
+    spin_id = Column(UUID(as_uuid=False), ForeignKey("spins.id"), nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+
+
 class MagicLink(Base):
     __tablename__ = "magic_links"
 
@@ -130,6 +181,58 @@ class MagicLink(Base):
     lead = relationship("Lead", back_populates="magic_links")
 
 
+class IdempotencyKey(Base):
+    """Respuesta ya entregada a una petición con `Idempotency-Key` (reintentos móviles)."""
+    __tablename__ = "idempotency_keys"
+
+    ruta = Column(String(80), primary_key=True)  # "channels/{slug}": slug de hasta 60
+    key = Column(String(80), primary_key=True)
+    respuesta = Column(Text, nullable=False)  # JSON del response_model
+    huella = Column(String(64), nullable=True)  # sha256 de la petición (ver idempotencia.huella)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class EmailOutbox(Base):
+    """Correo pendiente de envío, escrito en la misma transacción que el registro/giro.
+
+    El worker de `services.outbox` lo reclama (SKIP LOCKED), lo envía y lo marca
+    `enviado`; si falla reintenta con backoff y tras N intentos queda `muerto`.
+    """
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        Index("ix_email_outbox_pendientes", "proximo_intento",
+              postgresql_where=text("estado = 'pendiente'")),
+    )
+
+    id = Column(UUID(as_uuid=False), primary_key=True, default=_uuid)
+    tipo = Column(String(30), nullable=False)  # cupon | premio | notif_registro | notif_premio
+    destinatario = Column(String(160), nullable=False)
+    datos = Column(Text, nullable=False)  # JSON con lo necesario para armar el correo
+    qr_contenido = Column(String(255), nullable=True)  # URL del QR a adjuntar
+    # pendiente | enviado | muerto | omitido (sin transporte configurado)
+    estado = Column(String(20), default="pendiente", nullable=False, index=True)
+    intentos = Column(Integer, default=0, nullable=False)
+    proximo_intento = Column(DateTime, default=datetime.utcnow, nullable=False)
+    ultimo_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    enviado_at = Column(DateTime, nullable=True)
+
+
+class EventCounter(Base):
+    """Contadores del dashboard/reporte, sumados en la misma transacción del evento.
+
+    Cada (canal, evento) se reparte en varios `fragmento` elegidos al azar para que los
+    giros simultáneos no se peleen la misma fila; el total es la suma de los fragmentos.
+    `canal` = "" para la inauguración (registro completo).
+    """
+    __tablename__ = "event_counters"
+
+    canal = Column(String(36), primary_key=True)
+    evento = Column(String(30), primary_key=True)
+    fragmento = Column(Integer, primary_key=True)
+    valor = Column(BigInteger, default=0, nullable=False)
+
+
 class AdminUser(Base):
     __tablename__ = "admin_users"
 
@@ -1,21 +1,23 @@
 """Panel de administración: auth, métricas, CRUD de premios, redención de QR y export."""
+import asyncio
 import csv
 import io
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from ..config import settings
-from ..database import get_db
-from ..models import AdminUser, Channel, Lead, Prize, Spin
+from ..database import get_async_db, get_db
+from ..models import AdminUser, Channel, Deck, DeckTicket, Lead, Prize
 from ..schemas import (
     AdminLogin,
     ChannelCreate,
     ChannelResponse,
     ChannelUpdate,
+    DeckResponse,
     Metrics,
     PrizeCreate,
     PrizeResponse,
@@ -24,21 +26,38 @@ from ..schemas import (
     RedeemResponse,
     TokenResponse,
 )
-from ..security import create_session_token, get_current_admin, verify_password
+from ..security import (
+    create_session_token,
+    create_stream_token,
+    get_current_admin,
+    get_current_admin_query,
+    verify_password,
+)
+from ..services import contadores as contadores_svc
+from ..services import email as email_svc
+from ..services import en_vivo as en_vivo_svc
+from ..services import kit_qr as kit_qr_svc
+from ..services import mazo as mazo_svc
+from ..services import outbox as outbox_svc
+from ..services import qr as qr_svc
 from ..services import redeem as redeem_svc
 from ..services import report as report_svc
+from ..services import ruleta as ruleta_svc
+from ..services import tablero as tablero_svc
 from ..utils import slugify
 
 
 def _channel_out(ch: Channel) -> ChannelResponse:
     return ChannelResponse(
         id=ch.id, tipo=ch.tipo, nombre=ch.nombre, slug=ch.slug, modo=ch.modo,
-        activo=ch.activo, orden=ch.orden,
-        qr_url=f"{settings.public_base_url}/girar/{ch.slug}",
+        sorteo=ch.sorteo, activo=ch.activo, orden=ch.orden,
+        qr_url=qr_svc.url_canal(ch.slug),
     )
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
+_LATIDO_SSE = 15  # segundos sin eventos antes de mandar un comentario
+
 
 # ---------------- Auth ----------------
 @router.post("/login", response_model=TokenResponse)
@@ -51,23 +70,43 @@ def login(data: AdminLogin, db: Session = Depends(get_db)):
 
 # ---------------- Métricas ----------------
 @router.get("/metrics", response_model=Metrics)
-def metrics(db: Session = Depends(get_db), _=Depends(get_current_admin)):
-    total_part = db.query(func.count(Lead.id)).scalar() or 0
-    total_giros = db.query(func.count(Spin.id)).scalar() or 0
-    ganados = db.query(func.count(Spin.id)).filter(Spin.gano.is_(True)).scalar() or 0
-    entregados = db.query(func.count(Spin.id)).filter(Spin.redeemed.is_(True)).scalar() or 0
-    disponibles = db.query(func.coalesce(func.sum(Prize.stock_restante), 0)).filter(
-        Prize.activo.is_(True), Prize.es_perdedor.is_(False)
-    ).scalar() or 0
-    conv = round((total_giros / total_part * 100), 1) if total_part else 0.0
-    return Metrics(
-        total_participantes=total_part,
-        total_giros=total_giros,
-        premios_ganados=ganados,
-        premios_entregados=entregados,
-        premios_disponibles=int(disponibles),
-        tasa_conversion=conv,
-    )
+def metrics(request: Request, db: Session = Depends(get_db), _=Depends(get_current_admin)):
+    """Métricas del dashboard; con `If-None-Match` igual al ETag responde 304."""
+    datos, etag = tablero_svc.resumen(db)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in {t.strip().removeprefix("W/") for t in if_none_match.split(",")}:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(Metrics(**datos).model_dump(), headers=headers)
+
+
+@router.post("/stream/token", response_model=TokenResponse)
+def token_stream(admin=Depends(get_current_admin)):
+    """Token de ~1 minuto para abrir `/admin/stream` (EventSource lo manda en la URL)."""
+    return TokenResponse(access_token=create_stream_token(admin["sub"]))
+
+
+@router.get("/stream")
+async def stream(request: Request, _=Depends(get_current_admin_query)):
+    """Dashboard en vivo (server-sent events): métricas, stock y premios al momento."""
+    cola = en_vivo_svc.suscribir()
+
+    async def eventos():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=_LATIDO_SSE)
+                except asyncio.TimeoutError:
+                    yield ": latido\n\n"  # mantiene viva la conexión en proxies
+                    continue
+                if evento is None:
+                    break
+                yield evento
+        finally:
+            en_vivo_svc.desuscribir(cola)
+
+    return StreamingResponse(eventos(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # ---------------- CRUD canales (sedes / vendedores) ----------------
@@ -77,6 +116,26 @@ def listar_canales(db: Session = Depends(get_db), _=Depends(get_current_admin)):
     return [_channel_out(c) for c in chs]
 
 
+@router.get("/channels/qr-kit")
+async def kit_qr_canales(
+    formato: str = Query(default="pdf", pattern="^(zip|pdf)$"),
+    db: AsyncSession = Depends(get_async_db),
+    _=Depends(get_current_admin),
+):
+    """QR de todos los canales activos para imprimir: PDF (una página por canal) o ZIP."""
+    filas = (await db.execute(
+        select(Channel.id, Channel.slug, Channel.nombre, Channel.tipo, Channel.orden)
+        .where(Channel.activo.is_(True))
+        .order_by(Channel.tipo.asc(), Channel.orden.asc(), Channel.nombre.asc())
+    )).all()
+    if not filas:
+        raise HTTPException(status_code=404, detail="No hay canales activos.")
+    kit = await kit_qr_svc.generar([tuple(f) for f in filas], formato)
+    media = "application/pdf" if formato == "pdf" else "application/zip"
+    return Response(content=kit, media_type=media, headers={
+        "Content-Disposition": f'attachment; filename="QR_Canales_Cerritos.{formato}"'})
+
+
 @router.post("/channels", response_model=ChannelResponse, status_code=201)
 def crear_canal(data: ChannelCreate, db: Session = Depends(get_db), _=Depends(get_current_admin)):
     base = slugify(data.slug or data.nombre)
@@ -86,10 +145,11 @@ def crear_canal(data: ChannelCreate, db: Session = Depends(get_db), _=Depends(ge
         slug = f"{base}-{i}"
         i += 1
     ch = Channel(tipo=data.tipo, nombre=data.nombre, slug=slug, modo=data.modo,
-                 activo=data.activo, orden=data.orden)
+                 sorteo=data.sorteo, activo=data.activo, orden=data.orden)
     db.add(ch)
     db.commit()
     db.refresh(ch)
+    ruleta_svc.invalidar_cache(ch.id)
     return _channel_out(ch)
 
 
@@ -100,10 +160,21 @@ def actualizar_canal(
     ch = db.query(Channel).filter(Channel.id == channel_id).first()
     if not ch:
         raise HTTPException(status_code=404, detail="Canal no encontrado.")
+    slug_anterior = ch.slug
+    sorteo_anterior = ch.sorteo
     for k, v in data.model_dump(exclude_unset=True).items():
         setattr(ch, k, v)
+    if sorteo_anterior == "mazo" and ch.sorteo != "mazo":
+        # Las cartas ganadas no descuentan stock: se cierra el mazo (y se sincroniza el
+        # stock) en la misma transacción, o la ruleta volvería a repartir lo ya entregado.
+        deck = mazo_svc.mazo_activo(db, ch.id)
+        if deck:
+            mazo_svc.cerrar(db, deck)
     db.commit()
     db.refresh(ch)
+    ruleta_svc.invalidar_cache(ch.id)
+    if ch.slug != slug_anterior:
+        qr_svc.olvidar(qr_svc.url_canal(slug_anterior))
     return _channel_out(ch)
 
 
@@ -112,9 +183,51 @@ def eliminar_canal(channel_id: str, db: Session = Depends(get_db), _=Depends(get
     ch = db.query(Channel).filter(Channel.id == channel_id).first()
     if not ch:
         raise HTTPException(status_code=404, detail="Canal no encontrado.")
+    decks = db.query(Deck.id).filter(Deck.channel_id == channel_id)
+    db.query(DeckTicket).filter(DeckTicket.deck_id.in_(decks.scalar_subquery())).delete(
+        synchronize_session=False)
+    db.query(Deck).filter(Deck.channel_id == channel_id).delete()
     db.query(Prize).filter(Prize.channel_id == channel_id).delete()
+    slug = ch.slug
     db.delete(ch)
     db.commit()
+    ruleta_svc.invalidar_cache(channel_id)
+    qr_svc.olvidar(qr_svc.url_canal(slug))
+
+
+# ---------------- Mazo pre-barajado por canal ----------------
+def _deck_out(db: Session, deck: Deck) -> DeckResponse:
+    return DeckResponse(
+        id=deck.id, seed_hash=deck.seed_hash, total=deck.total, activo=deck.activo,
+        creado=deck.created_at, cerrado=deck.cerrado_at,
+        seed=None if deck.activo else deck.seed,
+        pendientes=sum(mazo_svc.pendientes_por_premio(db, deck).values()),
+    )
+
+
+@router.post("/channels/{channel_id}/mazo", response_model=DeckResponse, status_code=201)
+def armar_mazo(channel_id: str, db: Session = Depends(get_db), _=Depends(get_current_admin)):
+    """Arma (o rearma) el mazo del canal con su stock y probabilidades actuales."""
+    ch = db.query(Channel).filter(Channel.id == channel_id).first()
+    if not ch:
+        raise HTTPException(status_code=404, detail="Canal no encontrado.")
+    if ch.sorteo != "mazo":
+        raise HTTPException(status_code=409, detail="El canal no está en modo mazo.")
+    try:
+        deck = mazo_svc.construir(db, ch.id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    db.commit()
+    db.refresh(deck)
+    return _deck_out(db, deck)
+
+
+@router.get("/channels/{channel_id}/mazo", response_model=DeckResponse)
+def estado_mazo(channel_id: str, db: Session = Depends(get_db), _=Depends(get_current_admin)):
+    deck = mazo_svc.ultimo_mazo(db, channel_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="El canal no tiene mazo.")
+    return _deck_out(db, deck)
 
 
 # ---------------- CRUD premios ----------------
@@ -124,11 +237,24 @@ def listar_premios(
 ):
     """Premios de un canal. Sin channel_id => premios de la inauguración (channel_id NULL)."""
     q = db.query(Prize)
+    stock_mazo: dict = {}
     if channel_id:
+        # En modo mazo el stock vivo es el del mazo: se muestra, no se escribe (el GET
+        # no compite por los locks de los giros; se persiste al cerrar el mazo)
+        deck = mazo_svc.mazo_activo(db, channel_id)
+        if deck:
+            stock_mazo = mazo_svc.stock_del_mazo(db, deck)
         q = q.filter(Prize.channel_id == channel_id)
     else:
         q = q.filter(Prize.channel_id.is_(None))
-    return q.order_by(Prize.orden.asc(), Prize.created_at.asc()).all()
+    premios = q.order_by(Prize.orden.asc(), Prize.created_at.asc()).all()
+    if not stock_mazo:
+        return premios
+    return [
+        PrizeResponse.model_validate(p).model_copy(
+            update={"stock_restante": stock_mazo.get(p.id, p.stock_restante)})
+        for p in premios
+    ]
 
 
 @router.post("/prizes", response_model=PrizeResponse, status_code=201)
@@ -137,6 +263,7 @@ def crear_premio(data: PrizeCreate, db: Session = Depends(get_db), _=Depends(get
     db.add(premio)
     db.commit()
     db.refresh(premio)
+    ruleta_svc.invalidar_cache(premio.channel_id)
     return premio
 
 
@@ -156,6 +283,7 @@ def actualizar_premio(
         setattr(premio, k, v)
     db.commit()
     db.refresh(premio)
+    ruleta_svc.invalidar_cache(premio.channel_id)
     return premio
 
 
@@ -164,8 +292,15 @@ def eliminar_premio(prize_id: str, db: Session = Depends(get_db), _=Depends(get_
     premio = db.query(Prize).filter(Prize.id == prize_id).first()
     if not premio:
         raise HTTPException(status_code=404, detail="Premio no encontrado.")
+    # Las cartas de los mazos (activos o cerrados) son la auditoría del sorteo
+    if db.query(DeckTicket.id).filter(DeckTicket.prize_id == prize_id).first():
+        raise HTTPException(
+            status_code=409,
+            detail="El premio está en un mazo del canal: desactívalo en lugar de borrarlo.")
+    channel_id = premio.channel_id
     db.delete(premio)
     db.commit()
+    ruleta_svc.invalidar_cache(channel_id)
 
 
 # ---------------- Redención de QR (escáner) ----------------
@@ -174,6 +309,9 @@ def redimir(data: RedeemRequest, db: Session = Depends(get_db), admin=Depends(ge
     """Canjea (marca como usado) un QR de cupón o premio. Un solo uso."""
     token = redeem_svc.extraer_token(data.token)
     r = redeem_svc.canjear(db, token, admin.get("email"))
+    if r["valido"] and not r["ya_redimido"]:
+        tablero_svc.invalidar()
+        en_vivo_svc.avisar()
     return RedeemResponse(
         valido=r["valido"], ya_redimido=r["ya_redimido"], tipo=r["tipo"],
         mensaje=r["mensaje"], premio=r["premio"], cliente=r["cliente"],
@@ -181,6 +319,47 @@ def redimir(data: RedeemRequest, db: Session = Depends(get_db), admin=Depends(ge
     )
 
 
+# ---------------- Contadores del dashboard ----------------
+@router.post("/contadores/reconciliar")
+def reconciliar_contadores(
+    revisar: bool = Query(False, description="Solo reportar diferencias, sin corregir"),
+    db: Session = Depends(get_db),
+    _=Depends(get_current_admin),
+):
+    """Reconstruye `event_counters` desde leads/spins y devuelve lo que no cuadraba."""
+    diferencias = contadores_svc.reconciliar(db, corregir=not revisar)
+    if diferencias and not revisar:
+        tablero_svc.invalidar()
+    return {"diferencias": diferencias}
+
+
+# ---------------- Outbox de correos ----------------
+@router.get("/email/outbox")
+async def estado_outbox(db: AsyncSession = Depends(get_async_db), _=Depends(get_current_admin)):
+    """Correos por estado, el pendiente más viejo y la latencia de envío de la última hora."""
+    return await outbox_svc.estado(db)
+
+
+@router.post("/email/outbox/reintentar")
+async def reintentar_outbox(
+    db: AsyncSession = Depends(get_async_db), _=Depends(get_current_admin)
+):
+    """Devuelve a la cola los correos que agotaron sus intentos."""
+    return {"reintentados": await outbox_svc.reintentar_muertos(db)}
+
+
+@router.get("/email/transportes")
+def estado_transportes(_=Depends(get_current_admin)):
+    """SendGrid/SMTP: si están configurados y el estado de su circuit breaker."""
+    return email_svc.estado_transportes()
+
+
+@router.get("/email/telemetria")
+def telemetria_correo(limite: int = Query(50, ge=0, le=500), _=Depends(get_current_admin)):
+    """Intentos de envío recientes y resumen por transporte/plantilla (latencia, bytes)."""
+    return email_svc.telemetria(limite)
+
+
 # ---------------- Export leads CSV ----------------
 @router.get("/leads.csv")
 def export_leads(db: Session = Depends(get_db), _=Depends(get_current_admin)):
@@ -203,9 +382,12 @@ def export_leads(db: Session = Depends(get_db), _=Depends(get_current_admin)):
 # ---------------- Reporte ejecutivo Excel ----------------
 @router.get("/reporte.xlsx")
 def export_reporte(db: Session = Depends(get_db), _=Depends(get_current_admin)):
-    data = report_svc.generar_reporte(db)
+    archivo = report_svc.generar_reporte(db)
+    tamano = archivo.seek(0, io.SEEK_END)
+    archivo.seek(0)
     return StreamingResponse(
-        iter([data]),
+        report_svc.en_trozos(archivo),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=Reporte_Cerritos.xlsx"},
+        headers={"Content-Disposition": "attachment; filename=Reporte_Cerritos.xlsx",
+                 "Content-Length": str(tamano)},
     )
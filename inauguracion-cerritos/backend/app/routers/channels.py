@@ -3,22 +3,36 @@
 - Sede (modo 'factura'): el cliente pone el número de factura y gira. 1 factura = 1 giro.
 - Vendedor (modo 'vendedor'): el cliente pone nombre + teléfono y gira. 1 teléfono = 1 giro.
 El resultado se decide en el backend. La entrega es inmediata (queda registrada).
+Canales con sorteo 'mazo' toman el resultado de su mazo pre-barajado (services/mazo).
 """
+import asyncio
+import uuid
 from datetime import datetime
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from ..database import get_db
-from ..models import Channel, Prize, Spin
-from ..schemas import ChannelPublic, ChannelSpinRequest, SpinResult, WheelSegment
+from ..database import get_async_db, get_db
+from ..models import Channel, Spin
+from ..schemas import ChannelPublic, ChannelSpinRequest, DeckPublic, SpinResult, WheelSegment
+from ..services import contadores as contadores_svc
+from ..services import en_vivo as en_vivo_svc
+from ..services import idempotencia as idem_svc
+from ..services import mazo as mazo_svc
 from ..services import ruleta as ruleta_svc
 
 router = APIRouter(prefix="/channels", tags=["channels"])
 
 
-def _get_channel(slug: str, db: Session) -> Channel:
-    ch = db.query(Channel).filter(Channel.slug == slug).first()
+# Reintentos cuando todas las cartas libres del mazo están tomadas por giros en curso
+_REINTENTOS_MAZO = 5
+
+
+def _validar_canal(ch: Channel | None) -> Channel:
     if not ch:
         raise HTTPException(status_code=404, detail="Canal no encontrado.")
     if not ch.activo:
@@ -26,6 +40,10 @@ def _get_channel(slug: str, db: Session) -> Channel:
     return ch
 
 
+def _get_channel(slug: str, db: Session) -> Channel:
+    return _validar_canal(db.query(Channel).filter(Channel.slug == slug).first())
+
+
 @router.get("/{slug}", response_model=ChannelPublic)
 def info_canal(slug: str, db: Session = Depends(get_db)):
     ch = _get_channel(slug, db)
@@ -42,71 +60,133 @@ def ruleta_canal(slug: str, db: Session = Depends(get_db)):
     ]
 
 
-@router.post("/{slug}/spin", response_model=SpinResult)
-def girar_canal(slug: str, data: ChannelSpinRequest, db: Session = Depends(get_db)):
+@router.get("/{slug}/mazo", response_model=DeckPublic)
+def mazo_canal(slug: str, db: Session = Depends(get_db)):
+    """Compromiso público del último mazo del canal; el seed solo se ve ya cerrado."""
     ch = _get_channel(slug, db)
+    deck = mazo_svc.ultimo_mazo(db, ch.id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Este punto no usa mazo.")
+    return DeckPublic(
+        seed_hash=deck.seed_hash, total=deck.total, activo=deck.activo,
+        creado=deck.created_at, cerrado=deck.cerrado_at,
+        seed=None if deck.activo else deck.seed,
+    )
 
-    # Validación de datos + anti-duplicado según el modo
+
+@router.post("/{slug}/spin", response_model=SpinResult)
+async def girar_canal(
+    slug: str,
+    data: ChannelSpinRequest,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(default=None, max_length=80),
+):
+    ruta = f"channels/{slug}"
+    firma = idem_svc.huella(data)
+    previa = await idem_svc.buscar(db, ruta, idempotency_key, firma, SpinResult)
+    if previa:
+        return previa
+
+    ch = _validar_canal(await db.scalar(select(Channel).where(Channel.slug == slug)))
+
+    # Validación de datos según el modo (el anti-duplicado lo garantiza el índice único)
     factura = (data.factura or "").strip()
     nombre = (data.nombre or "").strip()
     telefono = (data.telefono or "").strip()
 
+    # Solo se guarda la llave del modo: los índices únicos de factura y teléfono aplican a
+    # todo giro de canal, y la del otro modo bloquearía giros legítimos
     if ch.modo == "factura":
         if not factura:
             raise HTTPException(status_code=422, detail="Ingresa el número de factura.")
-        dup = db.query(Spin).filter(
-            Spin.channel_id == ch.id, Spin.factura == factura
-        ).first()
-        if dup:
-            raise HTTPException(status_code=409, detail="Esta factura ya giró la ruleta.")
+        telefono = ""
+        dup_msg = "Esta factura ya giró la ruleta."
     else:  # vendedor
         if not (nombre and telefono):
             raise HTTPException(status_code=422, detail="Ingresa nombre y teléfono.")
-        dup = db.query(Spin).filter(
-            Spin.channel_id == ch.id, Spin.telefono == telefono
-        ).first()
-        if dup:
-            raise HTTPException(status_code=409, detail="Este teléfono ya giró con este vendedor.")
-
-    # Decisión segura en el servidor (premios del canal)
-    premio, seed, indice, segmentos = ruleta_svc.elegir_premio(db, ch.id)
+        factura = ""
+        dup_msg = "Este teléfono ya giró con este vendedor."
+
+    # Decisión segura en el servidor: carta del mazo o sorteo ponderado del canal
+    deck = await db.run_sync(mazo_svc.mazo_activo, ch.id) if ch.sorteo == "mazo" else None
+    ticket = None
+    if deck:
+        for intento in range(_REINTENTOS_MAZO):
+            try:
+                ticket = await db.run_sync(mazo_svc.reclamar, deck)
+                break
+            except mazo_svc.MazoOcupado:
+                if intento == _REINTENTOS_MAZO - 1:
+                    raise HTTPException(status_code=503,
+                                        detail="Hay muchos giros en curso, intenta de nuevo.")
+                await asyncio.sleep(0.05)
+        if ticket is None:
+            await db.run_sync(mazo_svc.cerrar, deck)  # mazo agotado -> sorteo normal
+    if ticket:
+        premio, seed, indice, segmentos = await db.run_sync(mazo_svc.resultado, deck, ticket)
+    else:
+        premio, seed, indice, segmentos = await db.run_sync(ruleta_svc.elegir_premio, ch.id)
     if not segmentos:
         raise HTTPException(status_code=503, detail="Este punto aún no tiene premios configurados.")
 
     gano = premio is not None and not premio.es_perdedor
-    spin = Spin(
-        channel_id=ch.id, server_seed=seed, gano=gano,
-        nombre=nombre or None, telefono=telefono or None, factura=factura or None,
+    spin_id = str(uuid.uuid4())
+    ahora = datetime.utcnow()
+    # Entrega inmediata (cara a cara): si gana queda registrado como entregado.
+    insertado = await db.scalar(
+        insert(Spin).values(
+            id=spin_id, channel_id=ch.id, server_seed=seed, gano=gano,
+            prize_id=premio.id if gano else None,
+            nombre=nombre or None, telefono=telefono or None, factura=factura or None,
+            redeemed=gano, redeemed_at=ahora if gano else None,
+            redeemed_by=ch.nombre if gano else None,
+        )
+        .on_conflict_do_nothing()
+        .returning(Spin.id)
     )
-
-    if gano:
-        locked = db.query(Prize).filter(Prize.id == premio.id).with_for_update().first()
-        if locked.stock_restante <= 0:
+    if not insertado:
+        await db.rollback()  # libera también la carta del mazo, si se tomó
+        # Doble toque: el reintento con la misma llave esperó en el índice a la primera
+        # petición, que ya dejó guardada su respuesta
+        previa = await idem_svc.buscar(db, ruta, idempotency_key, firma, SpinResult)
+        if previa:
+            return previa
+        raise HTTPException(status_code=409, detail=dup_msg)
+
+    if gano and not ticket:  # con mazo, la carta ya es el stock
+        if not await db.run_sync(ruleta_svc.descontar_stock, ch.id, premio.id):
             gano = False
             premio = None
-        else:
-            locked.stock_restante -= 1
-            spin.prize_id = locked.id
-    spin.gano = gano
-
-    # Entrega inmediata (cara a cara): queda registrado como entregado.
-    if gano:
-        spin.redeemed = True
-        spin.redeemed_at = datetime.utcnow()
-        spin.redeemed_by = ch.nombre
-    db.add(spin)
-    db.commit()
+            await db.execute(
+                update(Spin).where(Spin.id == spin_id).values(
+                    gano=False, prize_id=None, redeemed=False, redeemed_at=None,
+                    redeemed_by=None)
+            )
+    if ticket:
+        ticket.spin_id = spin_id
+        ticket.claimed_at = ahora
+
+    ganado = int(gano and premio is not None)  # entrega inmediata: ganado = entregado
+    await db.execute(contadores_svc.sumar(
+        ch.id, giros=1, premios_ganados=ganado, premios_entregados=ganado))
 
     if gano and premio is not None:
-        return SpinResult(
+        resp = SpinResult(
             gano=True, prize_id=premio.id, prize_nombre=premio.nombre,
             segment_index=indice,
             mensaje=f"¡Ganaste: {premio.nombre}! Reclámalo aquí mismo. 🎁",
         )
-    idx = indice if premio is not None else (
-        next((i for i, p in enumerate(segmentos) if p.es_perdedor), 0)
-    )
-    return SpinResult(
-        gano=False, prize_id=None, prize_nombre=None, segment_index=idx,
-        mensaje="¡Gracias por participar! 🎉",
-    )
+    else:
+        idx = indice if premio is not None else (
+            next((i for i, p in enumerate(segmentos) if p.es_perdedor), 0)
+        )
+        resp = SpinResult(
+            gano=False, prize_id=None, prize_nombre=None, segment_index=idx,
+            mensaje="¡Gracias por participar! 🎉",
+        )
+    if not await idem_svc.guardar(db, ruta, idempotency_key, firma, resp):
+        await db.rollback()
+        return await idem_svc.buscar(db, ruta, idempotency_key, firma, SpinResult)
+    await db.commit()
+    en_vivo_svc.avisar()
+    return resp
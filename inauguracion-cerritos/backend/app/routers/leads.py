@@ -1,20 +1,31 @@
 """Registro de participantes (público)."""
+import uuid
 from datetime import datetime, timedelta
+from typing import Optional
 from urllib.parse import quote
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy import null, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..config import settings
-from ..database import get_db
-from ..models import Lead, MagicLink
+from ..database import get_async_db
+from ..models import Lead, MagicLink, lead_codigo_seq
 from ..schemas import LeadCreate, LeadResponse
-from ..services import email as email_svc
+from ..services import contadores as contadores_svc
+from ..services import en_vivo as en_vivo_svc
+from ..services import idempotencia as idem_svc
+from ..services import outbox as outbox_svc
 from ..services import qr as qr_svc
 from ..utils import codigo_cupon, codigo_referido, token_corto, token_url
 
 router = APIRouter(prefix="/leads", tags=["leads"])
 
+_RUTA = "leads"
+# Reintentos de código solo ante choques con códigos aleatorios de antes del consecutivo
+_INTENTOS_CODIGO = 5
+
 
 def _whatsapp_url(nombre: str, magic_token: str) -> str:
     """Enlace wa.me para que el usuario se auto-envíe su Magic Link a la ruleta."""
@@ -27,31 +38,27 @@ def _whatsapp_url(nombre: str, magic_token: str) -> str:
 
 
 @router.post("", response_model=LeadResponse)
-def registrar_lead(
+async def registrar_lead(
     data: LeadCreate,
-    background: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(default=None, max_length=80),
 ):
-    # Anti-duplicado por cédula
-    if db.query(Lead).filter(Lead.cedula == data.cedula).first():
-        raise HTTPException(status_code=409, detail="Esta cédula ya está registrada.")
-
-    # Referido (opcional)
-    referred_by = None
-    if data.referral_code:
-        ref = db.query(Lead).filter(Lead.referral_code == data.referral_code).first()
-        if ref:
-            referred_by = ref.id
+    # Reintento del mismo envío => misma respuesta
+    firma = idem_svc.huella(data)
+    previa = await idem_svc.buscar(db, _RUTA, idempotency_key, firma, LeadResponse)
+    if previa:
+        return previa
 
-    # Códigos únicos
-    coupon = codigo_cupon()
-    while db.query(Lead).filter(Lead.coupon_code == coupon).first():
-        coupon = codigo_cupon()
-    referral = codigo_referido()
-    while db.query(Lead).filter(Lead.referral_code == referral).first():
-        referral = codigo_referido()
+    # Consecutivo del participante (=> códigos únicos sin probar) + referido, en un viaje
+    n, referred_by = (await db.execute(select(
+        lead_codigo_seq.next_value(),
+        select(Lead.id).where(Lead.referral_code == data.referral_code).scalar_subquery()
+        if data.referral_code else null(),
+    ))).one()
 
-    lead = Lead(
+    lead_id = str(uuid.uuid4())
+    valores = dict(
+        id=lead_id,
         nombre=data.nombre.strip(),
         telefono=data.telefono.strip(),
         correo=str(data.correo).lower().strip(),
@@ -59,16 +66,37 @@ def registrar_lead(
         direccion=(data.direccion or "").strip() or None,
         consentimiento_datos=True,
         consentimiento_ts=datetime.utcnow(),
-        coupon_code=coupon,
-        coupon_token=token_corto(),
-        referral_code=referral,
         referred_by=referred_by,
     )
-    db.add(lead)
-    db.flush()  # obtiene lead.id
-
-    # Firma del cupón (JWT) para trazabilidad interna
-    lead.coupon_jwt = qr_svc.firmar_cupon(lead.id, coupon)
+    for _ in range(_INTENTOS_CODIGO):
+        coupon, referral = codigo_cupon(n), codigo_referido(n)
+        valores.update(
+            coupon_code=coupon,
+            # Firma del cupón (JWT) para trazabilidad interna
+            coupon_jwt=qr_svc.firmar_cupon(lead_id, coupon),
+            coupon_token=token_corto(),
+            referral_code=referral,
+        )
+        # Anti-duplicado (cédula y códigos) en la misma sentencia, sin SELECT previo ni carrera
+        insertado = await db.scalar(
+            insert(Lead).values(**valores).on_conflict_do_nothing().returning(Lead.id)
+        )
+        if insertado:
+            break
+        if await db.scalar(select(Lead.id).where(Lead.cedula == valores["cedula"])):
+            await db.rollback()
+            # Reintento concurrente con la misma llave: la primera petición ya respondió
+            previa = await idem_svc.buscar(db, _RUTA, idempotency_key, firma, LeadResponse)
+            if previa:
+                return previa
+            raise HTTPException(status_code=409, detail="Esta cédula ya está registrada.")
+        # Solo con participantes anteriores a los códigos por consecutivo (aleatorios):
+        # el código coincidió con uno de ellos, se toma el siguiente número.
+        n = await db.scalar(select(lead_codigo_seq.next_value()))
+    else:
+        await db.rollback()
+        raise HTTPException(status_code=503, detail="No se pudo asignar un código. Intenta de nuevo.")
+    lead = Lead(**valores)  # copia en memoria para correos/notificación
 
     # Magic link de un solo uso hacia la ruleta
     magic = MagicLink(
@@ -77,16 +105,8 @@ def registrar_lead(
         expires_at=datetime.utcnow() + timedelta(hours=settings.magic_link_ttl_hours),
     )
     db.add(magic)
-    db.commit()
-    db.refresh(lead)
-
-    # Email 1 (cupón + QR con URL corta validable) en segundo plano
-    qr_png = qr_svc.qr_png_bytes(qr_svc.url_validar(lead.coupon_token))
-    background.add_task(email_svc.enviar_cupon, lead.correo, lead.nombre, coupon, qr_png)
-    # Notificación interna con TODA la info del participante
-    background.add_task(email_svc.notificar_registro, lead)
 
-    return LeadResponse(
+    resp = LeadResponse(
         id=lead.id,
         nombre=lead.nombre,
         coupon_code=coupon,
@@ -94,3 +114,19 @@ def registrar_lead(
         magic_token=magic.token,
         whatsapp_url=_whatsapp_url(lead.nombre, magic.token),
     )
+    await db.execute(contadores_svc.sumar(participantes=1, referidos=int(bool(referred_by))))
+    # Email 1 (cupón + QR con URL corta validable) y notificación interna con TODA la
+    # info del participante: al outbox, en la misma transacción que el registro
+    await outbox_svc.encolar(
+        db,
+        outbox_svc.cupon(lead, lead.coupon_token),
+        outbox_svc.notif_registro(lead),
+    )
+    if not await idem_svc.guardar(db, _RUTA, idempotency_key, firma, resp):
+        await db.rollback()
+        return await idem_svc.buscar(db, _RUTA, idempotency_key, firma, LeadResponse)
+    await db.commit()
+    outbox_svc.despertar()
+    en_vivo_svc.avisar()
+
+    return resp
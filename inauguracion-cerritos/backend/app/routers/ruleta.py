@@ -1,19 +1,28 @@
 """Ruleta: config visible + giro seguro (resultado decidido en backend)."""
+import uuid
 from datetime import datetime
+from typing import Optional
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from ..database import get_db
-from ..models import Lead, MagicLink, Prize, Spin
+from ..database import get_async_db, get_db
+from ..models import Lead, MagicLink, Spin
 from ..schemas import SpinResult, WheelSegment
-from ..services import email as email_svc
+from ..services import contadores as contadores_svc
+from ..services import en_vivo as en_vivo_svc
+from ..services import idempotencia as idem_svc
+from ..services import outbox as outbox_svc
 from ..services import qr as qr_svc
 from ..services import ruleta as ruleta_svc
 from ..utils import token_corto
 
 router = APIRouter(prefix="/ruleta", tags=["ruleta"])
 
+_RUTA = "ruleta"
+
 
 @router.get("/config", response_model=list[WheelSegment])
 def config_ruleta(db: Session = Depends(get_db)):
@@ -26,76 +35,99 @@ def config_ruleta(db: Session = Depends(get_db)):
 
 
 @router.post("/spin/{token}", response_model=SpinResult)
-def girar(token: str, background: BackgroundTasks, db: Session = Depends(get_db)):
-    ml = db.query(MagicLink).filter(MagicLink.token == token).with_for_update().first()
-    if not ml:
+async def girar(
+    token: str,
+    db: AsyncSession = Depends(get_async_db),
+    idempotency_key: Optional[str] = Header(default=None, max_length=80),
+):
+    firma = idem_svc.huella(token)  # sin cuerpo: la petición es el enlace
+    # Enlace (bloqueado) + participante + "¿ya giró?" en una sola consulta
+    fila = (await db.execute(
+        select(
+            MagicLink,
+            Lead,
+            select(Spin.id).where(Spin.lead_id == MagicLink.lead_id).exists().label("ya_giro"),
+        )
+        .outerjoin(Lead, Lead.id == MagicLink.lead_id)
+        .where(MagicLink.token == token)
+        .with_for_update(of=MagicLink)
+    )).first()
+    if not fila:
         raise HTTPException(status_code=404, detail="Enlace inválido.")
+    ml, lead, ya_giro = fila
     if ml.expires_at < datetime.utcnow():
         raise HTTPException(status_code=410, detail="Enlace expirado.")
     if ml.used:
+        # Reintento del mismo giro (misma llave) => el resultado original
+        previa = await idem_svc.buscar(db, _RUTA, idempotency_key, firma, SpinResult)
+        if previa:
+            return previa
         raise HTTPException(status_code=409, detail="Ya usaste tu giro.")
-
-    lead = db.query(Lead).filter(Lead.id == ml.lead_id).first()
     if not lead:
         raise HTTPException(status_code=404, detail="Participante no encontrado.")
-    if db.query(Spin).filter(Spin.lead_id == lead.id).first():
+    if ya_giro:
         ml.used = True
-        db.commit()
+        await db.commit()
         raise HTTPException(status_code=409, detail="Ya usaste tu giro.")
 
-    # --- Decisión SEGURA en servidor ---
-    premio, seed, indice, segmentos = ruleta_svc.elegir_premio(db)
+    # --- Decisión SEGURA en servidor (segmentos en caché: normalmente sin consultas) ---
+    premio, seed, indice, segmentos = await db.run_sync(ruleta_svc.elegir_premio)
     if not segmentos:
         raise HTTPException(status_code=503, detail="La ruleta no está configurada aún.")
 
-    gano = premio is not None and not premio.es_perdedor
-    spin = Spin(lead_id=lead.id, server_seed=seed, gano=gano)
-
-    if gano:
-        # Descuento atómico de stock (lock de fila)
-        locked = db.query(Prize).filter(Prize.id == premio.id).with_for_update().first()
-        if locked.stock_restante <= 0:
-            # Se agotó entre la selección y el lock -> cae a "sigue participando"
-            gano = False
+    # Descuento de stock + INSERT del giro + consumo del enlace en un solo viaje.
+    # El JWT y el token se preparan antes; si el stock se agotó quedan en NULL.
+    candidato = premio if premio is not None and not premio.es_perdedor else None
+    spin_id = str(uuid.uuid4())
+    redeem_token = token_corto() if candidato else None
+    gano, restante = (await db.execute(ruleta_svc.sentencia_giro(
+        spin_id=spin_id,
+        lead_id=lead.id,
+        magic_link_id=ml.id,
+        prize_id=candidato.id if candidato else None,
+        seed=seed,
+        prize_jwt=(qr_svc.firmar_premio(spin_id, lead.id, candidato.nombre, lead.cedula)
+                   if candidato else None),
+        redeem_token=redeem_token,
+    ))).one()
+    if candidato:
+        ruleta_svc.registrar_descuento(None, candidato.id, gano, restante)
+        if not gano:
+            # Se agotó entre la selección y el descuento -> cae a "sigue participando"
             premio = None
-            spin.gano = False
-        else:
-            locked.stock_restante -= 1
-            spin.prize_id = locked.id
+    await db.execute(contadores_svc.sumar(giros=1, premios_ganados=int(bool(gano))))
 
-    spin.gano = gano
-    ml.used = True
-    db.add(spin)
-    db.flush()
-
-    if gano and premio is not None:
-        spin.prize_jwt = qr_svc.firmar_premio(spin.id, lead.id, premio.nombre, lead.cedula)
-        spin.redeem_token = token_corto()
-        db.commit()
-        db.refresh(spin)
-        qr_png = qr_svc.qr_png_bytes(qr_svc.url_validar(spin.redeem_token))
-        background.add_task(
-            email_svc.enviar_premio, lead.correo, lead.nombre, premio.nombre, qr_png
-        )
-        # Notificación interna del premio ganado
-        background.add_task(email_svc.notificar_premio, lead, premio.nombre)
-        return SpinResult(
+    if gano:
+        resp = SpinResult(
             gano=True,
             prize_id=premio.id,
             prize_nombre=premio.nombre,
             segment_index=indice,
             mensaje=f"¡Felicitaciones! Ganaste: {premio.nombre}. Te enviamos el QR por correo.",
         )
+        # Correo del premio (QR) + notificación interna, en la transacción del giro
+        await outbox_svc.encolar(
+            db,
+            outbox_svc.premio(lead, premio.nombre, redeem_token),
+            outbox_svc.notif_premio(lead, premio.nombre),
+        )
+        await idem_svc.guardar(db, _RUTA, idempotency_key, firma, resp)
+        await db.commit()
+        outbox_svc.despertar()
+        en_vivo_svc.avisar()
+        return resp
 
-    db.commit()
     # Segmento sobre el que se detiene la animación cuando no gana premio físico
     idx_perdedor = indice if premio is not None else (
         next((i for i, p in enumerate(segmentos) if p.es_perdedor), 0)
     )
-    return SpinResult(
+    resp = SpinResult(
         gano=False,
         prize_id=None,
         prize_nombre=None,
         segment_index=idx_perdedor,
         mensaje="¡Gracias por participar! Sigue disfrutando la inauguración. 🎉",
     )
+    await idem_svc.guardar(db, _RUTA, idempotency_key, firma, resp)
+    await db.commit()
+    return resp
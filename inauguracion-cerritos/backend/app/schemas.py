@@ -116,6 +116,7 @@ class ChannelBase(BaseModel):
     tipo: str = Field(pattern="^(sede|vendedor)$")
     nombre: str = Field(min_length=1, max_length=120)
     modo: str = Field(pattern="^(factura|vendedor)$")
+    sorteo: str = Field(default="ruleta", pattern="^(ruleta|mazo)$")
     activo: bool = True
     orden: int = 0
 
@@ -128,6 +129,7 @@ class ChannelUpdate(BaseModel):
     nombre: Optional[str] = None
     tipo: Optional[str] = Field(default=None, pattern="^(sede|vendedor)$")
     modo: Optional[str] = Field(default=None, pattern="^(factura|vendedor)$")
+    sorteo: Optional[str] = Field(default=None, pattern="^(ruleta|mazo)$")
     activo: Optional[bool] = None
     orden: Optional[int] = None
 
@@ -148,6 +150,20 @@ class ChannelPublic(BaseModel):
     activo: bool
 
 
+class DeckPublic(BaseModel):
+    seed_hash: str  # compromiso publicado al armar el mazo
+    total: int
+    activo: bool
+    creado: datetime
+    cerrado: Optional[datetime] = None
+    seed: Optional[str] = None  # se revela al cerrar el mazo
+
+
+class DeckResponse(DeckPublic):
+    id: str
+    pendientes: int
+
+
 class ChannelSpinRequest(BaseModel):
     # Según el modo del canal:
     factura: Optional[str] = Field(default=None, max_length=60)     # sede
@@ -2,7 +2,7 @@
 from datetime import datetime, timedelta, timezone
 
 import jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from passlib.context import CryptContext
 
@@ -32,19 +32,45 @@ def create_session_token(admin_id: str, email: str) -> str:
     return jwt.encode(payload, settings.jwt_secret, algorithm=settings.jwt_algorithm)
 
 
-def get_current_admin(
-    creds: HTTPAuthorizationCredentials = Depends(bearer),
-) -> dict:
-    if creds is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
+def create_stream_token(admin_id: str) -> str:
+    """Token corto y de un solo propósito para `GET /admin/stream?token=`.
+
+    EventSource no manda cabeceras, así que el token viaja en la URL y termina en los
+    access logs: por eso no es la sesión, solo abre el stream y vence en segundos.
+    """
+    now = datetime.now(timezone.utc)
+    payload = {
+        "sub": admin_id,
+        "typ": "sse",
+        "iat": now,
+        "exp": now + timedelta(seconds=settings.sse_token_ttl_seconds),
+    }
+    return jwt.encode(payload, settings.jwt_secret, algorithm=settings.jwt_algorithm)
+
+
+def _decodificar(token: str, tipo: str) -> dict:
     try:
-        payload = jwt.decode(
-            creds.credentials, settings.jwt_secret, algorithms=[settings.jwt_algorithm]
-        )
-        if payload.get("typ") != "session":
+        payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
+        if payload.get("typ") != tipo:
             raise ValueError("tipo inválido")
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Sesión expirada")
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido")
+
+
+def get_current_admin(
+    creds: HTTPAuthorizationCredentials = Depends(bearer),
+) -> dict:
+    if creds is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
+    return _decodificar(creds.credentials, "session")
+
+
+def get_current_admin_query(token: str = Query(default="")) -> dict:
+    """Para EventSource, que no puede mandar cabeceras: `?token=` con un token `sse`
+    (ver `create_stream_token`); el de sesión no se acepta aquí."""
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
+    return _decodificar(token, "sse")
@@ -0,0 +1,139 @@
+"""Contadores de eventos (`event_counters`) para el dashboard y el reporte.
+
+Cada registro, giro, premio ganado/entregado y cupón usado suma +1 en la misma
+transacción que lo produce (`sumar`), así las métricas se leen en tiempo constante sin
+recontar `leads` ni `spins`. `reconciliar` los reconstruye desde las tablas crudas:
+
+    cd backend
+    python -m app.services.contadores            # muestra diferencias y corrige
+    python -m app.services.contadores --revisar  # solo muestra diferencias
+"""
+import argparse
+import random
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import exists, func, literal, select, text, union_all
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import EventCounter, Lead, Spin
+
+INAUGURACION = ""
+EVENTOS = ("participantes", "referidos", "cupones_usados",
+           "giros", "premios_ganados", "premios_entregados")
+
+
+def sumar(canal: Optional[str] = None, **eventos: int):
+    """Sentencia que suma `evento=n` al canal (None = inauguración), en un fragmento al azar.
+
+    Se ejecuta en la transacción del evento: si esta se revierte, el contador también.
+    """
+    desconocidos = set(eventos) - set(EVENTOS)
+    if desconocidos:
+        raise ValueError(f"Eventos desconocidos: {sorted(desconocidos)}")
+    filas = [
+        {"canal": canal or INAUGURACION, "evento": evento, "valor": n,
+         "fragmento": random.randrange(settings.contadores_fragmentos)}
+        for evento, n in eventos.items() if n
+    ]
+    stmt = insert(EventCounter).values(filas)
+    return stmt.on_conflict_do_update(
+        index_elements=[EventCounter.canal, EventCounter.evento, EventCounter.fragmento],
+        set_={"valor": EventCounter.valor + stmt.excluded.valor},
+    )
+
+
+def total(evento: str):
+    """Expresión SUM(valor) FILTER (evento) para usar sobre `event_counters`."""
+    return func.coalesce(func.sum(EventCounter.valor).filter(EventCounter.evento == evento), 0)
+
+
+def totales(db: Session) -> Dict[str, int]:
+    """Total de cada evento sumando todos los canales."""
+    fila = db.execute(select(*(total(e) for e in EVENTOS))).one()
+    return {e: int(v) for e, v in zip(EVENTOS, fila)}
+
+
+def por_canal(db: Session) -> Dict[Tuple[str, str], int]:
+    """(canal, evento) -> total."""
+    filas = db.execute(
+        select(EventCounter.canal, EventCounter.evento, func.sum(EventCounter.valor))
+        .group_by(EventCounter.canal, EventCounter.evento)
+    ).all()
+    return {(c, e): int(v) for c, e, v in filas}
+
+
+def _reales():
+    """(canal, evento, valor) contados desde leads y spins."""
+    inaug = literal(INAUGURACION)
+    canal = func.coalesce(Spin.channel_id.cast(EventCounter.canal.type), INAUGURACION)
+    leads = select(
+        func.count().label("participantes"),
+        func.count().filter(Lead.referred_by.isnot(None)).label("referidos"),
+        func.count().filter(Lead.coupon_redeemed.is_(True)).label("cupones_usados"),
+    ).subquery()
+    spins = select(
+        canal.label("canal"),
+        func.count().label("giros"),
+        func.count().filter(Spin.gano.is_(True)).label("premios_ganados"),
+        func.count().filter(Spin.redeemed.is_(True)).label("premios_entregados"),
+    ).group_by(canal).subquery()
+    partes = [select(inaug, literal(e), getattr(leads.c, e)) for e in EVENTOS[:3]]
+    partes += [select(spins.c.canal, literal(e), getattr(spins.c, e)) for e in EVENTOS[3:]]
+    return union_all(*partes)
+
+
+def reconciliar(db: Session, corregir: bool = True) -> List[dict]:
+    """Compara los contadores con las tablas crudas y (si `corregir`) los reconstruye.
+
+    Bloquea `event_counters` contra escrituras mientras cuenta: los registros/giros en
+    curso esperan y suman después, sobre los contadores ya reconstruidos.
+    """
+    db.execute(text("LOCK TABLE event_counters IN SHARE ROW EXCLUSIVE MODE"))
+    reales = {(c, e): int(v) for c, e, v in db.execute(_reales()).all()}
+    actuales = por_canal(db)
+    diferencias = [
+        {"canal": c or "inauguración", "evento": e, "contador": actuales.get((c, e), 0),
+         "real": reales.get((c, e), 0)}
+        for c, e in sorted(set(reales) | set(actuales))
+        if actuales.get((c, e), 0) != reales.get((c, e), 0)
+    ]
+    if corregir:
+        db.query(EventCounter).delete()
+        filas = [{"canal": c, "evento": e, "fragmento": 0, "valor": v}
+                 for (c, e), v in reales.items() if v]
+        if filas:
+            db.execute(insert(EventCounter), filas)
+        db.commit()
+    else:
+        db.rollback()
+    return diferencias
+
+
+def inicializar(db: Session) -> None:
+    """Primer arranque con la tabla vacía (p. ej. base existente): se llena desde cero."""
+    if not db.scalar(select(exists().select_from(EventCounter))):
+        reconciliar(db)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Reconstruye event_counters desde leads/spins.")
+    ap.add_argument("--revisar", action="store_true", help="solo muestra diferencias")
+    args = ap.parse_args()
+
+    from ..database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        diferencias = reconciliar(db, corregir=not args.revisar)
+    finally:
+        db.close()
+    for d in diferencias:
+        print(f"{d['canal']:<38} {d['evento']:<20} contador={d['contador']:<8} real={d['real']}")
+    print(f"{len(diferencias)} diferencia(s)"
+          + ("" if args.revisar or not diferencias else " corregida(s)"))
+
+
+if __name__ == "__main__":
+    main()
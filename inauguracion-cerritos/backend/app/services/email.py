@@ -4,14 +4,22 @@ Estrategia: intenta SendGrid primero; si no hay API key o falla, cae a SMTP (Gma
 Los errores de envío NO deben tumbar el registro del usuario -> se capturan y loguean.
 """
 import base64
+import json
 import logging
 import smtplib
+import threading
+import time
+from collections import deque
+from datetime import datetime
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Optional
+from typing import Deque, Dict, List, Optional, Tuple
+
+import httpx
 
 from ..config import settings
+from . import metricas
 
 logger = logging.getLogger("email")
 
@@ -41,7 +49,7 @@ def _wrapper(titulo: str, cuerpo_html: str) -> str:
 </div>"""
 
 
-def _html_cupon(nombre: str, code: str) -> str:
+def _html_cupon(nombre: str, code: str, qr_src: str = "cid:qrimg") -> str:
     cuerpo = f"""
     <p>¡Hola <strong>{nombre}</strong>! Gracias por registrarte en la inauguración de la
     nueva <strong>Tienda Pintuco Cerritos</strong>. 🎉</p>
@@ -54,7 +62,7 @@ def _html_cupon(nombre: str, code: str) -> str:
     </div>
     <p style="text-align:center;">Muestra este código QR en caja para redimirlo:</p>
     <div style="text-align:center;margin:12px 0 4px;">
-      <img src="cid:qrimg" width="180" height="180" alt="QR del cupón"
+      <img src="{qr_src}" width="180" height="180" alt="QR del cupón"
         style="border:8px solid #fff;border-radius:12px;box-shadow:0 4px 16px rgba(10,46,87,.12);">
     </div>
     <p style="text-align:center;font-size:13px;color:#7A8AA0;">
@@ -63,7 +71,7 @@ def _html_cupon(nombre: str, code: str) -> str:
     return _wrapper("¡Tu cupón está listo! 🎁", cuerpo)
 
 
-def _html_premio(nombre: str, premio: str) -> str:
+def _html_premio(nombre: str, premio: str, qr_src: str = "cid:qrimg") -> str:
     cuerpo = f"""
     <p>¡Felicitaciones <strong>{nombre}</strong>! 🏆 Giraste la ruleta del equipo ganador
     Pintuco y te ganaste:</p>
@@ -73,7 +81,7 @@ def _html_premio(nombre: str, premio: str) -> str:
     </div>
     <p style="text-align:center;">Presenta este QR en la tienda para reclamar tu premio:</p>
     <div style="text-align:center;margin:12px 0 4px;">
-      <img src="cid:qrimg" width="200" height="200" alt="QR del premio"
+      <img src="{qr_src}" width="200" height="200" alt="QR del premio"
         style="border:8px solid #fff;border-radius:12px;box-shadow:0 4px 16px rgba(10,46,87,.12);">
     </div>
     <p style="text-align:center;font-size:13px;color:#7A8AA0;">
@@ -83,78 +91,375 @@ def _html_premio(nombre: str, premio: str) -> str:
 
 
 # ---------------- Transporte ----------------
-def _enviar_sendgrid(to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bool:
-    if not settings.sendgrid_api_key:
-        return False
-    try:
-        from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import (
-            Attachment,
-            Disposition,
-            FileContent,
-            FileName,
-            FileType,
-            Mail,
-            ContentId,
-        )
+# Un solo cliente HTTP (keep-alive) para SendGrid y un pool de sesiones SMTP ya
+# autenticadas: en una ráfaga de registros no se paga un handshake TLS (+ login) por correo.
+_SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+_SMTP_INACTIVA = 60.0  # segundos; una sesión guardada más tiempo se descarta (el servidor la cierra)
 
-        message = Mail(
-            from_email=(settings.sendgrid_from_email, settings.sendgrid_from_name),
-            to_emails=to,
-            subject=asunto,
-            html_content=html,
-        )
-        if qr_png:
-            att = Attachment(
-                FileContent(base64.b64encode(qr_png).decode()),
-                FileName("qr.png"),
-                FileType("image/png"),
-                Disposition("inline"),
+_http: Optional[httpx.Client] = None
+_http_lock = threading.Lock()
+
+
+def _cliente_http() -> httpx.Client:
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = httpx.Client(
+                timeout=httpx.Timeout(15.0, connect=5.0),
+                limits=httpx.Limits(max_connections=settings.email_concurrencia,
+                                    max_keepalive_connections=settings.email_concurrencia,
+                                    keepalive_expiry=120.0),
             )
-            att.content_id = ContentId("qrimg")
-            message.attachment = att
-
-        client = SendGridAPIClient(settings.sendgrid_api_key)
-        resp = client.send(message)
-        return 200 <= resp.status_code < 300
-    except Exception as e:  # noqa: BLE001
-        logger.warning("SendGrid falló: %s", e)
-        return False
+        return _http
 
 
-def _enviar_smtp(to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bool:
-    if not (settings.smtp_server and settings.smtp_user and settings.smtp_password):
-        return False
+def _sesion_caida(e: Exception) -> bool:
+    """El error invalida la conexión (vs. un rechazo del mensaje con la sesión sana)."""
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return e.smtp_code == 421
+    return not isinstance(e, smtplib.SMTPException)
+
+
+def _cerrar_smtp(server: smtplib.SMTP) -> None:
     try:
-        root = MIMEMultipart("related")
-        root["Subject"] = asunto
-        root["From"] = f"{settings.sendgrid_from_name} <{settings.smtp_user}>"
-        root["To"] = to
-
-        alt = MIMEMultipart("alternative")
-        alt.attach(MIMEText("Abre este correo en formato HTML.", "plain"))
-        alt.attach(MIMEText(html, "html"))
-        root.attach(alt)
-
-        if qr_png:
-            img = MIMEImage(qr_png, _subtype="png")
-            img.add_header("Content-ID", "<qrimg>")
-            img.add_header("Content-Disposition", "inline", filename="qr.png")
-            root.attach(img)
-
-        with smtplib.SMTP_SSL(settings.smtp_server, settings.smtp_port) as server:
+        server.quit()
+    except Exception:  # noqa: BLE001
+        server.close()
+
+
+class _SesionesSMTP:
+    """Sesiones SMTP_SSL autenticadas reutilizables, hasta `limite` abiertas a la vez.
+
+    Una sesión que murió mientras esperaba (timeout del servidor, 421) se reemplaza por
+    una nueva y el mensaje se reintenta una vez.
+    """
+
+    def __init__(self, limite: int) -> None:
+        self._cupo = threading.BoundedSemaphore(max(1, limite))
+        self._libres: List[Tuple[smtplib.SMTP, float]] = []
+        self._lock = threading.Lock()
+
+    def _abrir(self) -> smtplib.SMTP:
+        metricas.email_conexiones.inc("smtp")
+        server = smtplib.SMTP_SSL(settings.smtp_server, settings.smtp_port, timeout=15)
+        try:
             server.login(settings.smtp_user, settings.smtp_password)
-            server.sendmail(settings.smtp_user, [to], root.as_string())
-        return True
-    except Exception as e:  # noqa: BLE001
-        logger.warning("SMTP falló: %s", e)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _tomar(self) -> Tuple[smtplib.SMTP, bool]:
+        """(sesión, reutilizada)."""
+        ahora = time.monotonic()
+        with self._lock:
+            while self._libres:
+                server, usada = self._libres.pop()
+                if ahora - usada < _SMTP_INACTIVA:
+                    return server, True
+                _cerrar_smtp(server)
+        return self._abrir(), False
+
+    def _devolver(self, server: smtplib.SMTP) -> None:
+        with self._lock:
+            self._libres.append((server, time.monotonic()))
+
+    def enviar(self, remitente: str, destinos: List[str], mensaje: bytes) -> None:
+        with self._cupo:
+            server, reutilizada = self._tomar()
+            while True:
+                try:
+                    server.sendmail(remitente, destinos, mensaje)
+                except Exception as e:  # noqa: BLE001
+                    if not _sesion_caida(e):
+                        self._devolver(server)
+                        raise
+                    _cerrar_smtp(server)
+                    if not reutilizada:
+                        raise
+                    server, reutilizada = self._abrir(), False
+                    continue
+                self._devolver(server)
+                return
+
+    def cerrar(self) -> None:
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for server, _ in libres:
+            _cerrar_smtp(server)
+
+
+_smtp = _SesionesSMTP(settings.smtp_sesiones)
+
+
+def _sendgrid_configurado() -> bool:
+    return bool(settings.sendgrid_api_key)
+
+
+def _smtp_configurado() -> bool:
+    return bool(settings.smtp_server and settings.smtp_user and settings.smtp_password)
+
+
+def _armar_sendgrid(to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bytes:
+    """Cuerpo JSON de /v3/mail/send. El SDK solo arma el payload (Mail)."""
+    from sendgrid.helpers.mail import (
+        Attachment,
+        Disposition,
+        FileContent,
+        FileName,
+        FileType,
+        Mail,
+        ContentId,
+    )
+
+    message = Mail(
+        from_email=(settings.sendgrid_from_email, settings.sendgrid_from_name),
+        to_emails=to,
+        subject=asunto,
+        html_content=html,
+    )
+    if qr_png:
+        att = Attachment(
+            FileContent(base64.b64encode(qr_png).decode()),
+            FileName("qr.png"),
+            FileType("image/png"),
+            Disposition("inline"),
+        )
+        att.content_id = ContentId("qrimg")
+        message.attachment = att
+    return json.dumps(message.get()).encode()
+
+
+def _enviar_sendgrid(to: str, cuerpo: bytes) -> None:
+    resp = _cliente_http().post(
+        _SENDGRID_URL, content=cuerpo,
+        headers={"Authorization": f"Bearer {settings.sendgrid_api_key}",
+                 "Content-Type": "application/json"},
+    )
+    if not resp.is_success:
+        detalle = f"HTTP {resp.status_code}: {resp.text[:300]}"
+        # 4xx = SendGrid rechazó ESTE mensaje (p. ej. correo mal escrito), salvo cuota y
+        # credenciales, que afectan a todos los envíos
+        if 400 <= resp.status_code < 500 and resp.status_code not in (401, 403, 429):
+            raise RechazoMensaje(detalle)
+        raise RuntimeError(detalle)
+
+
+def _armar_smtp(to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bytes:
+    root = MIMEMultipart("related")
+    root["Subject"] = asunto
+    root["From"] = f"{settings.sendgrid_from_name} <{settings.smtp_user}>"
+    root["To"] = to
+
+    alt = MIMEMultipart("alternative")
+    alt.attach(MIMEText("Abre este correo en formato HTML.", "plain"))
+    alt.attach(MIMEText(html, "html"))
+    root.attach(alt)
+
+    if qr_png:
+        img = MIMEImage(qr_png, _subtype="png")
+        img.add_header("Content-ID", "<qrimg>")
+        img.add_header("Content-Disposition", "inline", filename="qr.png")
+        root.attach(img)
+    return root.as_bytes()
+
+
+def _enviar_smtp(to: str, cuerpo: bytes) -> None:
+    _smtp.enviar(settings.smtp_user, [to], cuerpo)
+
+
+def cerrar() -> None:
+    """Cierra el cliente HTTP y las sesiones SMTP guardadas (apagado del proceso)."""
+    global _http
+    with _http_lock:
+        cliente, _http = _http, None
+    if cliente is not None:
+        cliente.close()
+    _smtp.cerrar()
+
+
+# ---------------- Telemetría de envíos ----------------
+# Cada intento (transporte, plantilla, bytes con el QR, latencia, resultado) va a un buffer
+# circular para el admin y a los histogramas de /metrics.
+_intentos: Deque[dict] = deque(maxlen=settings.email_telemetria_items)
+_intentos_lock = threading.Lock()
+
+
+def _registrar_intento(transporte: str, plantilla: str, tamano: Optional[int],
+                       segundos: float, error: Optional[str]) -> None:
+    resultado = "error" if error else "ok"
+    metricas.email_envio_duracion.observar(segundos, transporte, plantilla, resultado)
+    if tamano is not None:
+        metricas.email_envio_bytes.observar(tamano, transporte, plantilla)
+    with _intentos_lock:
+        _intentos.append({
+            "ts": datetime.utcnow().isoformat(timespec="seconds"),
+            "transporte": transporte, "plantilla": plantilla, "bytes": tamano,
+            "ms": round(segundos * 1000, 1), "resultado": resultado,
+            "error": error[:300] if error else None,
+        })
+
+
+def telemetria(limite: int = 50) -> dict:
+    """Resumen por transporte y plantilla de los intentos en el buffer + los últimos."""
+    with _intentos_lock:
+        intentos = list(_intentos)
+    grupos: Dict[Tuple[str, str], List[dict]] = {}
+    for i in intentos:
+        grupos.setdefault((i["transporte"], i["plantilla"]), []).append(i)
+    resumen = []
+    for (transporte, plantilla), filas in sorted(grupos.items()):
+        ms = sorted(f["ms"] for f in filas)
+        tamanos = [f["bytes"] for f in filas if f["bytes"] is not None]
+        resumen.append({
+            "transporte": transporte, "plantilla": plantilla, "intentos": len(filas),
+            "errores": sum(f["resultado"] == "error" for f in filas),
+            "p50_ms": ms[(len(ms) - 1) // 2],
+            "p95_ms": ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+            "max_ms": ms[-1],
+            "bytes_promedio": round(sum(tamanos) / len(tamanos)) if tamanos else None,
+            "bytes_max": max(tamanos) if tamanos else None,
+        })
+    return {"ventana": len(intentos), "resumen": resumen,
+            "recientes": intentos[-limite:][::-1] if limite > 0 else []}
+
+
+# ---------------- Circuit breaker por transporte ----------------
+class RechazoMensaje(Exception):
+    """El transporte respondió pero rechazó este mensaje: no cuenta para su circuito."""
+
+
+def _falla_de_transporte(e: Exception) -> bool:
+    """Conexión, timeout, 5xx/429 o 421 (servicio no disponible) cuentan para el circuito;
+    un destinatario o un contenido rechazado es problema del mensaje, no del transporte."""
+    if isinstance(e, RechazoMensaje):
         return False
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(codigo == 421 for codigo, _ in e.recipients.values())
+    if isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return e.smtp_code == 421
+    return True
 
 
-def _enviar(to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bool:
-    if _enviar_sendgrid(to, asunto, html, qr_png):
+class _Interruptor:
+    """Circuit breaker de un transporte.
+
+    cerrado -> abierto tras `EMAIL_BREAKER_FALLOS` fallos seguidos; abierto no deja pasar
+    envíos durante `EMAIL_BREAKER_ESPERA_SECONDS`; luego semiabierto deja pasar UNA
+    prueba: si sale bien se cierra, si falla vuelve a abrirse.
+    """
+
+    def __init__(self, nombre: str) -> None:
+        self.nombre = nombre
+        self._lock = threading.Lock()
+        self.estado = "cerrado"
+        self.fallos_seguidos = 0
+        self.aperturas = 0
+        self.ultimo_error: Optional[str] = None
+        self._abierto_en = 0.0
+        self._probando = False
+
+    def permitir(self) -> bool:
+        with self._lock:
+            if self.estado == "cerrado":
+                return True
+            if self.estado == "abierto":
+                if time.monotonic() - self._abierto_en < settings.email_breaker_espera_seconds:
+                    return False
+                self.estado, self._probando = "semiabierto", False
+            if self._probando:
+                return False
+            self._probando = True
+            return True
+
+    def exito(self) -> None:
+        with self._lock:
+            if self.estado != "cerrado":
+                logger.info("Transporte %s recuperado: circuito cerrado.", self.nombre)
+            self.estado, self.fallos_seguidos, self._probando = "cerrado", 0, False
+        metricas.email_circuito_abierto.fijar(self.nombre, valor=0)
+
+    def liberar(self) -> None:
+        """El intento no dice nada del transporte (mensaje rechazado): suelta la prueba
+        del semiabierto sin cambiar el estado ni la racha de fallos."""
+        with self._lock:
+            self._probando = False
+
+    def fallo(self, error: str) -> None:
+        with self._lock:
+            self.fallos_seguidos += 1
+            self.ultimo_error = error
+            self._probando = False
+            if self.estado == "abierto":
+                return
+            if self.estado == "cerrado" and self.fallos_seguidos < settings.email_breaker_fallos:
+                return
+            self.estado, self._abierto_en = "abierto", time.monotonic()
+            self.aperturas += 1
+        logger.warning("Transporte %s abierto tras %s fallos seguidos: %s",
+                       self.nombre, self.fallos_seguidos, error)
+        metricas.email_circuito_abierto.fijar(self.nombre, valor=1)
+
+    def resumen(self) -> dict:
+        with self._lock:
+            restante = None
+            if self.estado == "abierto":
+                restante = max(0.0, settings.email_breaker_espera_seconds
+                               - (time.monotonic() - self._abierto_en))
+            return {
+                "estado": self.estado,
+                "fallos_seguidos": self.fallos_seguidos,
+                "aperturas": self.aperturas,
+                "reintento_en_s": round(restante, 1) if restante is not None else None,
+                "ultimo_error": self.ultimo_error,
+            }
+
+
+# (nombre, ¿configurado?, armar, envío, interruptor) en orden de preferencia
+_TRANSPORTES = [
+    ("sendgrid", _sendgrid_configurado, _armar_sendgrid, _enviar_sendgrid,
+     _Interruptor("sendgrid")),
+    ("smtp", _smtp_configurado, _armar_smtp, _enviar_smtp, _Interruptor("smtp")),
+]
+
+
+def configurado() -> bool:
+    """Hay al menos un transporte (SendGrid o SMTP) con credenciales."""
+    return any(listo() for _, listo, _, _, _ in _TRANSPORTES)
+
+
+def estado_transportes() -> List[dict]:
+    """Estado de cada transporte y su circuito (para el admin)."""
+    return [{"transporte": nombre, "configurado": listo(), **interruptor.resumen()}
+            for nombre, listo, _, _, interruptor in _TRANSPORTES]
+
+
+def _enviar(plantilla: str, to: str, asunto: str, html: str, qr_png: Optional[bytes]) -> bool:
+    """Primer transporte configurado con el circuito cerrado (o en prueba) que acepte."""
+    for nombre, listo, armar, enviar, interruptor in _TRANSPORTES:
+        if not listo() or not interruptor.permitir():
+            continue
+        t0 = time.perf_counter()
+        tamano = None
+        try:
+            cuerpo = armar(to, asunto, html, qr_png)
+            tamano = len(cuerpo)
+            enviar(to, cuerpo)
+        except Exception as e:  # noqa: BLE001
+            logger.warning("%s falló: %s", nombre, e)
+            _registrar_intento(nombre, plantilla, tamano, time.perf_counter() - t0, str(e))
+            # Sin cuerpo (falló el armado) o rechazo del mensaje: el transporte está sano
+            if tamano is not None and _falla_de_transporte(e):
+                interruptor.fallo(str(e)[:300])
+            else:
+                interruptor.liberar()
+            continue
+        _registrar_intento(nombre, plantilla, tamano, time.perf_counter() - t0, None)
+        interruptor.exito()
         return True
-    return _enviar_smtp(to, asunto, html, qr_png)
+    return False
 
 
 # ---------------- Notificaciones internas (a la tienda) ----------------
@@ -176,7 +481,7 @@ def notificar_registro(lead) -> bool:
         ("Cód. referido", lead.referral_code),
         ("Referido por", lead.referred_by or "—"),
     ]
-    return _enviar(settings.store_notify_email,
+    return _enviar("notif_registro", settings.store_notify_email,
                    f"🆕 Nuevo participante — {lead.nombre}",
                    _html_notif("Nuevo participante registrado", filas), None)
 
@@ -187,17 +492,52 @@ def notificar_premio(lead, premio: str) -> bool:
         ("Teléfono", lead.telefono), ("Correo", lead.correo),
         ("Cédula", lead.cedula),
     ]
-    return _enviar(settings.store_notify_email,
+    return _enviar("notif_premio", settings.store_notify_email,
                    f"🏆 Premio ganado — {premio} — {lead.nombre}",
                    _html_notif("Un participante ganó un premio", filas), None)
 
 
+def notificar_resumen(eventos: List[Tuple[datetime, str, dict]]) -> bool:
+    """Un solo correo con varios avisos: (creado, tipo, datos) como en el outbox."""
+    th = "".join(
+        f'<th style="padding:6px 8px;text-align:left;font-size:12px;color:#7A8AA0;">{t}</th>'
+        for t in ("Hora", "Evento", "Nombre", "Teléfono", "Correo", "Cédula", "Cupón / Premio")
+    )
+    tr = []
+    premios = 0
+    for creado, tipo, datos in sorted(eventos, key=lambda e: e[0]):
+        lead = datos["lead"]
+        if tipo == "notif_premio":
+            premios += 1
+            evento, detalle = "🏆 Premio", datos["premio"]
+        else:
+            evento, detalle = "🆕 Registro", lead["coupon_code"]
+        celdas = (creado.strftime("%H:%M"), evento, lead["nombre"], lead["telefono"],
+                  lead["correo"], lead["cedula"], detalle)
+        tr.append("<tr>" + "".join(
+            f'<td style="padding:6px 8px;border-top:1px solid #E3EAF2;font-size:13px;'
+            f'color:{BRAND_NAVY};">{c}</td>' for c in celdas) + "</tr>")
+    registros = len(eventos) - premios
+    cuerpo = (f"<p>{registros} registro(s) y {premios} premio(s) desde el último resumen.</p>"
+              f'<table style="width:100%;border-collapse:collapse;"><tr>{th}</tr>'
+              f'{"".join(tr)}</table>')
+    return _enviar("resumen", settings.store_notify_email,
+                   f"📋 Resumen — {registros} registros, {premios} premios",
+                   _wrapper("Resumen de participación", cuerpo), None)
+
+
 # ---------------- API pública del módulo ----------------
-def enviar_cupon(to: str, nombre: str, code: str, qr_png: bytes) -> bool:
-    return _enviar(to, "🎁 Tu cupón 10% — Tienda Pintuco Cerritos",
-                   _html_cupon(nombre, code), qr_png)
+def enviar_cupon(to: str, nombre: str, code: str, qr_png: Optional[bytes],
+                 qr_url: Optional[str] = None) -> bool:
+    """Con `qr_url` el QR va como imagen alojada y no se adjunta el PNG."""
+    return _enviar("cupon", to, "🎁 Tu cupón 10% — Tienda Pintuco Cerritos",
+                   _html_cupon(nombre, code, qr_url or "cid:qrimg"),
+                   None if qr_url else qr_png)
 
 
-def enviar_premio(to: str, nombre: str, premio: str, qr_png: bytes) -> bool:
-    return _enviar(to, "🏆 ¡Ganaste! — Tienda Pintuco Cerritos",
-                   _html_premio(nombre, premio), qr_png)
+def enviar_premio(to: str, nombre: str, premio: str, qr_png: Optional[bytes],
+                  qr_url: Optional[str] = None) -> bool:
+    """Con `qr_url` el QR va como imagen alojada y no se adjunta el PNG."""
+    return _enviar("premio", to, "🏆 ¡Ganaste! — Tienda Pintuco Cerritos",
+                   _html_premio(nombre, premio, qr_url or "cid:qrimg"),
+                   None if qr_url else qr_png)
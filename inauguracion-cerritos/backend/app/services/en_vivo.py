@@ -0,0 +1,168 @@
+"""Dashboard en vivo por server-sent events (`GET /admin/stream`).
+
+Un solo productor por proceso consulta la BD mientras haya al menos un dashboard
+conectado y reparte lo que cambió a la cola de cada suscriptor: N pestañas abiertas
+cuestan las mismas consultas que una. Cada evento se serializa una vez.
+
+Eventos:
+- `metricas`: al conectar, todas; después solo los campos que cambiaron.
+- `stock`: premios activos cuyo `stock_restante` cambió (todos al conectar).
+- `premio`: giros ganadores nuevos (cliente, premio, canal, hora).
+
+Los giros y canjes hechos en este proceso despiertan al productor al instante
+(`avisar`); los de otros workers se ven en el siguiente sondeo
+(`tablero_sse_intervalo_seconds`).
+"""
+import asyncio
+import json
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..database import AsyncSessionLocal
+from ..models import Channel, Lead, Prize, Spin
+from . import tablero as tablero_svc
+
+logger = logging.getLogger("en_vivo")
+
+_COLA = 100  # eventos pendientes por suscriptor; una pestaña más lenta se desconecta
+_SOLAPE = timedelta(seconds=10)  # los giros se confirman después de su created_at
+
+_suscriptores: Set[asyncio.Queue] = set()
+_productor: Optional[asyncio.Task] = None
+_despertador: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Último estado visto (para calcular diferencias y dar la foto inicial)
+_metricas: Dict[str, object] = {}
+_stock: Dict[str, dict] = {}
+_ultimo_giro: Optional[datetime] = None
+_giros_vistos: Deque[str] = deque(maxlen=500)
+
+
+def _evento(nombre: str, datos) -> str:
+    return f"event: {nombre}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+
+def _leer(db: Session, ganados_antes: Optional[int]) -> dict:
+    """Métricas + stock; los ganadores nuevos solo si subió `premios_ganados`."""
+    metricas = tablero_svc.consultar(db)
+    stock = {
+        pid: {"id": pid, "nombre": nombre, "stock_restante": restante, "canal": canal}
+        for pid, nombre, restante, canal in db.execute(
+            select(Prize.id, Prize.nombre, Prize.stock_restante, Channel.nombre)
+            .outerjoin(Channel, Channel.id == Prize.channel_id)
+            .where(Prize.activo.is_(True), Prize.es_perdedor.is_(False))
+        ).all()
+    }
+    ganadores: List[dict] = []
+    if ganados_antes is not None and metricas["premios_ganados"] > ganados_antes:
+        desde = (_ultimo_giro or datetime.utcnow()) - _SOLAPE
+        ganadores = [
+            {"id": sid, "cliente": cliente, "premio": premio, "canal": canal or "Inauguración",
+             "hora": creado}
+            for sid, cliente, premio, canal, creado in db.execute(
+                select(Spin.id, func.coalesce(Lead.nombre, Spin.nombre), Prize.nombre,
+                       Channel.nombre, Spin.created_at)
+                .join(Prize, Prize.id == Spin.prize_id)
+                .outerjoin(Lead, Lead.id == Spin.lead_id)
+                .outerjoin(Channel, Channel.id == Spin.channel_id)
+                .where(Spin.gano.is_(True), Spin.created_at >= desde)
+                .order_by(Spin.created_at)
+            ).all()
+        ]
+    return {"metricas": metricas, "stock": stock, "ganadores": ganadores}
+
+
+def _repartir(evento: str) -> None:
+    for cola in list(_suscriptores):
+        try:
+            cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            # No alcanza a leer: se corta y el EventSource reconecta con la foto completa
+            _suscriptores.discard(cola)
+            cola.get_nowait()
+            cola.put_nowait(None)
+
+
+async def _producir() -> None:
+    global _metricas, _stock, _ultimo_giro
+    while _suscriptores:
+        try:
+            async with AsyncSessionLocal() as db:
+                ganados = _metricas.get("premios_ganados") if _metricas else None
+                leido = await db.run_sync(_leer, ganados)
+            cambios = {k: v for k, v in leido["metricas"].items() if _metricas.get(k) != v}
+            if cambios:
+                _repartir(_evento("metricas", cambios))
+            stock = [p for pid, p in leido["stock"].items() if _stock.get(pid) != p]
+            if stock:
+                _repartir(_evento("stock", stock))
+            for g in leido["ganadores"]:
+                if g["id"] in _giros_vistos:
+                    continue
+                _giros_vistos.append(g["id"])
+                _ultimo_giro = max(_ultimo_giro or g["hora"], g["hora"])
+                _repartir(_evento("premio", g))
+            if _ultimo_giro is None:
+                _ultimo_giro = datetime.utcnow()
+            _metricas, _stock = leido["metricas"], leido["stock"]
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Dashboard en vivo: error al consultar: %s", e)
+        try:
+            await asyncio.wait_for(_despertador.wait(),
+                                   timeout=settings.tablero_sse_intervalo_seconds)
+        except asyncio.TimeoutError:
+            pass
+        _despertador.clear()
+    # Sin dashboards: la foto guardada envejece, el próximo productor arranca de cero
+    _metricas, _stock, _ultimo_giro = {}, {}, None
+
+
+def suscribir() -> asyncio.Queue:
+    """Cola de eventos de un dashboard, ya con la foto actual si el productor corre."""
+    global _productor, _despertador, _loop
+    cola: asyncio.Queue = asyncio.Queue(maxsize=_COLA)
+    if _metricas:
+        cola.put_nowait(_evento("metricas", _metricas))
+        cola.put_nowait(_evento("stock", list(_stock.values())))
+    _suscriptores.add(cola)
+    if _productor is None or _productor.done():
+        _loop = asyncio.get_running_loop()
+        _despertador = asyncio.Event()
+        _productor = asyncio.create_task(_producir())
+    return cola
+
+
+def desuscribir(cola: asyncio.Queue) -> None:
+    _suscriptores.discard(cola)
+
+
+def avisar() -> None:
+    """Algo cambió en este proceso: el productor consulta ya, sin esperar el sondeo.
+
+    Se puede llamar desde el threadpool (endpoints sync).
+    """
+    if _loop is not None and _despertador is not None and _suscriptores:
+        _loop.call_soon_threadsafe(_despertador.set)
+
+
+async def cerrar() -> None:
+    """Apagado del proceso: corta las conexiones abiertas y detiene el productor."""
+    for cola in list(_suscriptores):
+        _suscriptores.discard(cola)
+        if not cola.full():
+            cola.put_nowait(None)
+    if _productor is not None:
+        _productor.cancel()
+        try:
+            await _productor
+        except asyncio.CancelledError:
+            pass
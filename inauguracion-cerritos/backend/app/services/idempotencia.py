@@ -0,0 +1,106 @@
+"""Idempotencia de los POST públicos vía cabecera `Idempotency-Key`.
+
+Un reintento del celular (red inestable, doble toque) con la misma llave recibe la
+respuesta original en vez de registrar o girar otra vez. La respuesta se guarda en la
+misma transacción que el registro/giro: si esa transacción no confirma, no queda nada.
+
+Cada llave guarda también la huella (sha256) de la petición: reusarla con otro cuerpo no
+devuelve la respuesta ajena (que puede traer el magic_token de otra persona) sino 422.
+Las llaves vencen a las `idempotencia_ttl_horas`; `trabajar` las purga cada hora.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Type, TypeVar, Union
+
+from pydantic import BaseModel
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..database import AsyncSessionLocal
+from ..models import IdempotencyKey
+
+logger = logging.getLogger("idempotencia")
+
+M = TypeVar("M", bound=BaseModel)
+
+_PURGA_SEGUNDOS = 3600
+
+
+class LlaveReutilizada(Exception):
+    """La llave ya se usó con una petición distinta (main.py la responde con 422)."""
+
+
+def huella(peticion: Union[BaseModel, str]) -> str:
+    """sha256 del cuerpo (o de lo que identifica la petición, p. ej. el token de la ruta)."""
+    datos = peticion.model_dump_json() if isinstance(peticion, BaseModel) else peticion
+    return hashlib.sha256(datos.encode()).hexdigest()
+
+
+def _vence() -> datetime:
+    return datetime.utcnow() - timedelta(hours=settings.idempotencia_ttl_horas)
+
+
+async def buscar(db: AsyncSession, ruta: str, key: Optional[str], firma: str,
+                 modelo: Type[M]) -> Optional[M]:
+    """Respuesta ya entregada para esta llave, o None. LlaveReutilizada si la llave
+    vigente se guardó con otra petición."""
+    if not key:
+        return None
+    guardada = (await db.execute(
+        select(IdempotencyKey.respuesta, IdempotencyKey.huella).where(
+            IdempotencyKey.ruta == ruta, IdempotencyKey.key == key,
+            IdempotencyKey.created_at >= _vence())
+    )).first()
+    if not guardada:
+        return None
+    # Filas anteriores a la huella (NULL) se aceptan hasta que venzan
+    if guardada.huella is not None and guardada.huella != firma:
+        raise LlaveReutilizada()
+    return modelo.model_validate(json.loads(guardada.respuesta))
+
+
+async def guardar(db: AsyncSession, ruta: str, key: Optional[str], firma: str,
+                  respuesta: BaseModel) -> bool:
+    """Reserva la llave con su respuesta. False si otra petición con la misma llave
+    se adelantó (el llamador debe hacer rollback y devolver `buscar`). Una llave
+    vencida que aún no se purgó se reemplaza."""
+    if not key:
+        return True
+    valores = {"respuesta": respuesta.model_dump_json(), "huella": firma,
+               "created_at": datetime.utcnow()}
+    stmt = insert(IdempotencyKey).values(ruta=ruta, key=key, **valores)
+    r = await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[IdempotencyKey.ruta, IdempotencyKey.key],
+            set_=valores,
+            where=IdempotencyKey.created_at < _vence(),
+        ).returning(IdempotencyKey.key)
+    )
+    return r.scalar_one_or_none() is not None
+
+
+async def purgar() -> int:
+    """Borra las llaves vencidas. Devuelve cuántas."""
+    async with AsyncSessionLocal() as db:
+        r = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < _vence()))
+        await db.commit()
+        return r.rowcount
+
+
+async def trabajar() -> None:
+    """Purga periódica (una tarea por proceso, arrancada en el lifespan)."""
+    while True:
+        try:
+            n = await purgar()
+            if n:
+                logger.info("Idempotencia: %d llaves vencidas purgadas", n)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Idempotencia: error al purgar: %s", e)
+        await asyncio.sleep(_PURGA_SEGUNDOS)
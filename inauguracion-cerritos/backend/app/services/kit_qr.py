@@ -0,0 +1,120 @@
+"""Kit imprimible con los QR de todos los canales activos (ZIP de PNGs o PDF).
+
+Cada QR (o página del PDF) se renderiza en el pool de procesos de `services.qr`, en
+paralelo. El kit armado queda en memoria hasta que cambie la lista de canales: la
+firma incluye id, slug, nombre, tipo y orden de cada canal activo.
+"""
+import asyncio
+import hashlib
+import io
+import threading
+import zipfile
+from typing import Dict, List, Sequence, Tuple
+
+import qrcode
+from PIL import Image, ImageDraw, ImageFont
+
+from . import metricas
+from . import qr as qr_svc
+
+FORMATOS = ("zip", "pdf")
+
+# Carta a 150 dpi
+_DPI = 150
+_PAGINA = (1275, 1650)
+_LADO_QR = 1000
+_AZUL = "#0A2E57"
+
+_kits: Dict[str, Tuple[str, bytes]] = {}
+_kits_lock = threading.Lock()
+
+# (id, slug, nombre, tipo, orden) por canal, en el orden del kit
+Canal = Tuple[str, str, str, str, int]
+
+
+def _fuente(tamano: int):
+    try:
+        return ImageFont.load_default(size=tamano)
+    except TypeError:  # Pillow sin FreeType
+        return ImageFont.load_default()
+
+
+def _pagina(contenido: str, nombre: str, subtitulo: str) -> bytes:
+    """Página de póster (PNG) con el QR centrado y el nombre del canal debajo.
+
+    Corre en los procesos del pool: solo recibe y devuelve tipos simples.
+    """
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=2)
+    qr.add_data(contenido)
+    qr.make(fit=True)
+    img_qr = qr.make_image(fill_color=_AZUL, back_color="white").get_image()
+    img_qr = img_qr.convert("RGB").resize((_LADO_QR, _LADO_QR), Image.NEAREST)
+
+    pagina = Image.new("RGB", _PAGINA, "white")
+    x = (_PAGINA[0] - _LADO_QR) // 2
+    y = 220
+    pagina.paste(img_qr, (x, y))
+
+    dibujo = ImageDraw.Draw(pagina)
+    for texto, tamano, alto in (
+        ("Escanea y gira la ruleta", 56, 120),
+        (nombre, 84, y + _LADO_QR + 80),
+        (subtitulo, 48, y + _LADO_QR + 190),
+    ):
+        fuente = _fuente(tamano)
+        ancho = dibujo.textlength(texto, font=fuente)
+        dibujo.text(((_PAGINA[0] - ancho) / 2, alto), texto, fill=_AZUL, font=fuente)
+
+    buf = io.BytesIO()
+    pagina.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _armar_pdf(paginas: Sequence[bytes]) -> bytes:
+    imagenes = [Image.open(io.BytesIO(p)).convert("RGB") for p in paginas]
+    buf = io.BytesIO()
+    imagenes[0].save(buf, format="PDF", save_all=True, append_images=imagenes[1:],
+                     resolution=_DPI, quality=95)
+    return buf.getvalue()
+
+
+def _armar_zip(canales: Sequence[Canal], pngs: Sequence[bytes]) -> bytes:
+    buf = io.BytesIO()
+    # PNG ya viene comprimido: se guarda tal cual
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+        for i, ((_, slug, _, _, _), png) in enumerate(zip(canales, pngs), start=1):
+            zf.writestr(f"{i:02d}-{slug}.png", png)
+    return buf.getvalue()
+
+
+def firma(canales: Sequence[Canal]) -> str:
+    datos = "\n".join("|".join(map(str, c)) for c in canales) + qr_svc.url_canal("")
+    return hashlib.sha256(datos.encode()).hexdigest()
+
+
+async def generar(canales: List[Canal], formato: str) -> bytes:
+    """Kit del formato pedido; reutiliza el anterior si los canales no cambiaron."""
+    clave = firma(canales)
+    with _kits_lock:
+        guardado = _kits.get(formato)
+    if guardado and guardado[0] == clave:
+        return guardado[1]
+
+    loop = asyncio.get_running_loop()
+    with metricas.etapa_duracion.cronometrar(f"qr_kit_{formato}"):
+        if formato == "zip":
+            pngs = await asyncio.gather(
+                *(qr_svc.qr_png_async(qr_svc.url_canal(slug)) for _, slug, _, _, _ in canales))
+            kit = _armar_zip(canales, pngs)
+        else:
+            pool = qr_svc.pool_procesos()
+            paginas = await asyncio.gather(*(
+                loop.run_in_executor(pool, _pagina, qr_svc.url_canal(slug), nombre,
+                                     "Sede" if tipo == "sede" else "Vendedor")
+                for _, slug, nombre, tipo, _ in canales
+            ))
+            kit = await loop.run_in_executor(None, _armar_pdf, paginas)
+
+    with _kits_lock:
+        _kits[formato] = (clave, kit)
+    return kit
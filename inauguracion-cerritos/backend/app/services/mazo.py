@@ -0,0 +1,182 @@
+"""Sorteo por mazo pre-barajado (canales con `sorteo = 'mazo'`).
+
+- Al construir el mazo se materializan TODOS los resultados del canal: una carta por
+  unidad de stock de cada premio y cartas perdedoras en proporción a `probabilidad`.
+- El orden sale de `random.Random(seed).shuffle` sobre las cartas en orden de segmento;
+  `seed_hash` (sha256 del seed) se publica desde el inicio y el seed se revela al cerrar.
+- Cada giro reclama la siguiente carta libre con FOR UPDATE SKIP LOCKED: no hay sorteo
+  ponderado ni lock sobre `prizes`. En este modo el stock real es el del mazo y
+  `stock_restante` se sincroniza desde él al cerrarlo (ver `sincronizar_stock`); mientras
+  está activo, el admin muestra el stock del mazo sin escribirlo (`stock_del_mazo`).
+"""
+import hashlib
+import random
+import secrets
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from ..models import Deck, DeckTicket, Prize
+from . import ruleta as ruleta_svc
+
+class MazoOcupado(Exception):
+    """Quedan cartas, pero todas están tomadas por giros que aún no confirman."""
+
+
+def _repartir(total: int, pesos: List[float]) -> List[int]:
+    """Reparte `total` cartas según `pesos` (método del mayor residuo)."""
+    suma = sum(pesos)
+    if total <= 0 or suma <= 0:
+        return [0] * len(pesos)
+    exactos = [total * w / suma for w in pesos]
+    cuotas = [int(x) for x in exactos]
+    orden = sorted(range(len(pesos)), key=lambda i: exactos[i] - cuotas[i], reverse=True)
+    for i in orden[: total - sum(cuotas)]:
+        cuotas[i] += 1
+    return cuotas
+
+
+def barajar(seed: str, cartas: List[str]) -> List[str]:
+    """Orden auditable del mazo: cualquiera con el seed revelado obtiene el mismo."""
+    mezcladas = list(cartas)
+    random.Random(seed).shuffle(mezcladas)
+    return mezcladas
+
+
+def mazo_activo(db: Session, channel_id: str) -> Optional[Deck]:
+    return (
+        db.query(Deck)
+        .filter(Deck.channel_id == channel_id, Deck.activo.is_(True))
+        .order_by(Deck.created_at.desc())
+        .first()
+    )
+
+
+def ultimo_mazo(db: Session, channel_id: str) -> Optional[Deck]:
+    return db.query(Deck).filter(Deck.channel_id == channel_id).order_by(
+        Deck.created_at.desc()).first()
+
+
+def cerrar(db: Session, deck: Deck) -> None:
+    """Cierra el mazo (revela el seed) y deja el stock de sus premios al día."""
+    sincronizar_stock(db, deck)
+    deck.activo = False
+    deck.cerrado_at = datetime.utcnow()
+    db.flush()
+    ruleta_svc.invalidar_cache(deck.channel_id)
+
+
+def construir(db: Session, channel_id: str) -> Deck:
+    """Crea un mazo nuevo con el stock y las probabilidades actuales del canal.
+
+    Cierra el mazo anterior si lo había. Lanza ValueError si no hay nada que repartir.
+    """
+    anterior = mazo_activo(db, channel_id)
+    if anterior:
+        cerrar(db, anterior)
+
+    premios = (
+        db.query(Prize)
+        .filter(Prize.channel_id == channel_id, Prize.activo.is_(True))
+        .order_by(Prize.orden.asc(), Prize.created_at.asc())
+        .all()
+    )
+    ganables = [p for p in premios if not p.es_perdedor and p.stock_restante > 0]
+    perdedores = [p for p in premios if p.es_perdedor]
+    n_ganables = sum(p.stock_restante for p in ganables)
+    if not n_ganables:
+        raise ValueError("El canal no tiene premios con stock para armar el mazo.")
+
+    # Cartas perdedoras para respetar la proporción ganar/perder prometida.
+    p_gana = sum(max(p.probabilidad, 0.0) for p in ganables)
+    p_pierde = sum(max(p.probabilidad, 0.0) for p in perdedores)
+    n_perdedoras = round(n_ganables * p_pierde / p_gana) if p_gana > 0 else 0
+    cuotas = _repartir(n_perdedoras, [max(p.probabilidad, 0.0) for p in perdedores])
+
+    cartas: List[str] = []
+    for p in premios:
+        if p in ganables:
+            cartas.extend([p.id] * p.stock_restante)
+        elif p in perdedores:
+            cartas.extend([p.id] * cuotas[perdedores.index(p)])
+
+    seed = hashlib.sha256(secrets.token_bytes(32)).hexdigest()
+    deck = Deck(channel_id=channel_id, seed=seed,
+                seed_hash=hashlib.sha256(seed.encode()).hexdigest(), total=len(cartas))
+    db.add(deck)
+    db.flush()
+    db.execute(insert(DeckTicket), [
+        {"deck_id": deck.id, "posicion": i, "prize_id": prize_id}
+        for i, prize_id in enumerate(barajar(seed, cartas))
+    ])
+    ruleta_svc.invalidar_cache(channel_id)
+    return deck
+
+
+def reclamar(db: Session, deck: Deck) -> Optional[DeckTicket]:
+    """Toma la siguiente carta libre sin esperar a otros giros (SKIP LOCKED).
+
+    None solo cuando el mazo se acabó. Si las cartas libres están tomadas por giros en
+    curso lanza MazoOcupado: alguno puede hacer rollback, el llamador puede reintentar.
+    """
+    pendientes = db.query(DeckTicket).filter(
+        DeckTicket.deck_id == deck.id, DeckTicket.spin_id.is_(None))
+    ticket = (
+        pendientes.order_by(DeckTicket.posicion.asc())
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if ticket is None and db.query(pendientes.exists()).scalar():
+        raise MazoOcupado()
+    return ticket
+
+
+def resultado(db: Session, deck: Deck, ticket: DeckTicket):
+    """(premio, server_seed, indice_segmento, segmentos) de una carta, como `elegir_premio`.
+
+    El server_seed del giro es el compromiso del mazo; la posición de la carta queda
+    en `deck_tickets` para la auditoría.
+    """
+    segmentos = ruleta_svc.segmentos_visibles(db, deck.channel_id)
+    for i, p in enumerate(segmentos):
+        if p.id == ticket.prize_id:
+            return p, deck.seed_hash, i, segmentos
+    # Premio desactivado después de armar el mazo: cuenta como "sigue participando".
+    return None, deck.seed_hash, 0, segmentos
+
+
+def pendientes_por_premio(db: Session, deck: Deck) -> Dict[str, int]:
+    rows = (
+        db.query(DeckTicket.prize_id, func.count(DeckTicket.id))
+        .filter(DeckTicket.deck_id == deck.id, DeckTicket.spin_id.is_(None))
+        .group_by(DeckTicket.prize_id)
+        .all()
+    )
+    return {prize_id: n for prize_id, n in rows}
+
+
+def stock_del_mazo(db: Session, deck: Deck) -> Dict[str, int]:
+    """Cartas sin reclamar de cada premio ganable que está en el mazo (0 si ya salieron).
+
+    Los premios que no entraron al mazo (creados o reactivados después) no aparecen.
+    """
+    rows = (
+        db.query(DeckTicket.prize_id,
+                 func.count(DeckTicket.id).filter(DeckTicket.spin_id.is_(None)))
+        .join(Prize, Prize.id == DeckTicket.prize_id)
+        .filter(DeckTicket.deck_id == deck.id, Prize.es_perdedor.is_(False))
+        .group_by(DeckTicket.prize_id)
+        .all()
+    )
+    return {prize_id: n for prize_id, n in rows}
+
+
+def sincronizar_stock(db: Session, deck: Deck) -> None:
+    """`stock_restante` de los premios ganables del mazo = sus cartas aún sin reclamar."""
+    stock = stock_del_mazo(db, deck)
+    if not stock:
+        return
+    for p in db.query(Prize).filter(Prize.id.in_(stock)).all():
+        p.stock_restante = stock[p.id]
@@ -0,0 +1,176 @@
+"""Métricas en memoria con exposición en formato texto de Prometheus (`GET /metrics`).
+
+Sin dependencias: contadores, medidores e histogramas con etiquetas, protegidos por un
+lock cada uno (los usan a la vez el event loop, el threadpool y las tareas de fondo).
+Los valores viven por proceso; con varios workers de uvicorn, Prometheus suma por
+instancia.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Buckets por defecto de Prometheus (segundos)
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CONSULTAS = (1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+_registro: List["_Metrica"] = []
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _etiquetas(nombres: Sequence[str], valores: Sequence[str], extra: str = "") -> str:
+    partes = [f'{n}="{_escapar(str(v))}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _numero(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = ()) -> None:
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+        _registro.append(self)
+
+    def _muestras(self) -> List[str]:
+        raise NotImplementedError
+
+    def exponer(self) -> List[str]:
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}",
+                *self._muestras()]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._valores: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *valores: str, n: float = 1) -> None:
+        with self._lock:
+            self._valores[valores] = self._valores.get(valores, 0) + n
+
+    def _muestras(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._valores.items())
+        return [f"{self.nombre}{_etiquetas(self.etiquetas, k)} {_numero(v)}" for k, v in items]
+
+
+class Medidor(Contador):
+    """Valor que sube y baja (peticiones en curso, conexiones en uso...)."""
+
+    tipo = "gauge"
+
+    def dec(self, *valores: str, n: float = 1) -> None:
+        self.inc(*valores, n=-n)
+
+    def fijar(self, *valores: str, valor: float) -> None:
+        with self._lock:
+            self._valores[valores] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = (),
+                 buckets: Sequence[float] = BUCKETS_SEGUNDOS) -> None:
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        # por etiquetas: [conteos por bucket (no acumulados)..., +Inf], suma
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observar(self, valor: float, *valores: str) -> None:
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = ([0] * (len(self.buckets) + 1), [0.0])
+            serie[0][i] += 1
+            serie[1][0] += valor
+
+    @contextmanager
+    def cronometrar(self, *valores: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - t0, *valores)
+
+    def _muestras(self) -> List[str]:
+        with self._lock:
+            series = sorted((k, list(c), s[0]) for k, (c, s) in self._series.items())
+        lineas = []
+        for k, conteos, suma in series:
+            acumulado = 0
+            for limite, n in zip((*self.buckets, float("inf")), conteos):
+                acumulado += n
+                le = _etiquetas(self.etiquetas, k, f'le="{_numero(limite)}"')
+                lineas.append(f"{self.nombre}_bucket{le} {acumulado}")
+            base = _etiquetas(self.etiquetas, k)
+            lineas.append(f"{self.nombre}_sum{base} {_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{base} {acumulado}")
+        return lineas
+
+
+def exponer() -> str:
+    """Todas las métricas registradas en formato de exposición de texto 0.0.4."""
+    lineas: List[str] = []
+    for m in _registro:
+        lineas.extend(m.exponer())
+    return "\n".join(lineas) + "\n"
+
+
+# ---------------- Métricas de la aplicación ----------------
+http_peticiones = Contador(
+    "cerritos_http_requests_total", "Peticiones HTTP atendidas.", ("method", "route", "status"))
+http_duracion = Histograma(
+    "cerritos_http_request_duration_seconds", "Latencia de las peticiones HTTP.",
+    ("method", "route"))
+http_en_curso = Medidor(
+    "cerritos_http_requests_in_flight", "Peticiones HTTP en curso.", ("method", "route"))
+db_consultas = Histograma(
+    "cerritos_db_queries_per_request", "Sentencias SQL por petición.", ("route",),
+    buckets=BUCKETS_CONSULTAS)
+db_duracion = Histograma(
+    "cerritos_db_seconds_per_request",
+    "Tiempo en la BD por petición (incluye esperas por locks).", ("route",))
+db_pool_en_uso = Medidor(
+    "cerritos_db_pool_checked_out", "Conexiones del pool prestadas.", ("engine",))
+db_locks_en_espera = Medidor(
+    "cerritos_db_lock_waits", "Locks de Postgres pedidos y aún no concedidos (al raspar).")
+etapa_duracion = Histograma(
+    "cerritos_stage_duration_seconds",
+    "Etapas fuera de la BD: render de QR, kit de QR, envíos del outbox.", ("stage",))
+email_latencia = Histograma(
+    "cerritos_email_outbox_latency_seconds",
+    "Desde que se encola un correo hasta que sale (incluye reintentos).", ("tipo",),
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300, 900, 3600))
+email_conexiones = Contador(
+    "cerritos_email_connections_total",
+    "Conexiones de correo abiertas (TLS + login); con el pool deberían ser pocas.",
+    ("transport",))
+email_envio_duracion = Histograma(
+    "cerritos_email_send_seconds", "Intentos de envío de correo por transporte y plantilla.",
+    ("transport", "template", "result"))
+email_envio_bytes = Histograma(
+    "cerritos_email_payload_bytes",
+    "Tamaño del mensaje enviado (JSON de SendGrid o MIME de SMTP, con el QR).",
+    ("transport", "template"),
+    buckets=(2_000, 5_000, 10_000, 20_000, 50_000, 100_000, 200_000, 500_000, 1_000_000))
+email_circuito_abierto = Medidor(
+    "cerritos_email_circuit_open", "1 si el circuito del transporte de correo está abierto.",
+    ("transport",))
@@ -0,0 +1,298 @@
+"""Outbox de correos: se escriben en `email_outbox` junto con el registro/giro y un
+worker los envía en segundo plano.
+
+- Un correo que no alcanzó a salir sobrevive a un reinicio del contenedor.
+- El worker reclama lotes con FOR UPDATE SKIP LOCKED y los "alquila" (corre
+  `proximo_intento`): varios workers de uvicorn no se pisan y si uno muere a mitad de
+  envío el correo vuelve a la cola al vencer el alquiler.
+- Concurrencia acotada (`EMAIL_CONCURRENCIA`), backoff exponencial con jitter y estado
+  `muerto` tras `EMAIL_MAX_INTENTOS`.
+- Modo resumen (`EMAIL_RESUMEN_MINUTOS` > 0): los avisos a la tienda esperan y salen en
+  un solo correo cada N minutos o al juntar `EMAIL_RESUMEN_MAX_EVENTOS`; los premios
+  pueden seguir saliendo al instante (`EMAIL_RESUMEN_PREMIO_INMEDIATO`).
+"""
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..database import AsyncSessionLocal
+from ..models import EmailOutbox
+from . import email as email_svc
+from . import metricas
+from . import qr as qr_svc
+
+logger = logging.getLogger("outbox")
+
+_ALQUILER = timedelta(minutes=5)  # tiempo máximo de un envío antes de re-entregarlo
+_ESPERA_VACIA = 2.0  # segundos entre sondeos con la cola vacía
+_TOPE_BACKOFF = 3600
+
+_despertador: Optional[asyncio.Event] = None
+
+
+# ---------------- Encolar (en la transacción del llamador) ----------------
+def _lead(lead) -> dict:
+    return {
+        "nombre": lead.nombre, "telefono": lead.telefono, "correo": lead.correo,
+        "cedula": lead.cedula, "direccion": lead.direccion, "coupon_code": lead.coupon_code,
+        "referral_code": lead.referral_code, "referred_by": lead.referred_by,
+    }
+
+
+def cupon(lead, qr_token: str) -> dict:
+    return _mensaje("cupon", lead.correo, {"nombre": lead.nombre, "code": lead.coupon_code},
+                    qr_token)
+
+
+def premio(lead, premio_nombre: str, qr_token: str) -> dict:
+    return _mensaje("premio", lead.correo, {"nombre": lead.nombre, "premio": premio_nombre},
+                    qr_token)
+
+
+def notif_registro(lead) -> dict:
+    return _mensaje("notif_registro", settings.store_notify_email, {"lead": _lead(lead)})
+
+
+def notif_premio(lead, premio_nombre: str) -> dict:
+    return _mensaje("notif_premio", settings.store_notify_email,
+                    {"lead": _lead(lead), "premio": premio_nombre})
+
+
+def _mensaje(tipo: str, destinatario: str, datos: dict,
+             qr_token: Optional[str] = None) -> dict:
+    if qr_token:
+        datos["qr_token"] = qr_token
+    return {"tipo": tipo, "destinatario": destinatario,
+            "datos": json.dumps(datos, ensure_ascii=False),
+            "qr_contenido": qr_svc.url_validar(qr_token) if qr_token else None}
+
+
+async def encolar(db: AsyncSession, *mensajes: dict) -> None:
+    """Inserta los correos en la transacción abierta (un solo INSERT)."""
+    await db.execute(insert(EmailOutbox), list(mensajes))
+
+
+def despertar() -> None:
+    """Avisa al worker de este proceso que hay correos nuevos (tras el commit)."""
+    if _despertador is not None:
+        _despertador.set()
+
+
+# ---------------- Worker ----------------
+def _llamar(tipo: str, destinatario: str, datos: dict, qr_png: Optional[bytes],
+            qr_url: Optional[str]) -> bool:
+    if tipo == "cupon":
+        return email_svc.enviar_cupon(destinatario, datos["nombre"], datos["code"], qr_png,
+                                      qr_url)
+    if tipo == "premio":
+        return email_svc.enviar_premio(destinatario, datos["nombre"], datos["premio"], qr_png,
+                                       qr_url)
+    if tipo == "notif_registro":
+        return email_svc.notificar_registro(SimpleNamespace(**datos["lead"]))
+    if tipo == "notif_premio":
+        return email_svc.notificar_premio(SimpleNamespace(**datos["lead"]), datos["premio"])
+    raise ValueError(f"Tipo de correo desconocido: {tipo}")
+
+
+def _backoff(intentos: int) -> timedelta:
+    base = min(settings.email_reintento_base_seconds * 2 ** (intentos - 1), _TOPE_BACKOFF)
+    return timedelta(seconds=base * random.uniform(0.8, 1.2))
+
+
+def _tipos_resumen() -> tuple:
+    """Tipos que esperan al resumen periódico en vez de salir uno por uno."""
+    if settings.email_resumen_minutos <= 0:
+        return ()
+    if settings.email_resumen_premio_inmediato:
+        return ("notif_registro",)
+    return ("notif_registro", "notif_premio")
+
+
+async def _reclamar(limite: int, *, tipos: tuple = (), excluir: tuple = ()) -> List[EmailOutbox]:
+    ahora = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        libres = (
+            select(EmailOutbox.id)
+            .where(EmailOutbox.estado == "pendiente", EmailOutbox.proximo_intento <= ahora)
+            .order_by(EmailOutbox.proximo_intento)
+            .limit(limite)
+            .with_for_update(skip_locked=True)
+        )
+        if tipos:
+            libres = libres.where(EmailOutbox.tipo.in_(tipos))
+        if excluir:
+            libres = libres.where(EmailOutbox.tipo.not_in(excluir))
+        filas = (await db.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id.in_(libres.scalar_subquery()))
+            .values(proximo_intento=ahora + _ALQUILER)
+            .returning(EmailOutbox)
+        )).scalars().all()
+        await db.commit()
+        return list(filas)
+
+
+def _resultado(msg: EmailOutbox, ok: bool, error: Optional[str]) -> dict:
+    """Valores a guardar en la fila tras un intento de envío."""
+    ahora = datetime.utcnow()
+    valores: dict = {"intentos": msg.intentos + 1}
+    if ok:
+        valores.update(estado="enviado", enviado_at=ahora, ultimo_error=None)
+        metricas.email_latencia.observar((ahora - msg.created_at).total_seconds(), msg.tipo)
+    elif valores["intentos"] >= settings.email_max_intentos:
+        valores.update(estado="muerto", ultimo_error=error)
+        logger.error("Correo %s (%s) sin enviar tras %s intentos: %s",
+                     msg.id, msg.tipo, valores["intentos"], error)
+    else:
+        valores.update(proximo_intento=ahora + _backoff(valores["intentos"]),
+                       ultimo_error=error)
+    return valores
+
+
+async def _guardar(resultados: List[dict]) -> None:
+    async with AsyncSessionLocal() as db:
+        # UPDATE por llave primaria en lote (una sentencia por forma de fila)
+        await db.execute(update(EmailOutbox), resultados)
+        await db.commit()
+
+
+async def _procesar(msg: EmailOutbox) -> None:
+    if not email_svc.configurado():
+        valores = {"intentos": msg.intentos + 1, "estado": "omitido",
+                   "ultimo_error": "Sin transporte de correo configurado."}
+    else:
+        try:
+            datos = json.loads(msg.datos)
+            qr_png = qr_url = None
+            if settings.email_qr_alojado and datos.get("qr_token"):
+                # El cliente de correo pide la imagen al abrir: no se renderiza ni se adjunta
+                qr_url = qr_svc.url_alojado(datos["qr_token"])
+            elif msg.qr_contenido:
+                qr_png = await qr_svc.qr_png_async(msg.qr_contenido)
+            with metricas.etapa_duracion.cronometrar("email_outbox"):
+                ok = await run_in_threadpool(
+                    _llamar, msg.tipo, msg.destinatario, datos, qr_png, qr_url)
+            error = None if ok else "Ningún transporte aceptó el correo (fallo o circuito abierto)."
+        except Exception as e:  # noqa: BLE001
+            ok, error = False, str(e)[:500]
+        valores = _resultado(msg, ok, error)
+    await _guardar([{"id": msg.id, **valores}])
+
+
+async def _toca_resumen(tipos: tuple) -> bool:
+    """Hay M avisos acumulados o el más viejo ya esperó N minutos."""
+    async with AsyncSessionLocal() as db:
+        n, mas_viejo = (await db.execute(
+            select(func.count(), func.min(EmailOutbox.created_at)).where(
+                EmailOutbox.estado == "pendiente", EmailOutbox.tipo.in_(tipos),
+                EmailOutbox.proximo_intento <= datetime.utcnow(),
+            )
+        )).one()
+    if not n:
+        return False
+    limite = datetime.utcnow() - timedelta(minutes=settings.email_resumen_minutos)
+    return n >= settings.email_resumen_max_eventos or mas_viejo <= limite
+
+
+async def _procesar_resumen() -> bool:
+    """Envía un resumen de avisos a la tienda si toca. True si reclamó filas."""
+    tipos = _tipos_resumen()
+    if not tipos or not await _toca_resumen(tipos):
+        return False
+    lote = await _reclamar(settings.email_resumen_max_eventos, tipos=tipos)
+    if not lote:
+        return False
+    if not email_svc.configurado():
+        await _guardar([
+            {"id": m.id, "intentos": m.intentos + 1, "estado": "omitido",
+             "ultimo_error": "Sin transporte de correo configurado."} for m in lote
+        ])
+        return True
+    eventos = [(m.created_at, m.tipo, json.loads(m.datos)) for m in lote]
+    try:
+        with metricas.etapa_duracion.cronometrar("email_outbox"):
+            ok = await run_in_threadpool(email_svc.notificar_resumen, eventos)
+        error = None if ok else "Ningún transporte aceptó el correo (fallo o circuito abierto)."
+    except Exception as e:  # noqa: BLE001
+        ok, error = False, str(e)[:500]
+    await _guardar([{"id": m.id, **_resultado(m, ok, error)} for m in lote])
+    return True
+
+
+async def trabajar() -> None:
+    """Bucle del worker (una tarea por proceso, arrancada en el lifespan)."""
+    global _despertador
+    _despertador = asyncio.Event()
+    while True:
+        try:
+            resumen = await _procesar_resumen()
+            lote = await _reclamar(settings.email_concurrencia, excluir=_tipos_resumen())
+            if lote:
+                await asyncio.gather(*(_procesar(m) for m in lote))
+            if lote or resumen:
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # noqa: BLE001
+            logger.warning("Outbox: error al drenar la cola: %s", e)
+        try:
+            await asyncio.wait_for(_despertador.wait(), timeout=_ESPERA_VACIA)
+        except asyncio.TimeoutError:
+            pass
+        _despertador.clear()
+
+
+# ---------------- Estado para el admin ----------------
+async def estado(db: AsyncSession) -> dict:
+    """Profundidad por estado, antigüedad del pendiente más viejo y latencia de envío
+    (creación -> enviado) de la última hora."""
+    por_estado = dict((await db.execute(
+        select(EmailOutbox.estado, func.count()).group_by(EmailOutbox.estado)
+    )).all())
+    hace_una_hora = datetime.utcnow() - timedelta(hours=1)
+    latencia = func.extract("epoch", EmailOutbox.enviado_at - EmailOutbox.created_at)
+    fila = (await db.execute(
+        select(
+            select(func.min(EmailOutbox.created_at))
+            .where(EmailOutbox.estado == "pendiente").scalar_subquery(),
+            func.count(),
+            func.percentile_cont(0.5).within_group(latencia),
+            func.percentile_cont(0.95).within_group(latencia),
+            func.max(latencia),
+        ).where(EmailOutbox.estado == "enviado", EmailOutbox.enviado_at >= hace_una_hora)
+    )).one()
+    mas_viejo, enviados, p50, p95, maximo = fila
+    return {
+        "pendientes": por_estado.get("pendiente", 0),
+        "enviados": por_estado.get("enviado", 0),
+        "muertos": por_estado.get("muerto", 0),
+        "omitidos": por_estado.get("omitido", 0),
+        "pendiente_mas_viejo_s": (
+            round((datetime.utcnow() - mas_viejo).total_seconds(), 1) if mas_viejo else None),
+        "ultima_hora": {
+            "enviados": enviados,
+            "latencia_p50_s": round(p50, 2) if p50 is not None else None,
+            "latencia_p95_s": round(p95, 2) if p95 is not None else None,
+            "latencia_max_s": round(float(maximo), 2) if maximo is not None else None,
+        },
+    }
+
+
+async def reintentar_muertos(db: AsyncSession) -> int:
+    """Devuelve los correos muertos a la cola con los intentos en cero."""
+    r = await db.execute(
+        update(EmailOutbox).where(EmailOutbox.estado == "muerto")
+        .values(estado="pendiente", intentos=0, proximo_intento=datetime.utcnow())
+    )
+    await db.commit()
+    despertar()
+    return r.rowcount
@@ -1,13 +1,29 @@
-"""Generación y verificación de QRs firmados con JWT (HS256)."""
+"""Generación y verificación de QRs firmados con JWT (HS256).
+
+Los QR se guardan en una caché LRU por (motor, contenido) -el contenido es la URL con
+el token- junto con su ETag: un reenvío o un póster escaneado otra vez no vuelve a
+renderizar. `qr_png_async` renderiza en un pool de procesos acotado para no ocupar el
+event loop ni el threadpool con la construcción de la matriz y el PNG.
+"""
+import asyncio
 import base64
+import hashlib
+import hmac
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 import jwt
 import qrcode
+from PIL import Image
 
 from ..config import settings
+from . import metricas
 
 
 def _encode(payload: dict) -> str:
@@ -51,30 +67,214 @@ def verificar(token: str, tipo_esperado: str) -> Optional[dict]:
         return None
 
 
-def qr_data_uri(contenido: str) -> str:
-    """Genera un PNG del QR y lo devuelve como data URI base64 (para email/HTML)."""
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=8,
-        border=2,
-    )
+# ---------------- Render ----------------
+# "png": RGB de qrcode.make (el de siempre). "png1": PNG de paleta a 1 bit (blanco /
+# azul marca), ~4-6 veces más liviano. "svg": un solo <path>, para pantallas/impresión.
+MOTORES = ("png", "png1", "svg")
+MEDIA_TYPES = {"png": "image/png", "png1": "image/png", "svg": "image/svg+xml"}
+# Píxeles por módulo y zona de silencio (módulos) de los motores compactos. 4 módulos
+# de borde es lo que pide la norma; con menos algunos lectores de caja fallan.
+CAJA = 8
+BORDE = 4
+_AZUL = (0x0A, 0x2E, 0x57)
+
+
+def _matriz(contenido: str, borde: int) -> list:
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=borde)
     qr.add_data(contenido)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="#0A2E57", back_color="white")
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    b64 = base64.b64encode(buf.getvalue()).decode()
-    return f"data:image/png;base64,{b64}"
+    return qr.get_matrix()
 
 
-def qr_png_bytes(contenido: str) -> bytes:
-    qr = qrcode.make(contenido)
+def _svg(m: list) -> str:
+    """SVG mínimo: un solo <path> con un rectángulo por tramo de módulos oscuros."""
+    n = len(m)
+    tramos = []
+    for y, fila in enumerate(m):
+        x = 0
+        while x < n:
+            if fila[x]:
+                inicio = x
+                while x < n and fila[x]:
+                    x += 1
+                tramos.append(f"M{inicio} {y}h{x - inicio}v1h-{x - inicio}z")
+            else:
+                x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {n} {n}" '
+        f'width="{n * CAJA}" height="{n * CAJA}" shape-rendering="crispEdges">'
+        f'<rect width="{n}" height="{n}" fill="#fff"/>'
+        f'<path fill="#0A2E57" d="{"".join(tramos)}"/></svg>'
+    )
+
+
+def _render(contenido: str, motor: str) -> bytes:
+    """Render puro (corre en los procesos del pool)."""
     buf = BytesIO()
-    qr.save(buf, format="PNG")
+    if motor == "png1":
+        m = _matriz(contenido, BORDE)
+        n = len(m)
+        img = Image.new("P", (n, n), 0)
+        img.putpalette([255, 255, 255, *_AZUL])
+        img.putdata([1 if c else 0 for fila in m for c in fila])
+        img = img.resize((n * CAJA, n * CAJA), Image.NEAREST)
+        img.save(buf, format="PNG", bits=1, optimize=True)
+    elif motor == "svg":
+        buf.write(_svg(_matriz(contenido, BORDE)).encode())
+    elif motor == "png":
+        qrcode.make(contenido).save(buf, format="PNG")
+    else:
+        raise ValueError(f"Motor de QR desconocido: {motor}")
     return buf.getvalue()
 
 
+# ---------------- Caché LRU + pool de procesos ----------------
+_png_cache: "OrderedDict[Tuple[str, str], Tuple[bytes, str]]" = OrderedDict()
+_png_lock = threading.Lock()
+_en_curso: Dict[Tuple[str, str], "asyncio.Future[bytes]"] = {}
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _cache_get(clave: Tuple[str, str]) -> Optional[Tuple[bytes, str]]:
+    with _png_lock:
+        item = _png_cache.get(clave)
+        if item is not None:
+            _png_cache.move_to_end(clave)
+        return item
+
+
+def _cache_put(clave: Tuple[str, str], datos: bytes) -> Tuple[bytes, str]:
+    """Guarda el render con su ETag fuerte (hash de los bytes)."""
+    item = (datos, f'"{hashlib.sha256(datos).hexdigest()[:32]}"')
+    with _png_lock:
+        _png_cache[clave] = item
+        _png_cache.move_to_end(clave)
+        while len(_png_cache) > settings.qr_cache_items:
+            _png_cache.popitem(last=False)
+    return item
+
+
+def olvidar(contenido: str) -> None:
+    """Saca un QR de la caché en todos los motores (p. ej. canal renombrado o eliminado)."""
+    with _png_lock:
+        for motor in MOTORES:
+            _png_cache.pop((motor, contenido), None)
+
+
+def pool_procesos() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: el servidor ya tiene hilos y conexiones abiertas, no se hace fork
+            _pool = ProcessPoolExecutor(max_workers=settings.qr_workers,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def cerrar_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def qr_etag(contenido: str, motor: Optional[str] = None) -> Tuple[bytes, str]:
+    """(bytes, ETag) del QR renderizado en el hilo actual (con caché).
+
+    Sin `motor` usa el PNG configurado (`QR_PNG_MOTOR`).
+    """
+    motor = motor or settings.qr_png_motor
+    item = _cache_get((motor, contenido))
+    if item is None:
+        with metricas.etapa_duracion.cronometrar(f"qr_{motor}"):
+            datos = _render(contenido, motor)
+        item = _cache_put((motor, contenido), datos)
+    return item
+
+
+def qr_png_bytes(contenido: str) -> bytes:
+    """PNG del QR renderizado en el hilo actual (con caché)."""
+    return qr_etag(contenido)[0]
+
+
+def qr_data_uri(contenido: str) -> str:
+    """PNG del QR como data URI base64 (para email/HTML)."""
+    b64 = base64.b64encode(qr_png_bytes(contenido)).decode()
+    return f"data:image/png;base64,{b64}"
+
+
+async def qr_png_async(contenido: str) -> bytes:
+    """PNG del QR renderizado en el pool de procesos (con caché).
+
+    Peticiones simultáneas del mismo contenido esperan un único render.
+    """
+    clave = (settings.qr_png_motor, contenido)
+    item = _cache_get(clave)
+    if item is not None:
+        return item[0]
+    pendiente = _en_curso.get(clave)
+    if pendiente is not None:
+        return await asyncio.shield(pendiente)
+
+    loop = asyncio.get_running_loop()
+    futuro = _en_curso[clave] = loop.create_future()
+    try:
+        with metricas.etapa_duracion.cronometrar(f"qr_{clave[0]}_pool"):
+            try:
+                png = await loop.run_in_executor(pool_procesos(), _render, contenido, clave[0])
+            except BrokenProcessPool:
+                # Un proceso del pool murió: se recrea en el próximo uso
+                cerrar_pool()
+                png = await loop.run_in_executor(None, _render, contenido, clave[0])
+        _cache_put(clave, png)
+        futuro.set_result(png)
+        return png
+    except asyncio.CancelledError:
+        futuro.cancel()
+        raise
+    except Exception as e:
+        futuro.set_exception(e)
+        futuro.exception()  # marcado como leído si nadie más lo esperaba
+        raise
+    finally:
+        _en_curso.pop(clave, None)
+
+
+def url_registro() -> str:
+    """QR fijo hacia el formulario de registro."""
+    return f"{settings.public_base_url}/registro"
+
+
+def url_canal(slug: str) -> str:
+    """QR de un canal (sede/vendedor) hacia su ruleta."""
+    return f"{settings.public_base_url}/girar/{slug}"
+
+
 def url_validar(token: str) -> str:
     """URL corta que abre la página de validación al escanear el QR."""
     return f"{settings.public_base_url}/validar?t={token}"
+
+
+def _firma_alojado(token: str) -> str:
+    mac = hmac.new(settings.jwt_secret.encode(), b"qr-alojado:" + token.encode(),
+                   hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac[:12]).decode()
+
+
+def url_alojado(token: str) -> str:
+    """Imagen del QR de un cupón/premio servida por el backend (`/qr/t/{token}.{firma}.png`).
+
+    La firma evita que se pidan QR de tokens inventados; el PNG se renderiza recién
+    cuando el cliente de correo abre el mensaje.
+    """
+    return f"{settings.api_base_url}/qr/t/{token}.{_firma_alojado(token)}.png"
+
+
+def token_alojado(firmado: str) -> Optional[str]:
+    """Token de canje de `url_alojado` si la firma es válida."""
+    token, _, firma = firmado.rpartition(".")
+    if token and hmac.compare_digest(firma, _firma_alojado(token)):
+        return token
+    return None
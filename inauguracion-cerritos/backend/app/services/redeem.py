@@ -5,6 +5,7 @@ from urllib.parse import parse_qs, urlparse
 from sqlalchemy.orm import Session
 
 from ..models import Lead, Prize, Spin
+from . import contadores as contadores_svc
 
 
 def extraer_token(raw: str) -> str:
@@ -87,6 +88,7 @@ def canjear(db: Session, token: str, admin_email: str) -> dict:
         obj.redeemed = True
         obj.redeemed_at = datetime.utcnow()
         obj.redeemed_by = admin_email
+        db.execute(contadores_svc.sumar(obj.channel_id, premios_entregados=1))
         db.commit()
         return {"valido": True, "ya_redimido": False, "tipo": "premio",
                 "mensaje": "✅ Premio válido. Entrégalo al cliente.", "premio": titulo,
@@ -101,6 +103,7 @@ def canjear(db: Session, token: str, admin_email: str) -> dict:
     obj.coupon_redeemed = True
     obj.coupon_redeemed_at = datetime.utcnow()
     obj.coupon_redeemed_by = admin_email
+    db.execute(contadores_svc.sumar(cupones_usados=1))
     db.commit()
     return {"valido": True, "ya_redimido": False, "tipo": "cupon",
             "mensaje": "✅ Cupón 10% válido. Aplica el descuento.",
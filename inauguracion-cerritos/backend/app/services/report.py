@@ -1,14 +1,25 @@
-"""Genera un reporte ejecutivo en Excel (.xlsx) con formato premium."""
+"""Genera un reporte ejecutivo en Excel (.xlsx) con formato premium.
+
+El libro se escribe en modo `write_only` de openpyxl: cada fila se vuelca a disco al
+agregarla, las filas salen de la BD por cursores del lado del servidor (`yield_per`) y
+los formatos son estilos con nombre registrados una vez por libro. El .xlsx terminado
+queda en un archivo temporal que el endpoint envía por trozos, así que la memoria no
+crece con la cantidad de participantes o giros.
+"""
 from datetime import datetime
-from io import BytesIO
+from itertools import groupby
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterator, List, Optional, Sequence, Union
 
 from openpyxl import Workbook
-from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
 from openpyxl.utils import get_column_letter
 from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from ..models import Channel, Lead, Prize, Spin
+from . import contadores as contadores_svc
 
 NAVY = "FF0A2E57"
 NAVY_LIGHT = "FF12386B"
@@ -24,287 +35,325 @@ RED_SOFT = "FFFBE7E6"
 thin = Side(style="thin", color="FFD5DEE8")
 BORDER = Border(left=thin, right=thin, top=thin, bottom=thin)
 
-
-def _title(ws, text, ncols):
-    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=ncols)
-    c = ws.cell(row=1, column=1, value=text)
-    c.font = Font(bold=True, size=16, color=WHITE)
-    c.fill = PatternFill("solid", fgColor=NAVY)
-    c.alignment = Alignment(horizontal="left", vertical="center", indent=1)
-    ws.row_dimensions[1].height = 34
-    ws.merge_cells(start_row=2, start_column=1, end_row=2, end_column=ncols)
-    s = ws.cell(row=2, column=1,
-                value=f"Tienda Pintuco Cerritos · Generado {datetime.utcnow():%Y-%m-%d %H:%M} UTC")
-    s.font = Font(size=9, italic=True, color=NAVY_LIGHT)
-    s.fill = PatternFill("solid", fgColor=LIGHT)
-    ws.row_dimensions[2].height = 18
-
-
-def _band(ws, row, text, ncols, color=NAVY_LIGHT):
-    """Franja de sección dentro de una hoja."""
-    ws.merge_cells(start_row=row, start_column=1, end_row=row, end_column=ncols)
-    c = ws.cell(row=row, column=1, value=text)
-    c.font = Font(bold=True, size=12, color=WHITE)
-    c.fill = PatternFill("solid", fgColor=color)
-    c.alignment = Alignment(horizontal="left", vertical="center", indent=1)
-    ws.row_dimensions[row].height = 24
-
-
-def _header(ws, row, headers, color=NAVY_LIGHT):
-    for j, h in enumerate(headers, start=1):
-        c = ws.cell(row=row, column=j, value=h)
-        c.font = Font(bold=True, color=WHITE, size=11)
-        c.fill = PatternFill("solid", fgColor=color)
-        c.alignment = Alignment(horizontal="center", vertical="center")
-        c.border = BORDER
-    ws.row_dimensions[row].height = 22
-
-
-def _autosize(ws, widths):
-    for j, w in enumerate(widths, start=1):
-        ws.column_dimensions[get_column_letter(j)].width = w
-
-
-def _kpi(ws, row, col, label, value, color):
-    lc = ws.cell(row=row, column=col, value=label)
-    lc.font = Font(size=10, color=NAVY_LIGHT, bold=True)
-    lc.alignment = Alignment(horizontal="center")
-    vc = ws.cell(row=row + 1, column=col, value=value)
-    vc.font = Font(size=20, bold=True, color=WHITE)
-    vc.fill = PatternFill("solid", fgColor=color)
-    vc.alignment = Alignment(horizontal="center", vertical="center")
-    vc.border = BORDER
-    ws.row_dimensions[row + 1].height = 38
-
-
-def _si_no(ws, cell, es_si):
-    cell.alignment = Alignment(horizontal="center")
-    if es_si:
-        cell.value = "SÍ"
-        cell.font = Font(bold=True, color=GREEN)
-        cell.fill = PatternFill("solid", fgColor=GREEN_SOFT)
-    else:
-        cell.value = "Pendiente"
-        cell.font = Font(bold=True, color=RED)
-        cell.fill = PatternFill("solid", fgColor=RED_SOFT)
+_LOTE = 2000  # filas por viaje del cursor del servidor
+_SPOOL = 8 * 1024 * 1024  # el .xlsx se queda en memoria hasta 8 MB; más grande, a disco
+_TROZO = 64 * 1024
+
+_CENTRO = Alignment(horizontal="center")
+_BANDA = Alignment(horizontal="left", vertical="center", indent=1)
+
+
+def _solido(color: str) -> PatternFill:
+    return PatternFill("solid", fgColor=color)
+
+
+def _estilos() -> List[NamedStyle]:
+    """Formatos del reporte. Se crean por libro (openpyxl los ata al registrarlos)."""
+    estilos = [
+        NamedStyle("titulo", font=Font(bold=True, size=16, color=WHITE), fill=_solido(NAVY),
+                   alignment=_BANDA),
+        NamedStyle("subtitulo", font=Font(size=9, italic=True, color=NAVY_LIGHT),
+                   fill=_solido(LIGHT)),
+        NamedStyle("encabezado", font=Font(bold=True, color=WHITE, size=11),
+                   fill=_solido(NAVY_LIGHT), border=BORDER,
+                   alignment=Alignment(horizontal="center", vertical="center")),
+        NamedStyle("kpi_etiqueta", font=Font(size=10, color=NAVY_LIGHT, bold=True),
+                   alignment=_CENTRO),
+        NamedStyle("celda", border=BORDER),
+        NamedStyle("celda_centro", border=BORDER, alignment=_CENTRO),
+        NamedStyle("celda_zebra", border=BORDER, fill=_solido(LIGHT)),
+        NamedStyle("celda_zebra_centro", border=BORDER, fill=_solido(LIGHT), alignment=_CENTRO),
+        NamedStyle("si", font=Font(bold=True, color=GREEN), fill=_solido(GREEN_SOFT),
+                   border=BORDER, alignment=_CENTRO),
+        NamedStyle("pendiente", font=Font(bold=True, color=RED), fill=_solido(RED_SOFT),
+                   border=BORDER, alignment=_CENTRO),
+        NamedStyle("nota", font=Font(italic=True, color=NAVY_LIGHT)),
+    ]
+    for color in (NAVY, NAVY_LIGHT, ORANGE):
+        estilos.append(NamedStyle(f"banda_{color}", font=Font(bold=True, size=12, color=WHITE),
+                                  fill=_solido(color), alignment=_BANDA))
+    for color in (NAVY, NAVY_LIGHT, GREEN, RED, ORANGE):
+        estilos.append(NamedStyle(
+            f"kpi_{color}", font=Font(size=20, bold=True, color=WHITE), fill=_solido(color),
+            border=BORDER, alignment=Alignment(horizontal="center", vertical="center")))
+    return estilos
+
+
+class _Hoja:
+    """Hoja de solo escritura que se llena de arriba abajo, fila por fila."""
+
+    def __init__(self, wb: Workbook, nombre: str, anchos: Sequence[int],
+                 congelar: Optional[str] = None) -> None:
+        self.ws = wb.create_sheet(nombre)
+        self.ws.sheet_view.showGridLines = False
+        # Anchos y paneles van en el encabezado del XML: antes de la primera fila
+        for j, w in enumerate(anchos, start=1):
+            self.ws.column_dimensions[get_column_letter(j)].width = w
+        if congelar:
+            self.ws.freeze_panes = congelar
+        self.fila = 0
+
+    def agregar(self, valores: Sequence, estilos: Union[str, Sequence[str], None] = None,
+                alto: Optional[float] = None) -> None:
+        self.fila += 1
+        if alto:
+            self.ws.row_dimensions[self.fila].height = alto
+        if estilos is None:
+            self.ws.append(list(valores))
+            return
+        if isinstance(estilos, str):
+            estilos = [estilos] * len(valores)
+        celdas = []
+        for v, estilo in zip(valores, estilos):
+            c = WriteOnlyCell(self.ws, value=v)
+            c.style = estilo
+            celdas.append(c)
+        self.ws.append(celdas)
+
+    def vacia(self) -> None:
+        self.agregar([])
+
+    def _unir(self, ncols: int) -> None:
+        self.ws.merged_cells.add(f"A{self.fila}:{get_column_letter(ncols)}{self.fila}")
+
+    def titulo(self, text: str, ncols: int) -> None:
+        self.agregar([text], "titulo", alto=34)
+        self._unir(ncols)
+        self.agregar(
+            [f"Tienda Pintuco Cerritos · Generado {datetime.utcnow():%Y-%m-%d %H:%M} UTC"],
+            "subtitulo", alto=18)
+        self._unir(ncols)
+
+    def banda(self, text: str, ncols: int, color: str = NAVY_LIGHT) -> None:
+        """Franja de sección dentro de una hoja."""
+        self.agregar([text], f"banda_{color}", alto=24)
+        self._unir(ncols)
+
+    def encabezado(self, headers: Sequence[str]) -> None:
+        self.agregar(headers, "encabezado", alto=22)
+
+    def kpis(self, items: Sequence[tuple]) -> None:
+        """Fila de etiquetas y debajo la de valores: [(etiqueta, valor, color), ...]."""
+        self.agregar([e for e, _, _ in items], "kpi_etiqueta")
+        self.agregar([v for _, v, _ in items], [f"kpi_{c}" for _, _, c in items], alto=38)
+
+    def nota(self, text: str) -> None:
+        self.agregar([text], "nota")
+
+
+def _si_no(es_si: bool) -> tuple:
+    return ("SÍ", "si") if es_si else ("Pendiente", "pendiente")
 
 
 def _fecha(dt):
     return dt.strftime("%Y-%m-%d %H:%M") if dt else ""
 
 
-def generar_reporte(db: Session) -> bytes:
-    wb = Workbook()
-
-    # Métricas base
-    total_part = db.query(func.count(Lead.id)).scalar() or 0
-    total_giros = db.query(func.count(Spin.id)).scalar() or 0
-    ganados = db.query(func.count(Spin.id)).filter(Spin.gano.is_(True)).scalar() or 0
-    prem_entregados = db.query(func.count(Spin.id)).filter(Spin.redeemed.is_(True)).scalar() or 0
+def _escribir(db: Session, wb: Workbook) -> None:
+    # Métricas base (contadores mantenidos en cada evento, sin recontar leads/spins)
+    tot = contadores_svc.totales(db)
+    total_part = tot["participantes"]
+    total_giros = tot["giros"]
+    ganados = tot["premios_ganados"]
+    prem_entregados = tot["premios_entregados"]
     disponibles = db.query(func.coalesce(func.sum(Prize.stock_restante), 0)).filter(
         Prize.activo.is_(True), Prize.es_perdedor.is_(False)).scalar() or 0
     conv = round((total_giros / total_part * 100), 1) if total_part else 0.0
-    referidos = db.query(func.count(Lead.id)).filter(Lead.referred_by.isnot(None)).scalar() or 0
-    cup_usados = db.query(func.count(Lead.id)).filter(Lead.coupon_redeemed.is_(True)).scalar() or 0
+    referidos = tot["referidos"]
+    cup_usados = tot["cupones_usados"]
     cup_pend = total_part - cup_usados
     prem_pend = ganados - prem_entregados
 
     # ---------- Hoja 1: Resumen ----------
-    ws = wb.active
-    ws.title = "Resumen"
-    ws.sheet_view.showGridLines = False
-    _title(ws, "📊 REPORTE EJECUTIVO — INAUGURACIÓN", 6)
-
-    _kpi(ws, 4, 1, "PARTICIPANTES", total_part, NAVY)
-    _kpi(ws, 4, 2, "GIROS", total_giros, NAVY_LIGHT)
-    _kpi(ws, 4, 3, "CONVERSIÓN", f"{conv}%", GREEN)
-    _kpi(ws, 4, 4, "PREMIOS GANADOS", ganados, RED)
-
-    _band(ws, 7, "🏆 PREMIOS", 4, NAVY)
-    _kpi(ws, 8, 1, "GANADOS", ganados, NAVY_LIGHT)
-    _kpi(ws, 8, 2, "ENTREGADOS", prem_entregados, GREEN)
-    _kpi(ws, 8, 3, "POR ENTREGAR", prem_pend, ORANGE)
-    _kpi(ws, 8, 4, "DISPONIBLES (stock)", int(disponibles), NAVY)
-
-    _band(ws, 11, "🎁 CUPONES 10% DE DESCUENTO", 4, NAVY)
-    _kpi(ws, 12, 1, "EMITIDOS", total_part, NAVY_LIGHT)
-    _kpi(ws, 12, 2, "USADOS", cup_usados, GREEN)
-    _kpi(ws, 12, 3, "POR USAR", cup_pend, ORANGE)
-    _kpi(ws, 12, 4, "REFERIDOS", referidos, NAVY)
+    ws = _Hoja(wb, "Resumen", [24, 14, 14, 14, 16])
+    ws.titulo("📊 REPORTE EJECUTIVO — INAUGURACIÓN", 6)
+    ws.vacia()
+    ws.kpis([("PARTICIPANTES", total_part, NAVY), ("GIROS", total_giros, NAVY_LIGHT),
+             ("CONVERSIÓN", f"{conv}%", GREEN), ("PREMIOS GANADOS", ganados, RED)])
+    ws.vacia()
+    ws.banda("🏆 PREMIOS", 4, NAVY)
+    ws.kpis([("GANADOS", ganados, NAVY_LIGHT), ("ENTREGADOS", prem_entregados, GREEN),
+             ("POR ENTREGAR", prem_pend, ORANGE),
+             ("DISPONIBLES (stock)", int(disponibles), NAVY)])
+    ws.vacia()
+    ws.banda("🎁 CUPONES 10% DE DESCUENTO", 4, NAVY)
+    ws.kpis([("EMITIDOS", total_part, NAVY_LIGHT), ("USADOS", cup_usados, GREEN),
+             ("POR USAR", cup_pend, ORANGE), ("REFERIDOS", referidos, NAVY)])
+    ws.vacia()
 
     # Desglose por premio
-    _band(ws, 15, "Desglose por premio", 5)
-    _header(ws, 16, ["Premio", "Stock total", "Restante", "Ganados", "Entregados"])
-    prizes = db.query(Prize).order_by(Prize.orden.asc()).all()
-    r = 17
+    ws.banda("Desglose por premio", 5)
+    ws.encabezado(["Premio", "Stock total", "Restante", "Ganados", "Entregados"])
+    prizes = (
+        db.query(Prize.nombre, Prize.stock_total, Prize.stock_restante, func.count(Spin.id),
+                 func.count(Spin.id).filter(Spin.redeemed.is_(True)))
+        .outerjoin(Spin, Spin.prize_id == Prize.id)
+        .group_by(Prize.id)
+        .order_by(Prize.orden.asc())
+    )
     for p in prizes:
-        pg = db.query(func.count(Spin.id)).filter(Spin.prize_id == p.id).scalar() or 0
-        pe = db.query(func.count(Spin.id)).filter(
-            Spin.prize_id == p.id, Spin.redeemed.is_(True)).scalar() or 0
-        for j, v in enumerate([p.nombre, p.stock_total, p.stock_restante, pg, pe], start=1):
-            c = ws.cell(row=r, column=j, value=v)
-            c.border = BORDER
-            c.alignment = Alignment(horizontal="center" if j > 1 else "left")
-        r += 1
-    _autosize(ws, [24, 14, 14, 14, 16])
+        ws.agregar(list(p), ["celda"] + ["celda_centro"] * 4)
 
     # ---------- Hoja 2: Participantes (con estado del cupón) ----------
-    ws2 = wb.create_sheet("Participantes")
-    ws2.sheet_view.showGridLines = False
-    _title(ws2, "👥 PARTICIPANTES INSCRITOS", 10)
-    _header(ws2, 4, ["Nombre", "Teléfono", "Correo", "Cédula", "Dirección",
-                     "Cupón", "¿Bono usado?", "Fecha bono", "Referido por", "Fecha registro"])
-    leads = db.query(Lead).order_by(Lead.created_at.desc()).all()
-    for i, l in enumerate(leads):
-        row = 5 + i
-        vals = [l.nombre, l.telefono, l.correo, l.cedula, l.direccion or "",
-                l.coupon_code, None, _fecha(l.coupon_redeemed_at),
-                l.referred_by or "", _fecha(l.created_at)]
-        for j, v in enumerate(vals, start=1):
-            c = ws2.cell(row=row, column=j, value=v)
-            c.border = BORDER
-            if row % 2 == 0 and j != 7:
-                c.fill = PatternFill("solid", fgColor=LIGHT)
-        _si_no(ws2, ws2.cell(row=row, column=7), l.coupon_redeemed)
-    ws2.freeze_panes = "A5"
-    _autosize(ws2, [24, 15, 28, 15, 22, 17, 13, 17, 15, 17])
+    ws2 = _Hoja(wb, "Participantes", [24, 15, 28, 15, 22, 17, 13, 17, 15, 17], congelar="A5")
+    ws2.titulo("👥 PARTICIPANTES INSCRITOS", 10)
+    ws2.vacia()
+    ws2.encabezado(["Nombre", "Teléfono", "Correo", "Cédula", "Dirección",
+                    "Cupón", "¿Bono usado?", "Fecha bono", "Referido por", "Fecha registro"])
+    leads = db.query(
+        Lead.nombre, Lead.telefono, Lead.correo, Lead.cedula, Lead.direccion, Lead.coupon_code,
+        Lead.coupon_redeemed, Lead.coupon_redeemed_at, Lead.referred_by, Lead.created_at,
+    ).order_by(Lead.created_at.desc()).yield_per(_LOTE)
+    for l in leads:
+        bono, estilo_bono = _si_no(l.coupon_redeemed)
+        base = "celda_zebra" if (ws2.fila + 1) % 2 == 0 else "celda"
+        ws2.agregar(
+            [l.nombre, l.telefono, l.correo, l.cedula, l.direccion or "", l.coupon_code, bono,
+             _fecha(l.coupon_redeemed_at), l.referred_by or "", _fecha(l.created_at)],
+            [base] * 6 + [estilo_bono] + [base] * 3)
 
     # ---------- Hoja 3: Premios (giros ganadores + estado entrega) ----------
-    ws3 = wb.create_sheet("Premios")
-    ws3.sheet_view.showGridLines = False
-    _title(ws3, "🏆 PREMIOS GANADOS Y ENTREGA", 9)
-    _header(ws3, 4, ["Cliente", "Teléfono", "Cédula", "Premio", "¿Entregado?",
-                     "Entregado por", "Fecha giro", "Fecha entrega", "Correo"])
-    ganadores = db.query(Spin).filter(Spin.gano.is_(True)).order_by(Spin.created_at.desc()).all()
-    for i, s in enumerate(ganadores):
-        row = 5 + i
-        lead = db.query(Lead).filter(Lead.id == s.lead_id).first()
-        prize = db.query(Prize).filter(Prize.id == s.prize_id).first() if s.prize_id else None
-        vals = [lead.nombre if lead else "", lead.telefono if lead else "",
-                lead.cedula if lead else "", prize.nombre if prize else "Premio",
-                None, s.redeemed_by or "", _fecha(s.created_at), _fecha(s.redeemed_at),
-                lead.correo if lead else ""]
-        for j, v in enumerate(vals, start=1):
-            c = ws3.cell(row=row, column=j, value=v)
-            c.border = BORDER
-            c.alignment = Alignment(horizontal="left" if j in (1, 4, 6, 9) else "center")
-        _si_no(ws3, ws3.cell(row=row, column=5), s.redeemed)
-    ws3.freeze_panes = "A5"
-    _autosize(ws3, [24, 15, 15, 22, 13, 20, 18, 18, 26])
+    ws3 = _Hoja(wb, "Premios", [24, 15, 15, 22, 13, 20, 18, 18, 26], congelar="A5")
+    ws3.titulo("🏆 PREMIOS GANADOS Y ENTREGA", 9)
+    ws3.vacia()
+    ws3.encabezado(["Cliente", "Teléfono", "Cédula", "Premio", "¿Entregado?",
+                    "Entregado por", "Fecha giro", "Fecha entrega", "Correo"])
+
+    def ganadores(solo_pendientes: bool = False):
+        """Giros ganadores con su participante y premio, en un JOIN por cursor de servidor."""
+        q = (
+            db.query(Lead.nombre, Lead.telefono, Lead.cedula, Lead.correo, Prize.nombre,
+                     Spin.redeemed, Spin.redeemed_by, Spin.created_at, Spin.redeemed_at)
+            .select_from(Spin)
+            .outerjoin(Lead, Lead.id == Spin.lead_id)
+            .outerjoin(Prize, Prize.id == Spin.prize_id)
+            .filter(Spin.gano.is_(True))
+        )
+        if solo_pendientes:
+            q = q.filter(Spin.redeemed.is_(False))
+        return q.order_by(Spin.created_at.desc()).yield_per(_LOTE)
+
+    for nombre, telefono, cedula, correo, premio, entregado, por, giro, entrega in ganadores():
+        si_no, estilo = _si_no(entregado)
+        ws3.agregar(
+            [nombre or "", telefono or "", cedula or "", premio or "Premio", si_no, por or "",
+             _fecha(giro), _fecha(entrega), correo or ""],
+            ["celda", "celda_centro", "celda_centro", "celda", estilo, "celda",
+             "celda_centro", "celda_centro", "celda"])
 
     # ---------- Hoja 4: Por Reclamar (pendientes) ----------
-    ws4 = wb.create_sheet("Por Reclamar")
-    ws4.sheet_view.showGridLines = False
-    _title(ws4, "⏳ PENDIENTES POR RECLAMAR", 5)
+    ws4 = _Hoja(wb, "Por Reclamar", [24, 15, 28, 20, 18])
+    ws4.titulo("⏳ PENDIENTES POR RECLAMAR", 5)
+    ws4.vacia()
+    estilos_pend = ["celda"] * 4 + ["celda_centro"]
 
     # A) Premios ganados NO entregados
-    _band(ws4, 4, f"🏆 PREMIOS POR ENTREGAR ({prem_pend})", 5, ORANGE)
-    _header(ws4, 5, ["Cliente", "Teléfono", "Correo", "Premio", "Fecha giro"])
-    pend_prem = db.query(Spin).filter(
-        Spin.gano.is_(True), Spin.redeemed.is_(False)).order_by(Spin.created_at.desc()).all()
-    r = 6
-    for s in pend_prem:
-        lead = db.query(Lead).filter(Lead.id == s.lead_id).first()
-        prize = db.query(Prize).filter(Prize.id == s.prize_id).first() if s.prize_id else None
-        vals = [lead.nombre if lead else "", lead.telefono if lead else "",
-                lead.correo if lead else "", prize.nombre if prize else "Premio",
-                _fecha(s.created_at)]
-        for j, v in enumerate(vals, start=1):
-            c = ws4.cell(row=r, column=j, value=v)
-            c.border = BORDER
-            c.alignment = Alignment(horizontal="left" if j != 5 else "center")
-        r += 1
-    if not pend_prem:
-        ws4.cell(row=r, column=1, value="— Sin premios pendientes —").font = Font(italic=True, color=NAVY_LIGHT)
-        r += 1
+    ws4.banda(f"🏆 PREMIOS POR ENTREGAR ({prem_pend})", 5, ORANGE)
+    ws4.encabezado(["Cliente", "Teléfono", "Correo", "Premio", "Fecha giro"])
+    hay = False
+    for nombre, telefono, _, correo, premio, _, _, giro, _ in ganadores(solo_pendientes=True):
+        hay = True
+        ws4.agregar([nombre or "", telefono or "", correo or "", premio or "Premio",
+                     _fecha(giro)], estilos_pend)
+    if not hay:
+        ws4.nota("— Sin premios pendientes —")
 
     # B) Cupones NO usados
-    r += 1
-    _band(ws4, r, f"🎁 CUPONES 10% POR USAR ({cup_pend})", 5, ORANGE)
-    r += 1
-    _header(ws4, r, ["Cliente", "Teléfono", "Correo", "Cupón", "Fecha registro"])
-    r += 1
-    pend_cup = db.query(Lead).filter(Lead.coupon_redeemed.is_(False)).order_by(
-        Lead.created_at.desc()).all()
-    for l in pend_cup:
-        vals = [l.nombre, l.telefono, l.correo, l.coupon_code, _fecha(l.created_at)]
-        for j, v in enumerate(vals, start=1):
-            c = ws4.cell(row=r, column=j, value=v)
-            c.border = BORDER
-            c.alignment = Alignment(horizontal="left" if j != 5 else "center")
-        r += 1
-    if not pend_cup:
-        ws4.cell(row=r, column=1, value="— Sin cupones pendientes —").font = Font(italic=True, color=NAVY_LIGHT)
-    _autosize(ws4, [24, 15, 28, 20, 18])
+    ws4.vacia()
+    ws4.banda(f"🎁 CUPONES 10% POR USAR ({cup_pend})", 5, ORANGE)
+    ws4.encabezado(["Cliente", "Teléfono", "Correo", "Cupón", "Fecha registro"])
+    hay = False
+    for l in db.query(Lead.nombre, Lead.telefono, Lead.correo, Lead.coupon_code,
+                      Lead.created_at).filter(Lead.coupon_redeemed.is_(False)).order_by(
+            Lead.created_at.desc()).yield_per(_LOTE):
+        hay = True
+        ws4.agregar([l.nombre, l.telefono, l.correo, l.coupon_code, _fecha(l.created_at)],
+                    estilos_pend)
+    if not hay:
+        ws4.nota("— Sin cupones pendientes —")
 
     # ---------- Hoja 5: Canales (resumen comparativo) ----------
-    channels = db.query(Channel).order_by(Channel.tipo.asc(), Channel.orden.asc()).all()
-    if channels:
-        wsc = wb.create_sheet("Canales")
-        wsc.sheet_view.showGridLines = False
-        _title(wsc, "🏢 SEDES Y VENDEDORES — RESUMEN", 6)
-        _header(wsc, 4, ["Tipo", "Nombre", "Giros", "Premios entregados", "Estado"])
-        r = 5
-        for ch in channels:
-            giros = db.query(func.count(Spin.id)).filter(Spin.channel_id == ch.id).scalar() or 0
-            entreg = db.query(func.count(Spin.id)).filter(
-                Spin.channel_id == ch.id, Spin.gano.is_(True)).scalar() or 0
-            vals = [ch.tipo.capitalize(), ch.nombre, giros, entreg,
-                    "Activo" if ch.activo else "Inactivo"]
-            for j, v in enumerate(vals, start=1):
-                c = wsc.cell(row=r, column=j, value=v)
-                c.border = BORDER
-                c.alignment = Alignment(horizontal="center" if j in (1, 3, 4, 5) else "left")
-                if r % 2 == 0:
-                    c.fill = PatternFill("solid", fgColor=LIGHT)
-            r += 1
-        wsc.freeze_panes = "A5"
-        _autosize(wsc, [12, 24, 12, 20, 12])
-
-        # ---------- Una hoja por cada canal ----------
-        usados = set(wb.sheetnames)
-        for ch in channels:
-            pref = "Sede" if ch.tipo == "sede" else "Vend"
-            base = f"{pref} - {ch.nombre}"[:31]
-            name = base
-            k = 2
-            while name in usados:
-                name = f"{base[:28]}-{k}"
-                k += 1
-            usados.add(name)
-            wsx = wb.create_sheet(name)
-            wsx.sheet_view.showGridLines = False
-            _title(wsx, f"{'🏬' if ch.tipo == 'sede' else '🧑‍💼'} {ch.nombre.upper()}", 6)
+    orden_canal = (Channel.tipo.asc(), Channel.orden.asc(), Channel.id.asc())
+    channels = db.query(Channel).order_by(*orden_canal).all()
+    if not channels:
+        return
+    wsc = _Hoja(wb, "Canales", [12, 24, 12, 20, 12], congelar="A5")
+    wsc.titulo("🏢 SEDES Y VENDEDORES — RESUMEN", 6)
+    wsc.vacia()
+    wsc.encabezado(["Tipo", "Nombre", "Giros", "Premios entregados", "Estado"])
+    canal = contadores_svc.por_canal(db)
+    for ch in channels:
+        zebra = "_zebra" if (wsc.fila + 1) % 2 == 0 else ""
+        wsc.agregar(
+            [ch.tipo.capitalize(), ch.nombre, canal.get((ch.id, "giros"), 0),
+             canal.get((ch.id, "premios_entregados"), 0), "Activo" if ch.activo else "Inactivo"],
+            [f"celda{zebra}_centro", f"celda{zebra}"] + [f"celda{zebra}_centro"] * 3)
+
+    # ---------- Una hoja por cada canal ----------
+    # Un solo cursor con todos los giros de canal, en el mismo orden que `channels`:
+    # cada hoja consume su tramo y se cierra antes de abrir la siguiente.
+    giros = (
+        db.query(Spin.channel_id, Spin.created_at, Spin.factura, Spin.nombre, Spin.telefono,
+                 Spin.gano, Spin.redeemed_by, Prize.nombre)
+        .join(Channel, Channel.id == Spin.channel_id)
+        .outerjoin(Prize, Prize.id == Spin.prize_id)
+        .order_by(*orden_canal, Spin.created_at.desc())
+        .yield_per(_LOTE)
+    )
+    tramos = groupby(giros, key=lambda g: g[0])
+    tramo = next(tramos, None)
+    usados = set(wb.sheetnames)
+    for ch in channels:
+        pref = "Sede" if ch.tipo == "sede" else "Vend"
+        base = f"{pref} - {ch.nombre}"[:31]
+        name = base
+        k = 2
+        while name in usados:
+            name = f"{base[:28]}-{k}"
+            k += 1
+        usados.add(name)
+        wsx = _Hoja(wb, name, [18, 22, 22, 14, 20, 22], congelar="A5")
+        wsx.titulo(f"{'🏬' if ch.tipo == 'sede' else '🧑‍💼'} {ch.nombre.upper()}", 6)
+        wsx.vacia()
+        if ch.modo == "factura":
+            wsx.encabezado(["Fecha", "Factura", "Premio", "¿Ganó?", "Entregado por", "Cliente"])
+        else:
+            wsx.encabezado(["Fecha", "Cliente", "Teléfono", "Premio", "¿Ganó?", "Entregado por"])
+        if tramo is None or tramo[0] != ch.id:
+            continue
+        for _, creado, factura, nombre, telefono, gano, por, premio in tramo[1]:
+            pn = premio or "Sin premio"
+            gano_txt, gano_estilo = ("SÍ", "si") if gano else ("No", "celda_centro")
             if ch.modo == "factura":
-                _header(wsx, 4, ["Fecha", "Factura", "Premio", "¿Ganó?", "Entregado por", "Cliente"])
+                vals = [_fecha(creado), factura or "", pn, gano_txt, por or "", nombre or ""]
+                estilos = ["celda"] * 3 + [gano_estilo] + ["celda"] * 2
             else:
-                _header(wsx, 4, ["Fecha", "Cliente", "Teléfono", "Premio", "¿Ganó?", "Entregado por"])
-            spins = db.query(Spin).filter(Spin.channel_id == ch.id).order_by(
-                Spin.created_at.desc()).all()
-            for i, s in enumerate(spins):
-                row = 5 + i
-                prize = db.query(Prize).filter(Prize.id == s.prize_id).first() if s.prize_id else None
-                pn = prize.nombre if prize else "Sin premio"
-                if ch.modo == "factura":
-                    vals = [_fecha(s.created_at), s.factura or "", pn, None, s.redeemed_by or "", s.nombre or ""]
-                    gano_col = 4
-                else:
-                    vals = [_fecha(s.created_at), s.nombre or "", s.telefono or "", pn, None, s.redeemed_by or ""]
-                    gano_col = 5
-                for j, v in enumerate(vals, start=1):
-                    if j == gano_col:
-                        continue
-                    c = wsx.cell(row=row, column=j, value=v)
-                    c.border = BORDER
-                gc = wsx.cell(row=row, column=gano_col, value="SÍ" if s.gano else "No")
-                gc.border = BORDER
-                gc.alignment = Alignment(horizontal="center")
-                if s.gano:
-                    gc.font = Font(bold=True, color=GREEN)
-                    gc.fill = PatternFill("solid", fgColor=GREEN_SOFT)
-            wsx.freeze_panes = "A5"
-            _autosize(wsx, [18, 22, 22, 14, 20, 22])
-
-    buf = BytesIO()
-    wb.save(buf)
-    return buf.getvalue()
+                vals = [_fecha(creado), nombre or "", telefono or "", pn, gano_txt, por or ""]
+                estilos = ["celda"] * 4 + [gano_estilo, "celda"]
+            wsx.agregar(vals, estilos)
+        tramo = next(tramos, None)
+
+
+def generar_reporte(db: Session) -> IO[bytes]:
+    """Escribe el .xlsx en un archivo temporal y lo devuelve rebobinado (cerrarlo al final)."""
+    wb = Workbook(write_only=True)
+    for estilo in _estilos():
+        wb.add_named_style(estilo)
+    archivo = SpooledTemporaryFile(max_size=_SPOOL)
+    try:
+        _escribir(db, wb)
+        wb.save(archivo)
+    except Exception:
+        archivo.close()
+        raise
+    archivo.seek(0)
+    return archivo
+
+
+def en_trozos(archivo: IO[bytes]) -> Iterator[bytes]:
+    """Lee el reporte por bloques para `StreamingResponse` y cierra el temporal al final."""
+    try:
+        while trozo := archivo.read(_TROZO):
+            yield trozo
+    finally:
+        archivo.close()
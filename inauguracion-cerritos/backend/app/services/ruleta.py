@@ -2,68 +2,242 @@
 
 - Selección ponderada por `probabilidad` de cada premio activo con stock.
 - `server_seed` firmado -> provably fair (auditable).
-- Se descuenta stock de forma atómica dentro de la transacción del llamador.
+- Se descuenta stock de forma atómica dentro de la transacción del llamador con un
+  UPDATE condicional (sin SELECT ... FOR UPDATE previo). El giro del magic link hace
+  descuento + INSERT del giro + consumo del enlace en una sola sentencia (`sentencia_giro`).
+- Los segmentos de cada canal y su tabla de sorteo (pesos acumulados) se guardan en
+  caché en memoria; el admin la invalida al crear/editar/eliminar premios o canales y
+  la tabla se recompila sola cuando un premio se agota.
 """
+import bisect
 import hashlib
 import secrets as _secrets
-from typing import List, Optional, Tuple
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
+from sqlalchemy import Select, case, insert, literal, select, update
 from sqlalchemy.orm import Session
 
-from ..models import Prize
+from ..config import settings
+from ..models import MagicLink, Prize, Spin
+
+
+@dataclass(frozen=True)
+class Segmento:
+    """Copia inmutable de un premio activo (segura de compartir entre sesiones/hilos)."""
+    id: str
+    nombre: str
+    color: str
+    es_perdedor: bool
+    probabilidad: float
+    stock_restante: int
+
+
+@dataclass(frozen=True)
+class Sorteo:
+    """Tabla de sorteo compilada: pesos acumulados de los elegibles + su índice de segmento."""
+    acumulados: Tuple[float, ...]
+    indices: Tuple[int, ...]
+    total: float
+
+    def elegir(self, seed: str) -> int:
+        """Índice del segmento ganador para el punto de corte derivado del seed."""
+        r = (int(seed[:8], 16) / 0xFFFFFFFF) * self.total
+        k = bisect.bisect_left(self.acumulados, r)
+        return self.indices[min(k, len(self.indices) - 1)]
+
+
+def _compilar(segmentos: List[Segmento], agotados: FrozenSet[str]) -> Sorteo:
+    # Candidatos elegibles: perdedores siempre; ganables solo con stock.
+    elegibles = [
+        i for i, p in enumerate(segmentos)
+        if p.es_perdedor or (p.stock_restante > 0 and p.id not in agotados)
+    ]
+    if not elegibles:
+        elegibles = [i for i, p in enumerate(segmentos) if p.es_perdedor] or list(
+            range(len(segmentos))
+        )
+
+    pesos = [max(segmentos[i].probabilidad, 0.0) for i in elegibles]
+    if sum(pesos) <= 0:
+        # Sin probabilidades definidas: reparto uniforme.
+        pesos = [1.0] * len(elegibles)
+
+    acumulados = []
+    acumulado = 0.0
+    for w in pesos:
+        acumulado += w
+        acumulados.append(acumulado)
+    return Sorteo(acumulados=tuple(acumulados), indices=tuple(elegibles), total=acumulado)
+
+
+@dataclass(frozen=True)
+class _Ruleta:
+    cargado: float
+    segmentos: List[Segmento]
+    agotados: FrozenSet[str]
+    sorteo: Sorteo
+
+
+# channel_id (None = inauguración) -> ruleta compilada
+_cache: Dict[Optional[str], _Ruleta] = {}
+_cache_lock = threading.Lock()
+_TODOS = object()
 
 
 def _generar_seed() -> str:
     return hashlib.sha256(_secrets.token_bytes(32)).hexdigest()
 
 
-def segmentos_visibles(db: Session, channel_id: Optional[str] = None) -> List[Prize]:
-    """Premios activos de un canal (o de la inauguración si channel_id es None)."""
+def _cargar_segmentos(db: Session, channel_id: Optional[str]) -> List[Segmento]:
     q = db.query(Prize).filter(Prize.activo.is_(True))
     if channel_id is None:
         q = q.filter(Prize.channel_id.is_(None))
     else:
         q = q.filter(Prize.channel_id == channel_id)
-    return q.order_by(Prize.orden.asc(), Prize.created_at.asc()).all()
+    return [
+        Segmento(id=p.id, nombre=p.nombre, color=p.color, es_perdedor=p.es_perdedor,
+                 probabilidad=p.probabilidad, stock_restante=p.stock_restante)
+        for p in q.order_by(Prize.orden.asc(), Prize.created_at.asc()).all()
+    ]
+
+
+def invalidar_cache(channel_id=_TODOS) -> None:
+    """Descarta los segmentos en caché de un canal (o de todos si no se indica)."""
+    with _cache_lock:
+        if channel_id is _TODOS:
+            _cache.clear()
+        else:
+            _cache.pop(channel_id, None)
+
+
+def marcar_agotado(channel_id: Optional[str], prize_id: str) -> None:
+    """Saca un premio sin stock del sorteo del canal sin volver a consultar la BD."""
+    with _cache_lock:
+        ruleta = _cache.get(channel_id)
+        if ruleta is None or prize_id in ruleta.agotados:
+            return
+        agotados = ruleta.agotados | {prize_id}
+        _cache[channel_id] = _Ruleta(
+            cargado=ruleta.cargado, segmentos=ruleta.segmentos, agotados=agotados,
+            sorteo=_compilar(ruleta.segmentos, agotados),
+        )
+
+
+def _ruleta(db: Session, channel_id: Optional[str]) -> _Ruleta:
+    ahora = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(channel_id)
+    if hit and ahora - hit.cargado < settings.ruleta_cache_ttl_seconds:
+        return hit
+    segmentos = _cargar_segmentos(db, channel_id)
+    ruleta = _Ruleta(cargado=ahora, segmentos=segmentos, agotados=frozenset(),
+                     sorteo=_compilar(segmentos, frozenset()))
+    with _cache_lock:
+        _cache[channel_id] = ruleta
+    return ruleta
+
+
+def segmentos_visibles(db: Session, channel_id: Optional[str] = None) -> List[Segmento]:
+    """Premios activos de un canal (o de la inauguración si channel_id es None).
+
+    Sale de la caché en memoria mientras no se invalide ni venza el TTL
+    (`ruleta_cache_ttl_seconds`, red de seguridad cuando hay varios workers).
+    """
+    return _ruleta(db, channel_id).segmentos
 
 
 def elegir_premio(
     db: Session, channel_id: Optional[str] = None
-) -> Tuple[Optional[Prize], str, int, List[Prize]]:
+) -> Tuple[Optional[Segmento], str, int, List[Segmento]]:
     """Devuelve (premio, server_seed, indice_segmento, lista_segmentos).
 
     - Solo entran al sorteo premios con stock_restante > 0 (o perdedores, stock infinito).
+      El stock de la caché es orientativo: el llamador lo confirma con `descontar_stock`.
     - La ponderación usa `probabilidad`. Si todo lo "ganable" se agotó, cae en un perdedor.
+    - El punto de corte sale del seed (determinista y auditable) y se busca por bisección
+      en la tabla compilada, que ya trae el índice del segmento.
     """
     seed = _generar_seed()
-    segmentos = segmentos_visibles(db, channel_id)
-    if not segmentos:
+    ruleta = _ruleta(db, channel_id)
+    if not ruleta.segmentos:
         return None, seed, 0, []
+    indice = ruleta.sorteo.elegir(seed)
+    return ruleta.segmentos[indice], seed, indice, ruleta.segmentos
 
-    # Candidatos elegibles: perdedores siempre; ganables solo con stock.
-    elegibles = [
-        p for p in segmentos
-        if p.es_perdedor or p.stock_restante > 0
-    ]
-    if not elegibles:
-        elegibles = [p for p in segmentos if p.es_perdedor] or segmentos
 
-    pesos = [max(p.probabilidad, 0.0) for p in elegibles]
-    total = sum(pesos)
-    if total <= 0:
-        # Sin probabilidades definidas: reparto uniforme.
-        pesos = [1.0] * len(elegibles)
-        total = float(len(elegibles))
+def descontar_stock(db: Session, channel_id: Optional[str], prize_id: str) -> bool:
+    """Descuenta 1 unidad con un único UPDATE condicional. False si ya no quedaba stock.
+
+    El lock de fila dura solo lo que resta de la transacción del llamador, sin el
+    ida y vuelta de leer-bloquear-escribir.
+    """
+    restante = db.execute(
+        update(Prize)
+        .where(Prize.id == prize_id, Prize.stock_restante > 0)
+        .values(stock_restante=Prize.stock_restante - 1)
+        .returning(Prize.stock_restante)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    if restante is None or restante == 0:
+        marcar_agotado(channel_id, prize_id)
+    return restante is not None
+
+
+def sentencia_giro(
+    *,
+    spin_id: str,
+    lead_id: str,
+    magic_link_id: str,
+    prize_id: Optional[str],
+    seed: str,
+    prize_jwt: Optional[str],
+    redeem_token: Optional[str],
+) -> Select:
+    """Giro del magic link en UN viaje a la BD (CTEs que modifican datos).
+
+    Descuenta el stock de `prize_id` (si hay y queda), inserta el giro marcando `gano`
+    según haya salido el descuento y consume el enlace. Devuelve una fila
+    (gano, stock_restante); stock_restante es None si no se descontó nada.
+    """
+    descuento = (
+        update(Prize)
+        .where(Prize.id == prize_id, Prize.stock_restante > 0)
+        .values(stock_restante=Prize.stock_restante - 1)
+        .returning(Prize.id, Prize.stock_restante)
+        .cte("descuento")
+    )
+    premio = select(descuento.c.id).scalar_subquery()
+    gano = premio.is_not(None)
+    giro = (
+        insert(Spin)
+        .from_select(
+            ["id", "lead_id", "prize_id", "server_seed", "gano", "prize_jwt", "redeem_token"],
+            select(
+                literal(spin_id, Spin.id.type), literal(lead_id, Spin.lead_id.type), premio,
+                literal(seed, Spin.server_seed.type), gano,
+                case((gano, literal(prize_jwt, Spin.prize_jwt.type)), else_=None),
+                case((gano, literal(redeem_token, Spin.redeem_token.type)), else_=None),
+            ),
+        )
+        .returning(Spin.gano)
+        .cte("giro")
+    )
+    consumo = (
+        update(MagicLink).where(MagicLink.id == magic_link_id).values(used=True)
+        .returning(MagicLink.id)
+        .cte("consumo")
+    )
+    return select(
+        giro.c.gano, select(descuento.c.stock_restante).scalar_subquery()
+    ).add_cte(consumo)
 
-    # Punto de corte derivado del seed (determinista y auditable).
-    r = (int(seed[:8], 16) / 0xFFFFFFFF) * total
-    acumulado = 0.0
-    elegido = elegibles[-1]
-    for p, w in zip(elegibles, pesos):
-        acumulado += w
-        if r <= acumulado:
-            elegido = p
-            break
 
-    indice = segmentos.index(elegido)
-    return elegido, seed, indice, segmentos
+def registrar_descuento(
+    channel_id: Optional[str], prize_id: str, gano: bool, restante: Optional[int]
+) -> None:
+    """Refleja en la caché el resultado del descuento hecho por `sentencia_giro`."""
+    if not gano or restante == 0:
+        marcar_agotado(channel_id, prize_id)
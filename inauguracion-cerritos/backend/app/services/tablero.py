@@ -0,0 +1,66 @@
+"""Métricas del dashboard de admin (`GET /admin/metrics`).
+
+Una sola consulta sobre `event_counters` (SUM ... FILTER por evento, sin recontar leads ni
+spins) más el stock disponible, guardada unos segundos por proceso: con varias pestañas del dashboard abiertas
+se consulta la BD una vez por intervalo, no una vez por pestaña. Mientras una petición
+recalcula, las demás esperan su resultado en vez de lanzar la misma consulta.
+"""
+import hashlib
+import json
+import threading
+import time
+from typing import Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import EventCounter, Prize
+from . import contadores as contadores_svc
+
+_cache: Optional[Tuple[float, dict, str]] = None  # (cargado, métricas, etag)
+_lock = threading.Lock()
+
+
+def consultar(db: Session) -> dict:
+    """Métricas al momento, en una sola consulta y sin caché (`resumen` es la cacheada)."""
+    disponibles = (
+        select(func.coalesce(func.sum(Prize.stock_restante), 0))
+        .where(Prize.activo.is_(True), Prize.es_perdedor.is_(False))
+        .scalar_subquery()
+    )
+    fila = db.execute(
+        select(
+            *(contadores_svc.total(e) for e in
+              ("participantes", "giros", "premios_ganados", "premios_entregados")),
+            disponibles,
+        ).select_from(EventCounter)
+    ).one()
+    total_part, total_giros, ganados, entregados, stock = (int(v) for v in fila)
+    return {
+        "total_participantes": total_part,
+        "total_giros": total_giros,
+        "premios_ganados": ganados,
+        "premios_entregados": entregados,
+        "premios_disponibles": stock,
+        "tasa_conversion": round((total_giros / total_part * 100), 1) if total_part else 0.0,
+    }
+
+
+def resumen(db: Session) -> Tuple[dict, str]:
+    """(métricas, ETag fuerte); se recalculan cada `tablero_cache_ttl_seconds`."""
+    global _cache
+    with _lock:
+        if _cache and time.monotonic() - _cache[0] < settings.tablero_cache_ttl_seconds:
+            return _cache[1], _cache[2]
+        datos = consultar(db)
+        digest = hashlib.sha256(json.dumps(datos, sort_keys=True).encode()).hexdigest()
+        _cache = (time.monotonic(), datos, f'"{digest[:32]}"')
+        return _cache[1], _cache[2]
+
+
+def invalidar() -> None:
+    """Fuerza a recalcular en la próxima petición (p. ej. tras un canje en este proceso)."""
+    global _cache
+    with _lock:
+        _cache = None
@@ -1,18 +1,54 @@
-"""Helpers de generación de códigos legibles."""
+"""Helpers de generación de códigos legibles.
+
+Los códigos de cupón y de referido salen de una permutación con llave (red de Feistel)
+del número consecutivo del participante (`leads_codigo_seq`): números distintos dan
+SIEMPRE códigos distintos, sin consultar la BD, y sin la llave no se puede adivinar el
+código de otro participante a partir del propio.
+"""
+import hashlib
+import hmac
 import secrets
 import string
 
+from .config import settings
+
 _ALFA = string.ascii_uppercase + string.digits
-_SIN_AMBIGUOS = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # sin 0/O/1/I
+_SIN_AMBIGUOS = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # sin 0/O/1/I (32 = 2^5 símbolos)
+
+_LLAVE = hmac.new(settings.jwt_secret.encode(), b"codigos-cerritos", hashlib.sha256).digest()
+_RONDAS = 4
+
+
+def _feistel(n: int, bits: int) -> int:
+    """Permutación con llave de [0, 2^bits) (bits par; Feistel balanceada)."""
+    mitad = bits // 2
+    mascara = (1 << mitad) - 1
+    izq, der = n >> mitad, n & mascara
+    for ronda in range(_RONDAS):
+        h = hashlib.blake2b(
+            der.to_bytes(4, "big"), digest_size=4, key=_LLAVE, salt=bytes([ronda]) * 16
+        ).digest()
+        izq, der = der, izq ^ (int.from_bytes(h, "big") & mascara)
+    return (izq << mitad) | der
+
+
+def _base32(n: int, largo: int) -> str:
+    return "".join(_SIN_AMBIGUOS[(n >> (5 * i)) & 31] for i in reversed(range(largo)))
+
+
+CUPONES_MAX = 32 ** 4  # 1.048.576 participantes
 
 
-def codigo_cupon() -> str:
-    cuerpo = "".join(secrets.choice(_SIN_AMBIGUOS) for _ in range(4))
-    return f"CERRITOS-10-{cuerpo}"
+def codigo_cupon(n: int) -> str:
+    """Cupón del participante número `n` (0 <= n < CUPONES_MAX), único por construcción."""
+    if not 0 <= n < CUPONES_MAX:
+        raise ValueError("Se agotó el espacio de códigos de cupón.")
+    return f"CERRITOS-10-{_base32(_feistel(n, 20), 4)}"
 
 
-def codigo_referido() -> str:
-    return "".join(secrets.choice(_SIN_AMBIGUOS) for _ in range(6))
+def codigo_referido(n: int) -> str:
+    """Código de referido del participante número `n`, único por construcción."""
+    return _base32(_feistel(n % 32 ** 6, 30), 6)
 
 
 def token_url() -> str:
@@ -0,0 +1,97 @@
+"""Benchmark de motores de QR: bytes (crudos y gzip) y tiempo de render.
+
+Compara el PNG RGB que usaba `qr_data_uri`, el PNG por defecto de `qrcode.make` y los
+motores de `services.qr` ("png1" paleta 1 bit, "svg"), sobre las URLs reales que llevan
+los correos y los pósters. Para los PNG comprueba además que cada módulo se pueda
+leer de vuelta en el centro de su celda (sin antialias ni pérdida) y, si está
+instalado OpenCV (`pip install opencv-python-headless`), que el código se decodifique.
+
+Uso:
+    cd backend
+    python -m bench.bench_qr --repeticiones 200
+"""
+import argparse
+import gzip
+import io
+import statistics
+import time
+
+import qrcode
+from PIL import Image
+
+from app.services import qr as qr_svc
+
+try:  # opcional: decodificación real con OpenCV
+    import cv2
+    import numpy as np
+except ImportError:  # pragma: no cover
+    cv2 = None
+
+URLS = {
+    "validar": qr_svc.url_validar("AbCdEfGhIjKl"),
+    "canal": qr_svc.url_canal("vendedor-10"),
+    "registro": qr_svc.url_registro(),
+}
+
+
+def _rgb(contenido: str) -> bytes:
+    """El render de `qr_data_uri` antes de los motores compactos."""
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=8,
+                       border=2)
+    qr.add_data(contenido)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    qr.make_image(fill_color="#0A2E57", back_color="white").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+MOTORES = {
+    "rgb (anterior)": (_rgb, 2),
+    "png (qrcode.make)": (lambda c: qr_svc._render(c, "png"), 4),
+    "png1": (lambda c: qr_svc._render(c, "png1"), qr_svc.BORDE),
+    "svg": (lambda c: qr_svc._render(c, "svg"), qr_svc.BORDE),
+}
+
+
+def _modulos_ok(png: bytes, contenido: str, borde: int) -> bool:
+    m = qr_svc._matriz(contenido, borde)
+    img = Image.open(io.BytesIO(png)).convert("L")
+    caja = img.width / len(m)
+    return all(
+        (img.getpixel((int((x + 0.5) * caja), int((y + 0.5) * caja))) < 128) == bool(v)
+        for y, fila in enumerate(m) for x, v in enumerate(fila)
+    )
+
+
+def _decodifica(png: bytes, contenido: str):
+    if cv2 is None:
+        return None
+    arr = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_GRAYSCALE)
+    texto, _, _ = cv2.QRCodeDetector().detectAndDecode(arr)
+    return texto == contenido
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--repeticiones", type=int, default=200)
+    args = ap.parse_args()
+
+    print(f"{'url':<9} {'motor':<18} {'bytes':>6} {'gzip':>6} {'ms':>6} {'módulos':>8} "
+          f"{'decodifica':>10}")
+    for nombre_url, url in URLS.items():
+        for motor, (render, borde) in MOTORES.items():
+            tiempos = []
+            for _ in range(args.repeticiones):
+                t0 = time.perf_counter()
+                datos = render(url)
+                tiempos.append(time.perf_counter() - t0)
+            es_png = datos.startswith(b"\x89PNG")
+            modulos = ("sí" if _modulos_ok(datos, url, borde) else "NO") if es_png else "-"
+            deco = _decodifica(datos, url) if es_png else None
+            deco = "-" if deco is None else ("sí" if deco else "NO")
+            print(f"{nombre_url:<9} {motor:<18} {len(datos):>6} {len(gzip.compress(datos)):>6} "
+                  f"{statistics.median(tiempos) * 1000:>6.2f} {modulos:>8} {deco:>10}")
+
+
+if __name__ == "__main__":
+    main()
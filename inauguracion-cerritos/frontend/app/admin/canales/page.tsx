@@ -53,6 +53,22 @@ export default function CanalesPage() {
     load();
   }
 
+  async function descargarKit(formato: "pdf" | "zip") {
+    if (!token) return;
+    setError("");
+    try {
+      const blob = await api.descargarKitQr(token, formato);
+      const url = URL.createObjectURL(blob);
+      const a = document.createElement("a");
+      a.href = url;
+      a.download = `QR_Canales_Cerritos.${formato}`;
+      a.click();
+      URL.revokeObjectURL(url);
+    } catch (e) {
+      setError(e instanceof Error ? e.message : "Error al descargar");
+    }
+  }
+
   function editar(c: Channel) {
     setEditId(c.id);
     setForm({ tipo: c.tipo, nombre: c.nombre, modo: c.modo, activo: c.activo, orden: c.orden });
@@ -66,7 +82,13 @@ export default function CanalesPage() {
 
   return (
     <AdminShell>
-      <h1 className="mb-4 text-xl font-extrabold text-navy">Sedes y Vendedores</h1>
+      <div className="mb-4 flex flex-wrap items-center justify-between gap-2">
+        <h1 className="text-xl font-extrabold text-navy">Sedes y Vendedores</h1>
+        <div className="flex gap-2">
+          <Button type="button" variant="outline" onClick={() => descargarKit("pdf")}>🖨️ QR para imprimir (PDF)</Button>
+          <Button type="button" variant="outline" onClick={() => descargarKit("zip")}>📦 QR en ZIP</Button>
+        </div>
+      </div>
 
       <Card className="mb-6">
         <h2 className="mb-3 font-bold text-navy">{editId ? "Editar canal" : "Nuevo canal"}</h2>
@@ -1,6 +1,6 @@
 "use client";
 import { useEffect, useState } from "react";
-import { api, Metrics } from "@/lib/api";
+import { api, Metrics, PremioGanado, StockPremio } from "@/lib/api";
 import { getToken, saveToken } from "@/lib/auth";
 import { Button, Card, Input } from "@/components/ui";
 import AdminShell from "@/components/AdminShell";
@@ -54,6 +54,8 @@ function Stat({ label, value, accent }: { label: string; value: number | string;
 
 function Dashboard() {
   const [m, setM] = useState<Metrics | null>(null);
+  const [stock, setStock] = useState<Record<string, StockPremio>>({});
+  const [ganadores, setGanadores] = useState<PremioGanado[]>([]);
   const [error, setError] = useState("");
   const [descargando, setDescargando] = useState(false);
 
@@ -87,10 +89,64 @@ function Dashboard() {
       }
     };
     load();
-    const id = setInterval(load, 8000); // tiempo real (poll cada 8s)
-    return () => clearInterval(id);
+
+    // Tiempo real por SSE: el backend empuja solo lo que cambió. Cada conexión usa un
+    // token corto recién pedido; si no se puede abrir el stream se vuelve al poll de 8s.
+    const t = getToken();
+    let id: ReturnType<typeof setInterval> | undefined;
+    let es: EventSource | null = null;
+    let cerrado = false;
+    const sondear = () => {
+      if (!id) id = setInterval(load, 8000);
+    };
+    const conectar = async () => {
+      if (!t || typeof EventSource === "undefined") return sondear();
+      let streamToken: string;
+      try {
+        streamToken = (await api.tokenStream(t)).access_token;
+      } catch {
+        return sondear();
+      }
+      if (cerrado) return;
+      es = new EventSource(api.streamUrl(streamToken));
+      es.onopen = () => {
+        clearInterval(id);
+        id = undefined;
+      };
+      es.addEventListener("metricas", (e) => {
+        const cambios = JSON.parse((e as MessageEvent).data) as Partial<Metrics>;
+        setM((prev) => (prev ? { ...prev, ...cambios } : (cambios as Metrics)));
+      });
+      es.addEventListener("stock", (e) => {
+        const premios = JSON.parse((e as MessageEvent).data) as StockPremio[];
+        setStock((prev) => {
+          const sig = { ...prev };
+          for (const p of premios) sig[p.id] = p;
+          return sig;
+        });
+      });
+      es.addEventListener("premio", (e) => {
+        const g = JSON.parse((e as MessageEvent).data) as PremioGanado;
+        setGanadores((prev) => [g, ...prev.filter((x) => x.id !== g.id)].slice(0, 10));
+      });
+      es.onerror = () => {
+        // El reintento automático del navegador reusaría un token ya vencido: se cierra
+        // y se reconecta con uno nuevo; mientras tanto, poll de 8s.
+        es?.close();
+        sondear();
+        if (!cerrado) setTimeout(conectar, 5000);
+      };
+    };
+    conectar();
+    return () => {
+      cerrado = true;
+      es?.close();
+      clearInterval(id);
+    };
   }, []);
 
+  const premiosStock = Object.values(stock).sort((a, b) => a.stock_restante - b.stock_restante);
+
   return (
     <AdminShell>
       <div className="mb-5 flex flex-wrap items-center justify-between gap-3">
@@ -125,6 +181,43 @@ function Dashboard() {
           <Stat label="Disponibles" value={m.premios_disponibles} accent="text-navy-light" />
         </div>
       )}
+      {(ganadores.length > 0 || premiosStock.length > 0) && (
+        <div className="mt-6 grid gap-4 md:grid-cols-2">
+          <Card>
+            <h2 className="mb-3 text-sm font-bold uppercase tracking-wide text-navy/60">Últimos premios</h2>
+            {ganadores.length === 0 ? (
+              <p className="text-sm text-navy/50">Aún no hay ganadores en esta sesión.</p>
+            ) : (
+              <ul className="space-y-2 text-sm">
+                {ganadores.map((g) => (
+                  <li key={g.id} className="flex justify-between gap-3">
+                    <span className="font-semibold text-navy">{g.cliente || "—"}</span>
+                    <span className="text-right text-navy/70">
+                      {g.premio} · {g.canal}
+                    </span>
+                  </li>
+                ))}
+              </ul>
+            )}
+          </Card>
+          <Card>
+            <h2 className="mb-3 text-sm font-bold uppercase tracking-wide text-navy/60">Stock de premios</h2>
+            <ul className="max-h-72 space-y-2 overflow-y-auto text-sm">
+              {premiosStock.map((p) => (
+                <li key={p.id} className="flex justify-between gap-3">
+                  <span className="text-navy">
+                    {p.nombre}
+                    <span className="text-navy/50"> · {p.canal || "Inauguración"}</span>
+                  </span>
+                  <span className={`font-bold ${p.stock_restante === 0 ? "text-brand-red" : "text-navy"}`}>
+                    {p.stock_restante}
+                  </span>
+                </li>
+              ))}
+            </ul>
+          </Card>
+        </div>
+      )}
     </AdminShell>
   );
 }
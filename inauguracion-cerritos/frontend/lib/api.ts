@@ -49,6 +49,7 @@ export type Channel = {
   nombre: string;
   slug: string;
   modo: "factura" | "vendedor";
+  sorteo: "ruleta" | "mazo";
   activo: boolean;
   orden: number;
   qr_url: string;
@@ -70,6 +71,22 @@ export type Metrics = {
   tasa_conversion: number;
 };
 
+// Eventos de /admin/stream (dashboard en vivo)
+export type StockPremio = {
+  id: string;
+  nombre: string;
+  stock_restante: number;
+  canal: string | null;
+};
+
+export type PremioGanado = {
+  id: string;
+  cliente: string | null;
+  premio: string;
+  canal: string;
+  hora: string;
+};
+
 async function req<T>(path: string, init?: RequestInit): Promise<T> {
   const res = await fetch(`${BASE}${path}`, {
     ...init,
@@ -87,6 +104,63 @@ async function req<T>(path: string, init?: RequestInit): Promise<T> {
   return res.status === 204 ? (undefined as T) : ((await res.json()) as T);
 }
 
+// GET revalidado con ETag: si el backend responde 304 se reutiliza la última respuesta
+// (el fetch va con cache "no-store", así que el If-None-Match se maneja aquí).
+const porEtag = new Map<string, { etag: string; datos: unknown }>();
+
+async function reqConEtag<T>(path: string, init?: RequestInit): Promise<T> {
+  const previa = porEtag.get(path);
+  const res = await fetch(`${BASE}${path}`, {
+    ...init,
+    headers: {
+      ...(init?.headers || {}),
+      ...(previa ? { "If-None-Match": previa.etag } : {}),
+    },
+    cache: "no-store",
+  });
+  if (res.status === 304 && previa) return previa.datos as T;
+  if (!res.ok) {
+    let detail = "Error inesperado";
+    try {
+      const j = await res.json();
+      detail = j.detail || detail;
+    } catch {}
+    throw new Error(detail);
+  }
+  const datos = (await res.json()) as T;
+  const etag = res.headers.get("ETag");
+  if (etag) porEtag.set(path, { etag, datos });
+  return datos;
+}
+
+// POST que no debe repetirse: la misma Idempotency-Key en el reintento hace que el
+// backend devuelva la respuesta original si la primera petición sí alcanzó a llegar.
+// `crypto.randomUUID` solo existe en contextos seguros (HTTPS/localhost); en kioscos o
+// equipos de la red local por HTTP se arma la llave con `getRandomValues` o Math.random.
+function llaveIdempotencia(): string {
+  const c = typeof crypto !== "undefined" ? crypto : undefined;
+  if (c?.randomUUID) return c.randomUUID();
+  if (c?.getRandomValues) {
+    return Array.from(c.getRandomValues(new Uint8Array(16)), (b) =>
+      b.toString(16).padStart(2, "0"),
+    ).join("");
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random()
+    .toString(36)
+    .slice(2)}`;
+}
+
+async function reqUnaVez<T>(path: string, init: RequestInit): Promise<T> {
+  const llave = llaveIdempotencia();
+  const conLlave = { ...init, headers: { ...(init.headers || {}), "Idempotency-Key": llave } };
+  try {
+    return await req<T>(path, conLlave);
+  } catch (e) {
+    if (!(e instanceof TypeError)) throw e; // solo fallas de red
+    return req<T>(path, conLlave);
+  }
+}
+
 function auth(token: string): HeadersInit {
   return { Authorization: `Bearer ${token}` };
 }
@@ -94,7 +168,7 @@ function auth(token: string): HeadersInit {
 // ---------- Público ----------
 export const api = {
   registrar: (data: Record<string, unknown>) =>
-    req<LeadResponse>("/leads", { method: "POST", body: JSON.stringify(data) }),
+    reqUnaVez<LeadResponse>("/leads", { method: "POST", body: JSON.stringify(data) }),
 
   ruletaConfig: () => req<WheelSegment[]>("/ruleta/config"),
 
@@ -102,7 +176,7 @@ export const api = {
     req<{ valido: boolean; usado: boolean; nombre: string | null }>(`/magic/${token}`),
 
   girar: (token: string) =>
-    req<SpinResult>(`/ruleta/spin/${token}`, { method: "POST" }),
+    reqUnaVez<SpinResult>(`/ruleta/spin/${token}`, { method: "POST" }),
 
   // ---------- Canales (giro rápido por sede/vendedor) ----------
   infoCanal: (slug: string) => req<ChannelPublic>(`/channels/${slug}`),
@@ -110,7 +184,7 @@ export const api = {
   ruletaCanal: (slug: string) => req<WheelSegment[]>(`/channels/${slug}/ruleta`),
 
   girarCanal: (slug: string, data: Record<string, unknown>) =>
-    req<SpinResult>(`/channels/${slug}/spin`, {
+    reqUnaVez<SpinResult>(`/channels/${slug}/spin`, {
       method: "POST",
       body: JSON.stringify(data),
     }),
@@ -136,7 +210,15 @@ export const api = {
     }),
 
   metrics: (token: string) =>
-    req<Metrics>("/admin/metrics", { headers: auth(token) }),
+    reqConEtag<Metrics>("/admin/metrics", { headers: auth(token) }),
+
+  // EventSource no envía encabezados: la URL lleva un token corto (~1 min) y de un solo
+  // propósito, pedido con la sesión; la sesión nunca va en la URL.
+  tokenStream: (token: string) =>
+    req<{ access_token: string }>("/admin/stream/token", { method: "POST", headers: auth(token) }),
+
+  streamUrl: (streamToken: string) =>
+    `${BASE}/admin/stream?token=${encodeURIComponent(streamToken)}`,
 
   premios: (token: string, channelId?: string) =>
     req<Prize[]>(`/admin/prizes${channelId ? `?channel_id=${channelId}` : ""}`, {
@@ -205,4 +287,13 @@ export const api = {
     if (!res.ok) throw new Error("No se pudo generar el reporte");
     return res.blob();
   },
+
+  // Kit imprimible con los QR de todos los canales activos
+  descargarKitQr: async (token: string, formato: "pdf" | "zip"): Promise<Blob> => {
+    const res = await fetch(`${BASE}/admin/channels/qr-kit?formato=${formato}`, {
+      headers: auth(token),
+    });
+    if (!res.ok) throw new Error("No se pudo generar el kit de QR");
+    return res.blob();
+  },
 };